@@ -13,11 +13,24 @@
 from re import I, L
 from socket import TIPC_MEDIUM_IMPORTANCE
 import time,datetime
+STARTTIME = time.perf_counter()             # Startup benchmark, see firstDecision
 import argparse
-from requests import post,get
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import requests
 import json
-from scipy.signal import find_peaks
 import math
+import os
+import random
+import signal
+import threading
+import numpy as np
+IMPORTTIME = time.perf_counter() - STARTTIME
 
 # Local data and secrets
 
@@ -33,10 +46,34 @@ TIBBER_URL ="https://api.tibber.com/v1-beta/gql"
 # Default values, can be changed by command line options
 
 LOGFILE="./battery.log"
+METRICSFILE="./metrics.json" # Timing summary of last planning run
+PRICECACHE="./prices"       # Directory with fetched prices, one file per delivery day
+TUNECACHE="./tune.json"     # Revenue per day and parameter set from earlier tuning runs
+CHECKPOINT="./plan.json"    # Plan state, written after every change and resumed at restart. Empty for none
+PROFILEDIR="./profile"      # Directory where profiles of planning cycles and memory snapshot diffs are written
+ARCHIVE="./archive"         # Append only binary archive of all fetched prices and committed plans, see priceArchive. Empty for none
 WAIT = 10                   # seconds between loops
 LOGLEVEL='ERROR'
 TEST = False
 PRICECONTROL = False        # Will include setting of pricelevel in HA if set
+RESOLUTION = 'QUARTER_HOURLY'   # Price resolution requested from Tibber, HOURLY or QUARTER_HOURLY
+PLANNER = 'heuristic'       # Planning engine, 'heuristic' (peak/valley segments), 'dp' (exact dynamic programming) or 'milp' (battery and heating jointly)
+HORIZON = False             # Plan today and tomorrow as one rolling horizon (always uses the dp engine)
+WEBSOCKET = False           # Keep entity states in a local cache updated over the HA WebSocket API
+SWITCHOFFSET = 2            # Seconds after a slot boundary when the new slot is acted on
+ASYNCIO = False             # Run control loop on asyncio with concurrent I/O
+BACKTEST = None             # Directory with archived daily price files to backtest planners on, instead of running the control loop
+FLEET = None                # Config file with the homes to control in fleet mode, instead of the single home in privatetokens
+TUNE = None                 # Directory with archived daily price files to tune planner parameters on, instead of running the control loop
+TUNESAMPLES = None          # Random search, no of parameter sets drawn from TUNEGRID. All combinations if not set
+SOCSENSOR = None            # HA sensor with battery state of charge (%). If set, the plan follows the measured state of charge
+LIVE = False                # Stream power readings from the Tibber liveMeasurement subscription
+LIVEURL = None              # WebSocket for live readings, e.g. a local stand-in. Asked from Tibber if not set
+PEAKLIMIT = None            # Grid import (kW) above which the plan is overridden to shave the peak. Needs LIVE
+SIMULATE = None             # Directory with recorded daily price files to run the control loop on, on a virtual clock
+FORECAST = False            # Plan days without published prices on price scenarios from the price cache
+API = None                  # [HOST:]PORT of the local HTTP API with plan, metrics and simulation. No API if not set
+PROFILE = False             # Profile from start, see soakProfiler. Can also be switched on and off by signal SIGUSR1
 
 # Constants
 
@@ -45,6 +82,149 @@ INVERTERLOSS=0.05
 CYCLELENGTH = 3             # no of hours for a complete charging/discharging hours
 NOCHARGEHOUR = 8            # TOU mode (used for charging) needs one discharge segment. This hour will be blocked for charging, i.e no 'L' setting this hour
 CHARGINGPOWER = 2.5         # Charging and discharging power (kW)
+HEATINGPOWER = {'Off':0.0,'Eco':1.0,'Normal':2.0}   # Power (kW) drawn by heating at each heating level, used by the milp planner
+HEATOFFMAX = 3              # Max no of hours heating may be Off within any HEATOFFWINDOW hours (milp planner)
+HEATOFFWINDOW = 8           # Hours of the rolling window HEATOFFMAX is counted over (milp planner)
+BASELOAD = 0.5              # Household load (kW) besides heating and battery (milp planner)
+GRIDLIMIT = 11.0            # Max grid import (kW), main fuse or effect tariff (milp planner). PEAKLIMIT is used if set
+MILPTIMELIMIT = 5           # Max seconds for one solve by the milp planner, best plan found so far is used
+PLANNERS = ['heuristic','dp','milp']
+FORECASTHOUR = 23           # Tomorrow is planned on forecast prices from this hour if Tibber has not published prices yet
+FORECASTDAYS = 28           # No of days back in the price cache used for price scenarios
+FORECASTDECAY = 0.95        # Weight of a cached day per day of age, recent days are more like tomorrow
+SCENARIOS = 2000            # No of price scenarios each candidate vector is scored on
+HTTPTIMEOUT = (3.05,10)     # Connect and read timeout (s) for requests to Home Assistant and Tibber
+HTTPRETRIES = 3             # No of retries when a request fails on connection, timeout or server error
+HTTPBACKOFF = 0.5           # Delay (s) before first retry, doubled for each retry...
+HTTPBACKOFFMAX = 4          # ...but never longer than this
+SOCDRIFT = 10               # Re-plan rest of day when measured state of charge differs this much (%) from the planned
+RECONCILE = 3600            # Seconds between checks of actuator states in HA against the local copy (without WebSocket state cache)
+LIVEBUFFER = 1800           # No of live readings kept (about an hour with a reading every 2 s)
+LIVETIMEOUT = 60            # Seconds without a live reading before the Tibber WebSocket is reconnected
+PEAKWINDOW = 10             # Seconds of live readings averaged to rolling import/export power
+PEAKHOLD = 120              # Seconds the peak shaving override is kept after import was last above PEAKLIMIT
+APIMEMO = 64                # No of API results kept, by hash of their input
+APITIMEOUT = 60             # Seconds a simulation may run before /simulate answers 503 and its process is stopped
+WSPING = 30                 # Seconds of silence on the HA WebSocket before a ping is sent. No answer to the ping means reconnect
+PROFILEINTERVAL = 3600      # Seconds between memory snapshots when profiling
+PROFILETOP = 25             # No of functions, or allocating lines, written per profile or snapshot diff
+PROFILETREND = 48           # No of snapshots the memory trend is computed on
+SIMPUBLISHHOUR = 13         # Hour when the simulated Tibber publishes next days prices
+ADAPTERS = {}               # Transport adapters by url prefix, mounted on every httpClient (simulation)
+
+#########################################################################
+#
+# Clock of the control loops
+#
+# All reads of the time of day and all sleeps of the control loop go through CLOCK, so a simulation can
+# replace it by a virtualClock. Latency measurements and the live stream always use the real clock.
+#
+#########################################################################
+
+class wallClock:
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def today(self):
+        return datetime.date.today()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    #
+    # Waits for event at most timeout seconds, returns True if it was set
+    #
+    def wait(self,event,timeout):
+        return event.wait(timeout)
+
+class simulationEnd(Exception):
+    pass
+
+#
+# Time moves only when the control loop waits, and at once. Raises simulationEnd when end (epoch) is passed.
+#
+
+class virtualClock(wallClock):
+
+    def __init__(self,start,end):
+        self.epoch = start
+        self.end = end
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.epoch)
+
+    def today(self):
+        return self.now().date()
+
+    def monotonic(self):
+        return self.epoch
+
+    def wait(self,event,timeout):
+        if event.is_set() : return True
+        self.epoch = self.epoch + timeout
+        if self.epoch >= self.end : raise simulationEnd()
+        return False
+
+CLOCK = wallClock()
+
+#########################################################################
+#
+# Class holding a pooled keep-alive HTTP session towards one server.
+# All requests have timeouts and are retried with bounded backoff.
+# Latency and error counters are kept in stats.
+#
+#########################################################################
+
+class httpClient:
+
+    def __init__(self,url,headers,logger):
+
+        self.url = url
+        self.headers = headers
+        self.logger = logger
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=4)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+        for prefix,adapter in ADAPTERS.items() :
+            self.session.mount(prefix,adapter)
+            if url.startswith(prefix) : self.session.trust_env = False      # No proxy lookup towards in process servers
+        self.stats = {'requests':0,'errors':0,'retries':0,'failures':0,'latency':0.0,'maxlatency':0.0}
+
+    #
+    # Sends a request to url + path. Returns the response, or None if all attempts failed.
+    # Responses with status < 500 are returned as is, error handling is up to the caller.
+    #
+    def request(self,method,path='',**kwargs):
+        for attempt in range(HTTPRETRIES+1):
+            if attempt > 0 :
+                self.stats['retries'] += 1
+                time.sleep(min(HTTPBACKOFF*2**(attempt-1),HTTPBACKOFFMAX))
+            start = time.monotonic()
+            try:
+                response = self.session.request(method,self.url + path,timeout=HTTPTIMEOUT,**kwargs)
+                error = f"status {response.status_code}"
+            except requests.exceptions.RequestException as err:
+                response = None
+                error = err
+            latency = time.monotonic() - start
+            self.stats['requests'] += 1
+            self.stats['latency'] += latency
+            self.stats['maxlatency'] = max(self.stats['maxlatency'],latency)
+            if response is not None and response.status_code < 500 :
+                return response
+            self.stats['errors'] += 1
+            self.logger.warning(f"Request {method} {self.url + path} failed (attempt {attempt+1}): {error}")
+        self.stats['failures'] += 1
+        self.logger.error(f"Request {method} {self.url + path} failed after {HTTPRETRIES+1} attempts")
+        return None
+
+    def statistics(self):
+        stats = dict(self.stats)
+        stats['avglatency'] = stats['latency']/stats['requests'] if stats['requests'] else 0
+        return stats
 
 #########################################################
 #
@@ -52,7 +232,7 @@ CHARGINGPOWER = 2.5         # Charging and discharging power (kW)
 #
 #########################################################   
 
-class homeAssistant:
+class homeAssistant(httpClient):
 
     def __init__(self,url,token,logger):
     
@@ -60,12 +240,144 @@ class homeAssistant:
         #   create object holding server
         #
 
-        self.headers = {
+        headers = {
             "Authorization": "Bearer " + token,
             "content-type": "application/json",
         }
-        self.url = url
-        self.logger = logger
+        super().__init__(url,headers,logger)
+        self.token = token
+        self.cache = None               # haStateCache, if entity states are kept updated over the WebSocket API
+        self.entities = set()           # Ids of entities used on this server, all tracked by the cache
+
+    def track(self,id):
+        self.entities.add(id)
+        if self.cache : self.cache.track(id)
+
+    #
+    # True if the state of entity id is read from the WebSocket state cache, i.e. without request
+    #
+    def cached(self,id):
+        return self.cache is not None and self.cache.has(id)
+
+    #
+    # Starts a WebSocket state cache for this server. Url defaults to the HA WebSocket API on the same host.
+    # Entities made before are tracked too. Returns True if the cache is connected and has fetched initial
+    # states within timeout seconds.
+    #
+    def startCache(self,url=None,timeout=10):
+        cache = haStateCache(self,url)
+        for id in self.entities :
+            cache.track(id)
+        self.cache = cache
+        return self.cache.start(timeout)
+
+#####################################################################################
+#
+# Local cache of entity states kept up to date by Home Assistant state_changed events
+#
+# A background thread connects to the WebSocket API, subscribes to state_changed, fetches initial
+# states and then applies each event for tracked entities. Reads are local lookups. If the connection
+# is lost the cache is marked stale (getState returns None, callers fall back to REST) until reconnected.
+#
+#####################################################################################
+
+class haStateCache:
+
+    def __init__(self,ha,url=None):
+        try:
+            import websocket
+        except ImportError:
+            ha.logger.error("Python package websocket-client is needed for the WebSocket state cache")
+            raise
+        self.websocket = websocket
+        self.url = url if url else ha.url.replace('http',"ws",1) + "/api/websocket"
+        self.token = ha.token
+        self.logger = ha.logger
+        self.entities = set()
+        self.states = {}
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.stats = {'events':0,'connects':0}
+        self.thread = threading.Thread(target=self.run,name="hacache",daemon=True)
+
+    def start(self,timeout=10):
+        self.thread.start()
+        return self.connected.wait(timeout)
+
+    def track(self,id):
+        with self.lock:
+            self.entities.add(id)
+
+    def getState(self,id):
+        if not self.connected.is_set() : return None
+        with self.lock:
+            return self.states.get(id)
+
+    def has(self,id):
+        return self.getState(id) is not None
+
+    def putState(self,id,state):
+        with self.lock:
+            if id in self.entities : self.states[id] = state
+
+    def run(self):
+        backoff = HTTPBACKOFF
+        while True:
+            try:
+                self.session()
+                backoff = HTTPBACKOFF
+            except Exception as err:
+                self.logger.warning(f"Home Assistant WebSocket disconnected: {err}")
+            self.connected.clear()
+            time.sleep(backoff)
+            backoff = min(backoff*2,HTTPBACKOFFMAX)
+
+    #
+    # One connection, returns or raises when connection is lost
+    #
+    def session(self):
+        ws = self.websocket.create_connection(self.url,timeout=HTTPTIMEOUT[0])
+        try:
+            ws.settimeout(WSPING)
+            if json.loads(ws.recv())['type'] != 'auth_required' :
+                raise ConnectionError("Unexpected WebSocket greeting")
+            ws.send(json.dumps({'type':'auth','access_token':self.token}))
+            if json.loads(ws.recv())['type'] != 'auth_ok' :
+                raise ConnectionError("WebSocket authentication failed")
+            ws.send(json.dumps({'id':1,'type':'subscribe_events','event_type':'state_changed'}))
+            ws.send(json.dumps({'id':2,'type':'get_states'}))
+            self.stats['connects'] += 1
+            msgid = 2
+            waiting = False
+            while True:
+                try:
+                    msg = json.loads(ws.recv())
+                except self.websocket.WebSocketTimeoutException:
+                    if waiting : raise ConnectionError("No answer to ping")
+                    msgid += 1
+                    ws.send(json.dumps({'id':msgid,'type':'ping'}))
+                    waiting = True
+                    continue
+                waiting = False
+                if msg['type'] == 'event' :
+                    data = msg['event']['data']
+                    if data['entity_id'] in self.entities :
+                        self.stats['events'] += 1
+                        with self.lock:
+                            if data['new_state'] is None :
+                                self.states.pop(data['entity_id'],None)
+                            else :
+                                self.states[data['entity_id']] = data['new_state']['state']
+                elif msg['type'] == 'result' and msg['id'] == 2 :
+                    with self.lock:
+                        for x in msg['result'] :
+                            if x['entity_id'] in self.entities : self.states[x['entity_id']] = x['state']
+                    self.connected.set()
+                    self.logger.info(f"Home Assistant WebSocket state cache connected, {len(self.states)} entities")
+                elif msg['type'] == 'result' and not msg.get('success',True) :
+                    raise ConnectionError(f"WebSocket command failed: {msg.get('error')}")
+        finally:
+            ws.close()
 
 ###################################################################
 #
@@ -77,15 +389,25 @@ class haEntity():
     
     def __init__(self,ha,id):
 
-        self.url=ha.url
-        self.headers = ha.headers
+        self.ha = ha
         self.id = id
         self.logger = ha.logger
+        ha.track(id)
 
-        
+    #
+    # Returns state of entity, None if Home Assistant can't be reached
+    # With a WebSocket state cache this is a local lookup, REST is only used if the cache doesn't know the entity (yet)
+    #
     def getState(self):
-        response = get(self.url + "/api/states/" + self.id, headers=self.headers)
-        return json.loads(response.text)['state']
+        if self.ha.cache :
+            state = self.ha.cache.getState(self.id)
+            if state is not None : return state
+        response = self.ha.request('GET',"/api/states/" + self.id)
+        if response is None or not response.ok :
+            return None
+        state = json.loads(response.text)['state']
+        if self.ha.cache : self.ha.cache.putState(self.id,state)
+        return state
 
     def setState(self,state,attributes={}):
         logger = self.logger
@@ -96,10 +418,15 @@ class haEntity():
         if attributes:
             payload["attributes"] = attributes
 
-        response = post(self.url + "/api/states/" + self.id, headers=self.headers, json=payload )
+        with TIMER.stage('push'):
+            response = self.ha.request('POST',"/api/states/" + self.id, json=payload)
+        if response is None :
+            return False
         if not response.ok:
             logger.error('Failed to send request to homeassistant: ' + str(response.status_code) +
                 ' - ' + response.reason + ', url: ' + response.url + ', req: ' + str(payload) + ', response_req: ' + str(response.request.body))
+        elif self.ha.cache :
+            self.ha.cache.putState(self.id,state)               # Don't wait for the state_changed event
 
         return response.ok
 
@@ -107,17 +434,774 @@ class haEntity():
         payload = {
             "entity_id" : self.id
         }
-        response = post(self.url + "/api/services/switch/turn_on", headers=self.headers ,json=payload)
-        return response.ok
+        response = self.ha.request('POST',"/api/services/switch/turn_on", json=payload)
+        return response is not None and response.ok
 
     def turnOff(self):
         payload = {
             "entity_id" : self.id
         }
-        response = post(self.url + "/api/services/switch/turn_off", headers=self.headers ,json=payload)
-        return response.ok
+        response = self.ha.request('POST',"/api/services/switch/turn_off", json=payload)
+        return response is not None and response.ok
+
+#####################################################################################
+#
+# Asyncio variants of homeAssistant and haEntity, used by the asyncio control loop (amain)
+#
+# Coroutines are prefixed with 'a' (arequest, agetState, ...). The synchronous methods are
+# inherited unchanged and can still be used, e.g. in test mode.
+#
+#####################################################################################
+
+class asyncHomeAssistant(homeAssistant):
+
+    def __init__(self,url,token,logger):
+        super().__init__(url,token,logger)
+        try:
+            import aiohttp
+        except ImportError:
+            logger.error("Python package aiohttp is needed for the asyncio control loop")
+            raise
+        self.aiohttp = aiohttp
+        self.asession = None            # Created at first use, must be created within the event loop
+
+    #
+    # Same as request, but returns a tuple (status,text). (None,None) if all attempts failed.
+    #
+    async def arequest(self,method,path='',**kwargs):
+        if self.asession is None :
+            self.asession = self.aiohttp.ClientSession(headers=self.headers,
+                connector=self.aiohttp.TCPConnector(limit=4,keepalive_timeout=60),
+                timeout=self.aiohttp.ClientTimeout(sock_connect=HTTPTIMEOUT[0],sock_read=HTTPTIMEOUT[1]))
+        for attempt in range(HTTPRETRIES+1):
+            if attempt > 0 :
+                self.stats['retries'] += 1
+                await asyncio.sleep(min(HTTPBACKOFF*2**(attempt-1),HTTPBACKOFFMAX))
+            start = time.monotonic()
+            try:
+                async with self.asession.request(method,self.url + path,**kwargs) as response:
+                    status = response.status
+                    text = await response.text()
+                error = f"status {status}"
+            except (self.aiohttp.ClientError,asyncio.TimeoutError) as err:
+                status = None
+                error = err
+            latency = time.monotonic() - start
+            self.stats['requests'] += 1
+            self.stats['latency'] += latency
+            self.stats['maxlatency'] = max(self.stats['maxlatency'],latency)
+            if status is not None and status < 500 :
+                return status,text
+            self.stats['errors'] += 1
+            self.logger.warning(f"Request {method} {self.url + path} failed (attempt {attempt+1}): {error}")
+        self.stats['failures'] += 1
+        self.logger.error(f"Request {method} {self.url + path} failed after {HTTPRETRIES+1} attempts")
+        return None,None
+
+    async def aclose(self):
+        if self.asession is not None :
+            await self.asession.close()
+            self.asession = None
+
+class asyncHaEntity(haEntity):
+
+    async def agetState(self):
+        if self.ha.cache :
+            state = self.ha.cache.getState(self.id)
+            if state is not None : return state
+        status,text = await self.ha.arequest('GET',"/api/states/" + self.id)
+        if status is None or status >= 400 :
+            return None
+        state = json.loads(text)['state']
+        if self.ha.cache : self.ha.cache.putState(self.id,state)
+        return state
+
+    async def asetState(self,state,attributes={}):
+        payload = {
+            "state" : state
+        }
+        if attributes:
+            payload["attributes"] = attributes
+        with TIMER.stage('push'):
+            status,text = await self.ha.arequest('POST',"/api/states/" + self.id, json=payload)
+        if status is None :
+            return False
+        if status >= 400 :
+            self.logger.error(f"Failed to send request to homeassistant: {status} - {text}, req: {payload}")
+            return False
+        if self.ha.cache : self.ha.cache.putState(self.id,state)
+        return True
+
+    async def aturnOn(self):
+        status,text = await self.ha.arequest('POST',"/api/services/switch/turn_on", json={"entity_id" : self.id})
+        return status is not None and status < 400
+
+    async def aturnOff(self):
+        status,text = await self.ha.arequest('POST',"/api/services/switch/turn_off", json={"entity_id" : self.id})
+        return status is not None and status < 400
+
+
+#####################################################################################
+#
+# Write-through actuator on top of a haEntity (or asyncHaEntity)
+#
+# Keeps the state and attributes last confirmed by HA, so deciding what to do needs no request.
+# Writes are only made when they change something. Attribute updates are collected by update() and
+# written with the next state change, or by flush() at the end of the slot, one write for all of them.
+# With the WebSocket state cache the local copy is checked at every read (no request). Without it, it is only read
+# from HA at the first read, and by reconcile() every RECONCILE seconds, called by the control loop after the
+# slot has been acted on, so the check is never on the path of a mode switch. Changes made in HA are then taken over.
+#
+#####################################################################################
+
+class haActuator:
+
+    def __init__(self,entity):
+        self.entity = entity
+        self.logger = entity.logger
+        self.state = None               # Last state confirmed by HA
+        self.attributes = {}            # Last attributes confirmed by HA
+        self.pending = {}               # Attribute updates not written yet
+        self.verified = None            # Monotonic time of last check against HA
+        self.lock = None                # Serializes writes on asyncio, created at first use
+
+    def cached(self):
+        return self.entity.ha.cached(self.entity.id)
+
+    def due(self):
+        return not self.cached() and (self.verified is None or CLOCK.monotonic() - self.verified >= RECONCILE)
+
+    #
+    # State read from HA
+    #
+    def confirm(self,state):
+        self.verified = CLOCK.monotonic()
+        if state is None : return
+        if self.state is not None and state != self.state :
+            self.logger.info(f"{self.entity.id} changed in Home Assistant from {self.state} to {state}")
+        self.state = state
+
+    def update(self,attributes):
+        self.pending.update(attributes)
+
+    #
+    # Returns (state,attributes) to write, None if there is nothing new (or state is unknown). state None keeps the state.
+    #
+    def change(self,state,attributes):
+        self.pending.update(attributes)
+        if state is None : state = self.state
+        if state is None : return None
+        attributes = {**self.attributes,**self.pending}
+        if state == self.state and attributes == self.attributes :
+            self.pending = {}
+            return None
+        return state,attributes
+
+    def written(self,state,attributes):
+        self.state = state
+        self.attributes = attributes
+        self.pending = {k:v for k,v in self.pending.items() if attributes.get(k) != v}     # Updated while writing
+
+    def current(self):
+        if self.state is None or self.cached() : self.confirm(self.entity.getState())
+        return self.state
+
+    def reconcile(self):
+        if self.due() : self.confirm(self.entity.getState())
+
+    def set(self,state=None,attributes={}):
+        change = self.change(state,attributes)
+        if change is None : return False
+        if not self.entity.setState(*change) : return False
+        self.written(*change)
+        return True
+
+    def flush(self):
+        return self.set()
+
+    async def acurrent(self):
+        if self.state is None or self.cached() : self.confirm(await self.entity.agetState())
+        return self.state
+
+    async def areconcile(self):
+        if self.due() : self.confirm(await self.entity.agetState())
+
+    async def aset(self,state=None,attributes={}):
+        if self.lock is None : self.lock = asyncio.Lock()
+        async with self.lock:
+            change = self.change(state,attributes)
+            if change is None : return False
+            if not await self.entity.asetState(*change) : return False
+            self.written(*change)
+            return True
+
+    async def aflush(self):
+        return await self.aset()
+
+#####################################################################################
+#
+# Scheduler waking up the control loop at slot boundaries
+#
+# The next boundary is taken from the start times of the price periods in the plan (next full slot
+# on the wall clock if there are no prices). The sleep is measured on the monotonic clock, so it is
+# not affected by clock adjustments. If the wall clock says we woke up early anyway (NTP step), the
+# remaining time is slept again. One wakeup per slot, unless wakeup() is called (from any thread), then
+# the sleep ends at once and returns None.
+#
+#####################################################################################
+
+class slotScheduler:
+
+    def __init__(self,logger,offset=SWITCHOFFSET):
+        self.logger = logger
+        self.offset = offset
+        self.stats = {'wakeups':0,'maxlate':0.0,'woken':0}
+        self.woken = threading.Event()
+        self.awoken = None              # asyncio.Event and its loop, created by asleep
+        self.loop = None
+
+    def wakeup(self):
+        self.woken.set()
+        if self.loop and not self.loop.is_closed() : self.loop.call_soon_threadsafe(self.awoken.set)
+
+    def nextBoundary(self,priceinfo,now):
+        for data in (priceinfo['today'],priceinfo['tomorrow']) :
+            start = data.nextStart(now)
+            if start : return start
+        minutes = priceinfo['today'].minutes
+        boundary = now.replace(second=0,microsecond=0)
+        return boundary + datetime.timedelta(minutes=minutes - boundary.minute % minutes)
+
+    def delay(self,boundary):
+        return (boundary - CLOCK.now().astimezone()).total_seconds() + self.offset
+
+    def sleep(self,priceinfo):
+        boundary = self.nextBoundary(priceinfo,CLOCK.now().astimezone())
+        self.logger.debug(f"Next slot starts at {boundary}")
+        while True:
+            delay = self.delay(boundary)
+            if delay <= 0 : break
+            deadline = CLOCK.monotonic() + delay
+            while CLOCK.monotonic() < deadline :
+                if CLOCK.wait(self.woken,max(0,deadline - CLOCK.monotonic())) :
+                    self.woken.clear()
+                    self.stats['woken'] += 1
+                    return None
+            self.stats['wakeups'] += 1
+        self.stats['maxlate'] = max(self.stats['maxlate'],-delay)
+        return boundary
+
+    async def asleep(self,priceinfo):
+        if self.awoken is None :
+            self.awoken = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
+        boundary = self.nextBoundary(priceinfo,CLOCK.now().astimezone())
+        self.logger.debug(f"Next slot starts at {boundary}")
+        while True:
+            delay = self.delay(boundary)
+            if delay <= 0 : break
+            try:
+                await asyncio.wait_for(self.awoken.wait(),delay)    # Event loop timers run on the monotonic clock
+                self.awoken.clear()
+                self.stats['woken'] += 1
+                return None
+            except asyncio.TimeoutError:
+                pass
+            self.stats['wakeups'] += 1
+        self.stats['maxlate'] = max(self.stats['maxlate'],-delay)
+        return boundary
+
+#####################################################################################
+#
+# Live power readings from Tibber (Pulse/Watty) and peak shaving
+#
+# A background thread subscribes to liveMeasurement over the Tibber WebSocket API (graphql-transport-ws)
+# and puts each reading in a ring buffer of fixed size, so memory use never grows. Rolling import and
+# export power is the mean of the readings of the last PEAKWINDOW seconds. After each reading the
+# listeners are called, from the thread. The WebSocket url (and home id) is asked from Tibber unless
+# given, so the stream can be replayed by a local stand-in (option --liveurl).
+#
+#####################################################################################
+
+class liveBuffer:
+
+    def __init__(self,size=LIVEBUFFER):
+        self.time = np.full(size,-np.inf)          # Arrival time (epoch s), -inf for unused positions
+        self.power = np.zeros(size)                # Import from grid (W)
+        self.production = np.zeros(size)           # Export to grid (W)
+        self.count = 0                             # Readings appended so far, next position is count % size
+        self.lock = threading.Lock()
+
+    def append(self,t,power,production):
+        with self.lock:
+            i = self.count % len(self.time)
+            self.time[i],self.power[i],self.production[i] = t,power,production
+            self.count += 1
+
+    #
+    # Mean import and export (kW) over the last seconds, None if there are no readings. The window is a mask
+    # over the whole buffer, so the order of the ring does not matter.
+    #
+    def rolling(self,seconds,now=None):
+        if now is None : now = time.time()
+        with self.lock:
+            window = self.time >= now - seconds
+            if not window.any() : return None,None
+            return self.power[window].mean()/1000,self.production[window].mean()/1000
+
+class tibberLive:
+
+    def __init__(self,logger,url=None,home=None,size=LIVEBUFFER):
+        try:
+            import websocket
+        except ImportError:
+            logger.error("Python package websocket-client is needed for Tibber live measurements")
+            raise
+        self.websocket = websocket
+        self.logger = logger
+        self.url = url
+        self.home = home
+        self.lookup = url is None              # Ask Tibber for url and home id at connect
+        self.buffer = liveBuffer(size)
+        self.listeners = []
+        self.stats = {'readings':0,'connects':0}
+        self.thread = threading.Thread(target=self.run,name="tibberlive",daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def rolling(self,seconds=PEAKWINDOW):
+        return self.buffer.rolling(seconds)
+
+    def run(self):
+        backoff = HTTPBACKOFF
+        while True:
+            try:
+                self.session()
+                backoff = HTTPBACKOFF
+            except Exception as err:
+                self.logger.warning(f"Tibber live measurement disconnected: {err}")
+            time.sleep(backoff)
+            backoff = min(backoff*2,LIVETIMEOUT)
+
+    def endpoint(self):
+        gql = '{ "query": "{viewer {websocketSubscriptionUrl homes {id features {realTimeConsumptionEnabled}}}}"}'
+        response = tibberClient(self.logger).request('POST',data=gql)
+        if response is None : raise ConnectionError("Tibber not reachable")
+        viewer = json.loads(response.text)['data']['viewer']
+        homes = [x['id'] for x in viewer['homes'] if x.get('features',{}).get('realTimeConsumptionEnabled')]
+        if not homes : raise ConnectionError("No home with real time consumption (Pulse) in Tibber account")
+        self.url,self.home = viewer['websocketSubscriptionUrl'],homes[0]
+        self.lookup = False
+
+    #
+    # One connection, returns or raises when connection is lost
+    #
+    def session(self):
+        if self.lookup : self.endpoint()
+        ws = self.websocket.create_connection(self.url,timeout=HTTPTIMEOUT[0],subprotocols=['graphql-transport-ws'],
+            header=["User-Agent: batterycontrol"])
+        try:
+            ws.settimeout(LIVETIMEOUT)
+            ws.send(json.dumps({'type':'connection_init','payload':{'token':privatetokens.TIBBER_TOKEN}}))
+            if json.loads(ws.recv())['type'] != 'connection_ack' :
+                raise ConnectionError("Tibber WebSocket authentication failed")
+            query = 'subscription {liveMeasurement(homeId:"' + str(self.home or '') + '") {timestamp power powerProduction}}'
+            ws.send(json.dumps({'id':'1','type':'subscribe','payload':{'query':query}}))
+            self.stats['connects'] += 1
+            self.logger.info(f"Tibber live measurement connected to {self.url}")
+            while True:
+                try:
+                    msg = json.loads(ws.recv())
+                except self.websocket.WebSocketTimeoutException:
+                    raise ConnectionError(f"No live reading for {LIVETIMEOUT} s")
+                if msg['type'] == 'next' :
+                    reading = msg['payload']['data']['liveMeasurement']
+                    self.buffer.append(time.time(),reading.get('power') or 0,reading.get('powerProduction') or 0)
+                    self.stats['readings'] += 1
+                    for listener in self.listeners :
+                        listener()
+                elif msg['type'] == 'ping' :
+                    ws.send(json.dumps({'type':'pong'}))
+                elif msg['type'] in ('error','complete') :
+                    raise ConnectionError(f"Subscription ended: {msg.get('payload')}")
+        finally:
+            ws.close()
+
+#
+# Overrides the plan while grid import is above PEAKLIMIT. Charging or holding (Idle) the battery is then replaced by
+# Selfconsumption, so the battery covers the load instead. The override is kept PEAKHOLD seconds after import was last
+# above the limit, then the planned mode is set again. Discharge and Selfconsumption already shave the peak.
+#
+
+class peakShaver:
+
+    def __init__(self,live,limit,logger):
+        self.live = live
+        self.limit = limit
+        self.logger = logger
+        self.peak = None                # Monotonic time import was last seen above limit
+        self.active = False
+        self.above = False              # Import above limit at the last reading, as last reported by due()
+        self.stats = {'overrides':0,'maxpeak':0.0}
+
+    def shaving(self):
+        importing,exporting = self.live.rolling(PEAKWINDOW)
+        now = time.monotonic()
+        if importing is not None and importing > self.limit :
+            self.peak = now
+            self.stats['maxpeak'] = max(self.stats['maxpeak'],round(importing,2))
+        return self.peak is not None and now - self.peak < PEAKHOLD
+
+    #
+    # Called by the live thread after each reading. True if the control loop should act now, i.e a peak has started
+    # or the hold time of an override has run out. A peak is reported once when it starts, so a peak during a plan
+    # that is not overridden (Discharge, Selfconsumption) does not wake the control loop at every reading.
+    #
+    def due(self):
+        importing,exporting = self.live.rolling(PEAKWINDOW)
+        above = importing is not None and importing > self.limit
+        started = above and not self.above
+        self.above = above
+        if self.active : return self.peak is None or time.monotonic() - self.peak >= PEAKHOLD
+        return started
+
+    #
+    # Same as batteryPlan.batteryMode, with the override applied
+    #
+    def batteryMode(self,plan,slot,battery_mode):
+        planned = plan.plannedMode(slot)
+        if self.shaving() and planned in ('Charge','Idle') :
+            if not self.active :
+                self.stats['overrides'] += 1
+                self.logger.info(f"Grid import above {self.limit} kW, {planned} overridden by Selfconsumption")
+            self.active = True
+            return 'Selfconsumption' if battery_mode != 'Selfconsumption' else None
+        if self.active :
+            self.active = False
+            self.logger.info(f"Grid import below {self.limit} kW for {PEAKHOLD} s, back to plan")
+            return planned if planned != battery_mode else None
+        return plan.batteryMode(slot,battery_mode)
+
+#####################################################################################
+#
+# Timing of planning stages
+#
+# Stages (fetch, parse, cache, segment, build, score, push) are timed on the monotonic clock with
+#   with TIMER.stage('build'):
+#       ...
+# A planning run starts with reset(). summary() gives time per stage in ms, published by publishMetrics.
+#
+#####################################################################################
+
+class stageTimer:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.started = CLOCK.now().astimezone()
+
+    @contextlib.contextmanager
+    def stage(self,name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            count,total = self.stages.get(name,(0,0.0))
+            self.stages[name] = (count+1,total + time.perf_counter() - start)
+
+    def summary(self):
+        summary = {'started':self.started.isoformat(timespec='seconds')}
+        for name,(count,total) in self.stages.items() :
+            summary[name + '_ms'] = round(total*1000,2)
+            summary[name + '_calls'] = count
+        summary['total_ms'] = round(sum(total for count,total in self.stages.values())*1000,2)
+        return summary
+
+TIMER = stageTimer()
+
+#
+# Startup benchmark. Time from start of import to the first battery mode decision and memory use at that point,
+# logged once and included in the published metrics.
+#
+
+STARTUP = {}
+METRICS = {}                    # Timing summary of the last planning run, see publishMetrics
+
+def memoryUsage():
+    import resource
+    usage = {'maxrss_kb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    try:
+        with open('/proc/self/statm') as f:
+            usage['rss_kb'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError,ValueError):
+        pass
+    return usage
+
+def firstDecision(logger):
+    if STARTUP : return
+    STARTUP['import_ms'] = round(IMPORTTIME*1000,1)
+    STARTUP['first_decision_ms'] = round((time.perf_counter() - STARTTIME)*1000,1)
+    STARTUP.update(memoryUsage())
+    logger.info(f"Startup benchmark: {STARTUP}")
+
+#
+# Writes timing summary of the last planning run to METRICSFILE and, if entity is given, as attributes of the entity in HA
+#
+
+def publishMetrics(logger,entity=None):
+    summary = TIMER.summary()
+    summary.update(STARTUP)
+    METRICS.clear()
+    METRICS.update(summary)
+    logger.info(f"Planning run timing: {summary}")
+    try:
+        with open(METRICSFILE + ".tmp",'w') as f:
+            json.dump(summary,f)
+        os.replace(METRICSFILE + ".tmp",METRICSFILE)
+    except OSError as err:
+        logger.error(f"Failed to write metrics file: {err}")
+    if entity :
+        entity.setState(summary['total_ms'],summary)
+    return summary
+
+#
+# Profiling of the daemon (option --profile, or signal SIGUSR1 to switch on and off at runtime)
+#
+# When switched on, the next slot of the control loop is profiled by cProfile, together with a planning run of
+# today and tomorrow on the current prices (a throw away plan, nothing is set). Memory allocations are traced by
+# tracemalloc and a snapshot is taken every PROFILEINTERVAL. Each snapshot is compared to the previous one and the lines
+# that allocated most since are written to PROFILEDIR. RSS and traced memory, and their growth per hour over the last
+# PROFILETREND snapshots, are reported after each snapshot. The signal handler only sets a flag, the control loop
+# acts on it at the next slot.
+#
+
+class soakProfiler:
+
+    def __init__(self,logger,directory):
+        self.logger = logger
+        self.directory = directory
+        self.active = False
+        self.toggled = False            # Set by the signal handler
+        self.armed = False              # Next slot is profiled
+        self.cycle = None               # cProfile.Profile of the slot being profiled
+        self.snapshot = None            # Last tracemalloc snapshot
+        self.taken = None               # CLOCK.monotonic() of last snapshot
+        self.trend = []                 # (hours,rss_kb,traced_kb) of each snapshot
+        self.top = []                   # Lines that allocated most between the last two snapshots
+        self.stats = {'cycles':0,'snapshots':0}
+
+    def toggle(self,signum=None,frame=None):
+        self.toggled = True
+
+    def start(self):
+        import tracemalloc
+        try:
+            os.makedirs(self.directory,exist_ok=True)
+        except OSError as err:
+            self.logger.error(f"Profiling not started, no directory {self.directory}: {err}")
+            return
+        tracemalloc.start()                     # One frame per allocation, allocations are compared by line
+        self.active,self.armed = True,True
+        self.snapshot,self.taken,self.trend,self.top = None,None,[],[]
+        self.logger.info(f"Profiling started, written to {self.directory}")
+
+    def stop(self):
+        import tracemalloc
+        if self.cycle is not None : self.cycle.disable()
+        tracemalloc.stop()
+        self.active,self.armed,self.cycle,self.snapshot = False,False,None,None
+        self.logger.info(f"Profiling stopped: {self.stats}")
+
+    def fileName(self,kind,suffix):
+        return os.path.join(self.directory,f"{kind}-{CLOCK.now().strftime('%Y%m%d-%H%M%S')}.{suffix}")
+
+    #
+    # Called at the start of each slot
+    #
+    def begin(self):
+        if self.toggled :
+            self.toggled = False
+            self.stop() if self.active else self.start()
+        if self.armed :
+            import cProfile,pstats,io                # Imported before profiling starts
+            self.armed = False
+            self.cycle = cProfile.Profile()
+            self.cycle.enable()
+
+    #
+    # Called at the end of each slot. Returns True when a snapshot was taken, i.e. there is a new report.
+    #
+    def end(self,plan):
+        if self.cycle is not None :
+            import pstats,io
+            quiet = logging.getLogger(self.logger.name + ".profile")
+            quiet.setLevel(logging.WARNING)
+            batteryPlan(quiet).planStartup(dict(plan.priceinfo))
+            self.cycle.disable()
+            text = io.StringIO()
+            stats = pstats.Stats(self.cycle,stream=text)
+            stats.sort_stats('cumulative').print_stats(PROFILETOP)
+            try:
+                stats.dump_stats(self.fileName('cycle','prof'))
+                with open(self.fileName('cycle','txt'),'w') as f:
+                    f.write(text.getvalue())
+            except OSError as err:
+                self.logger.error(f"Failed to write profile: {err}")
+            self.cycle = None
+            self.stats['cycles'] += 1
+        if not self.active or (self.taken is not None and CLOCK.monotonic() - self.taken < PROFILEINTERVAL) :
+            return False
+        self.takeSnapshot()
+        return True
+
+    def takeSnapshot(self):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        usage = memoryUsage()
+        traced,peak = tracemalloc.get_traced_memory()
+        self.trend = self.trend[1-PROFILETREND:] + [(CLOCK.monotonic()/3600,usage.get('rss_kb',usage['maxrss_kb']),traced//1024)]
+        if self.snapshot is not None :
+            diff = [x for x in snapshot.compare_to(self.snapshot,'lineno') if x.traceback[0].filename != tracemalloc.__file__][:PROFILETOP]
+            self.top = [str(x) for x in diff[:3]]
+            try:
+                with open(self.fileName('memory','txt'),'w') as f:
+                    f.write(f"{usage} traced {traced//1024} kB, peak {peak//1024} kB\n")
+                    f.write("\n".join(str(x) for x in diff) + "\n")
+            except OSError as err:
+                self.logger.error(f"Failed to write memory snapshot diff: {err}")
+        self.snapshot = snapshot
+        self.taken = CLOCK.monotonic()
+        self.stats['snapshots'] += 1
+
+    def report(self):
+        report = dict(memoryUsage(),traced_kb=self.trend[-1][2] if self.trend else 0,**self.stats)
+        if len(self.trend) >= 3 :
+            hours,rss,traced = np.array(self.trend,dtype=float).T
+            report['rss_kb_per_hour'] = round(float(np.polyfit(hours,rss,1)[0]),2)
+            report['traced_kb_per_hour'] = round(float(np.polyfit(hours,traced,1)[0]),2)
+        report['top'] = self.top
+        return report
+
+    def publish(self,entity=None):
+        report = self.report()
+        self.logger.info(f"Profiling: {report}")
+        if entity :
+            entity.setState(report.get('rss_kb',report['maxrss_kb']),report)
+        return report
+
+def startProfiler(logger):
+    profiler = soakProfiler(logger,PROFILEDIR)
+    if hasattr(signal,'SIGUSR1') :
+        signal.signal(signal.SIGUSR1,profiler.toggle)
+    profiler.toggled = PROFILE
+    return profiler
+
+#####################################################################################
+#
+# Prices of one or more consecutive days
+#
+# Tibber priceInfo (a list of {'total','energy','tax','startsAt'}) is parsed once into numpy arrays.
+# Start times are kept as UTC seconds (epoch) and UTC offset, so slot i is always the i:th price period,
+# also on 23 and 25 hour days when daylight saving time starts or ends. hour and minute are local time.
+# Slicing gives a new priceSeries, first is then the position of the slice in the series it was taken from
+# and daylength the length of that series (the length of charge control vectors). A priceSeries can also be made
+# from RECORD records (see priceArchive), the prices are then views of the records.
+#
+#####################################################################################
+
+class priceSeries:
+
+    ARRAYS = ('total','energy','tax','epoch','utcoffset','minute','hour')
+    RECORD = np.dtype([('epoch','<i8'),('utcoffset','<i8'),('total','<f8'),('energy','<f8'),('tax','<f8')])
+
+    def __init__(self,data=[]):
+        if isinstance(data,np.ndarray) :
+            for name in self.RECORD.names :
+                self.__dict__[name] = data[name]
+        else :
+            starts = [datetime.datetime.fromisoformat(x['startsAt']) for x in data]
+            self.total = np.array([x['total'] for x in data],dtype=float)
+            self.energy = np.array([x['energy'] for x in data],dtype=float)
+            self.tax = np.array([x['tax'] for x in data],dtype=float)
+            self.epoch = np.array([int(t.timestamp()) for t in starts],dtype=np.int64)
+            self.utcoffset = np.array([int(t.utcoffset().total_seconds()) for t in starts],dtype=np.int64)
+        self.minute = (self.epoch + self.utcoffset)//60 % 1440          # Local minute of day
+        self.hour = self.minute//60
+        if len(data) < 2 :
+            self.minutes = 15 if RESOLUTION == 'QUARTER_HOURLY' else 60
+        else :
+            self.minutes = int(self.epoch[1] - self.epoch[0])//60
+        self.spm = max(1,60//self.minutes)                              # Slots per hour
+        self.first = 0
+        self.daylength = len(data)
+
+    def __len__(self):
+        return len(self.total)
+
+    def __getitem__(self,index):
+        if not isinstance(index,slice) :                                # Single price period, as in Tibber priceInfo
+            return {'total':self.total[index],'energy':self.energy[index],'tax':self.tax[index],'startsAt':self.time(index).isoformat()}
+        series = self.view()
+        for name in self.ARRAYS :
+            series.__dict__[name] = self.__dict__[name][index]          # numpy views, no copy of the prices
+        series.first = self.first + index.indices(len(self))[0]
+        return series
+
+    def __add__(self,other):
+        if not other : return self
+        if not self : return other
+        series = self.view()
+        for name in self.ARRAYS :
+            series.__dict__[name] = np.concatenate((self.__dict__[name],other.__dict__[name]))
+        series.daylength = len(series)
+        return series
+
+    def view(self):
+        series = priceSeries.__new__(priceSeries)                   # Planners slice often, skip parsing and copy module
+        series.__dict__.update(self.__dict__)
+        return series
+
+    def __repr__(self):
+        if not self : return "priceSeries([])"
+        return f"priceSeries({len(self)} slots from {self.time(0).isoformat()}: {self.total.tolist()})"
+
+    def data(self):
+        return [{'total':t,'energy':e,'tax':x,'startsAt':self.time(i).isoformat()}
+            for i,(t,e,x) in enumerate(zip(self.total.tolist(),self.energy.tolist(),self.tax.tolist()))]
+
+    def records(self):
+        records = np.empty(len(self),self.RECORD)
+        for name in self.RECORD.names :
+            records[name] = self.__dict__[name]
+        return records
+
+    def digest(self):
+        return hashlib.sha1(self.epoch.tobytes() + self.total.tobytes()).hexdigest()
+
+    def time(self,i):
+        return datetime.datetime.fromtimestamp(int(self.epoch[i]),datetime.timezone(datetime.timedelta(seconds=int(self.utcoffset[i]))))
+
+    def label(self,i):
+        return f"{self.hour[i]:02d}:{self.minute[i] % 60:02d}"
+
+    #
+    # Index of the price period now is in, None if outside the series. Periods have equal length in UTC, so no search is needed.
+    #
+    def slotAt(self,now):
+        if not self : return None
+        i = int((now.timestamp() - self.epoch[0])//(self.minutes*60))
+        return i if 0 <= i < len(self) else None
+
+    #
+    # Start of the first price period after now, None if there is none
+    #
+    def nextStart(self,now):
+        i = np.searchsorted(self.epoch,now.timestamp(),side='right')
+        return self.time(i) if i < len(self) else None
 
-    
 ###########################################################################################################
 #
 # Get command line parameters
@@ -129,17 +1213,45 @@ class haEntity():
 ###########################################################################################################
 def get_cmd_line_parameters():
 
-    global LOGFILE,LOGLEVEL,TEST,PRICECONTROL
+    global LOGFILE,METRICSFILE,CHECKPOINT,ARCHIVE,LOGLEVEL,TEST,PRICECONTROL,PLANNER,RESOLUTION,HORIZON,WEBSOCKET,PRICECACHE,SWITCHOFFSET,ASYNCIO,BACKTEST,FLEET,SOCSENSOR,TUNE,TUNESAMPLES,TUNECACHE,LIVE,LIVEURL,PEAKLIMIT,API,FORECAST,SIMULATE,PROFILE,PROFILEDIR
 
     parser = argparse.ArgumentParser( description='Battery charging control daemon' )
     parser.add_argument("-v", "--loglevel", help="Log level. DEBUG, WARNING, INFO, ERROR or CRITICAL. Default ERROR.",default=LOGLEVEL)
     parser.add_argument("-l", "--logfile", help="Log file. Default " + LOGFILE, default=LOGFILE)
+    parser.add_argument("-m", "--metrics", help="File where timing summary of last planning run is written. Default " + METRICSFILE, default=METRICSFILE)
+    parser.add_argument("-k", "--checkpoint", help="File where the plan is saved after every change and resumed from at restart, without asking Tibber. Empty for none. Default " + CHECKPOINT, default=CHECKPOINT)
+    parser.add_argument("-e", "--archive", help="Directory of the append only archive of all fetched prices and committed plans, binary columns with an index by day. Can be given to --backtest and --tune. Empty for none. Default " + ARCHIVE, default=ARCHIVE)
+    parser.add_argument("-c", "--pricecache", help="Directory where fetched prices are kept, one file per day. Default " + PRICECACHE, default=PRICECACHE)
     parser.add_argument("-t", "--test", help="Test mode. Will test HA and TIBBER interface. No loop and nothing set in HA. Logging set to INFO and name set to batterytest.log", action="store_true")
     parser.add_argument("-p", "--pricecontrol", help="Price control. Will control setting of entity input_select.heating_level.", action="store_true")
+    parser.add_argument("-r", "--resolution", help="Price resolution, HOURLY or QUARTER_HOURLY. Default " + RESOLUTION, choices=['HOURLY','QUARTER_HOURLY'], default=RESOLUTION)
+    parser.add_argument("--planner", help="Planning engine, heuristic, dp or milp (battery and heating planned jointly under the grid limit, requires scipy). Default " + PLANNER, choices=PLANNERS, default=PLANNER)
+    parser.add_argument("-w", "--websocket", help="Keep states of used HA entities in a local cache updated by HA WebSocket events. Requires websocket-client.", action="store_true")
+    parser.add_argument("-o", "--offset", help="Seconds after start of a price period when battery mode is switched. Default " + str(SWITCHOFFSET), type=float, default=SWITCHOFFSET)
+    parser.add_argument("-a", "--asyncio", help="Run control loop on asyncio. Reads and writes towards HA run concurrently, prices are fetched in background. Requires aiohttp. Not used in test mode.", action="store_true")
+    parser.add_argument("-b", "--backtest", help="Backtest. Run all planners over archived daily price files in directory (e.g. the price cache) and report revenue and planning time. No HA interaction.", metavar="DIR")
+    parser.add_argument("--tune", help="Tuning. Run the planner over archived daily price files in directory with each parameter set in TUNEGRID, in parallel, and report revenue per parameter. No HA interaction.", metavar="DIR")
+    parser.add_argument("--samples", help="Random search when tuning, no of parameter sets to try. Default all combinations.", type=int)
+    parser.add_argument("--tunecache", help="File where tuning results per day and parameter set are kept. Default " + TUNECACHE, default=TUNECACHE)
+    parser.add_argument("-f", "--fleet", help="Fleet mode. Control the battery of every home in CONFIG (JSON), each through its own HA instance. Prices for all homes are fetched from Tibber at once.", metavar="CONFIG")
+    parser.add_argument("-s", "--soc", help="Closed loop. Read battery state of charge (%%) from this HA sensor each slot and re-plan rest of the day when it drifts from the plan, e.g. sensor.battery_state_of_capacity.", metavar="ENTITY")
+    parser.add_argument("--live", help="Stream live power readings from Tibber (needs Pulse or Watty). Requires websocket-client.", action="store_true")
+    parser.add_argument("--liveurl", help="WebSocket url for live readings instead of the one given by Tibber, e.g. a local stand-in replaying recorded readings. Implies --live.", metavar="URL")
+    parser.add_argument("--peak", help="Peak shaving. Override the plan within seconds when grid import is above KW, battery covers the load instead. Implies --live.", type=float, metavar="KW")
+    parser.add_argument("--simulate", help="Simulation. Run the control loop on a virtual clock over the recorded daily price files in directory, against simulated HA and Tibber, and report requests, mode switches and revenue. Runs in the time zone of the system (set TZ to that of the prices).", metavar="DIR")
+    parser.add_argument("--forecast", help="Forecast. If prices are not published in time (tomorrow at " + str(FORECASTHOUR) + ":00, or today), plan on price scenarios from the price cache. Replaced when prices arrive.", action="store_true")
+    parser.add_argument("--api", help="Local HTTP API on [HOST:]PORT with the plan (/plan), timing metrics (/metrics) and what-if planning (POST /simulate). Host defaults to 127.0.0.1.", metavar="[HOST:]PORT")
+    parser.add_argument("--profile", help="Profiling. Profile the next slot of the control loop with a planning run, then snapshot memory allocations every hour and write profiles and snapshot diffs to DIR. Memory use and trend are set as sensor.battery_profile in HA. Also switched on and off by signal SIGUSR1. Default directory " + PROFILEDIR, nargs='?', const=PROFILEDIR, metavar="DIR")
+    parser.add_argument("--horizon", help="Rolling horizon. Plan today and tomorrow as one optimization problem with the dp engine, re-plan remaining slots when next days prices arrive.", action="store_true")
 
                         
     args = parser.parse_args()
     LOGFILE = args.logfile
+    PRICECACHE = args.pricecache
+    METRICSFILE = args.metrics
+    CHECKPOINT = args.checkpoint
+    ARCHIVE = args.archive
+    SWITCHOFFSET = args.offset
     LOGLEVEL=args.loglevel
     if args.test : 
         LOGFILE = "batterytest.log"
@@ -148,6 +1260,31 @@ def get_cmd_line_parameters():
         TEST = True
     if args.pricecontrol :
         PRICECONTROL = True
+    PLANNER = args.planner
+    RESOLUTION = args.resolution
+    if args.horizon :
+        HORIZON = True
+    if args.websocket :
+        WEBSOCKET = True
+    if args.asyncio :
+        ASYNCIO = True
+    BACKTEST = args.backtest
+    FLEET = args.fleet
+    TUNE = args.tune
+    TUNESAMPLES = args.samples
+    TUNECACHE = args.tunecache
+    SOCSENSOR = args.soc
+    LIVEURL = args.liveurl
+    PEAKLIMIT = args.peak
+    if args.live or LIVEURL or PEAKLIMIT :
+        LIVE = True
+    API = args.api
+    SIMULATE = args.simulate
+    if args.profile :
+        PROFILE = True
+        PROFILEDIR = args.profile
+    if args.forecast :
+        FORECAST = True
         
 ####################################################
 #
@@ -176,45 +1313,328 @@ def logger(name,level):
 # Function to fetch elecitricy prices from Tibber broker for today and tomorrow (if available)
 #
 
+tibber = None                   # Pooled client towards Tibber, created at first use
+
+def tibberClient(logger):
+    global tibber
+    if tibber is None :
+        authorization = {"Authorization": "Bearer" + privatetokens.TIBBER_TOKEN , "Content-Type":"application/json"}
+        tibber = httpClient(TIBBER_URL,authorization,logger)
+    return tibber
+
 def getPrices(logger):
-    authorization = {"Authorization": "Bearer" + privatetokens.TIBBER_TOKEN , "Content-Type":"application/json"}
-    gql = '{ "query": "{viewer {homes {currentSubscription {priceInfo {current {total energy tax startsAt} today {total energy tax startsAt} tomorrow { total energy tax startsAt }} }}}}"} '
-    try:
-        response = post(TIBBER_URL, data=gql, headers=authorization)
-    except Exception as err:
+    tibber = tibberClient(logger)
+    gql = '{ "query": "{viewer {homes {id currentSubscription {priceInfo(resolution: ' + RESOLUTION + ') {current {total energy tax startsAt} today {total energy tax startsAt} tomorrow { total energy tax startsAt }} }}}}"} '
+    with TIMER.stage('fetch'):
+        response = tibber.request('POST',data=gql)
+    if response is None :
         logger.error("Error connecting to Tibber")
-        logger.error(err)
-        quit()
     return response
+
 #
+# Returns prices for today and tomorrow as {'today':priceSeries, 'tomorrow':priceSeries}.
 #
-#  
-# This function builds a charging vector based on today's prices
+# Prices are kept in a local cache, one file per delivery day. Tibber is only asked if today is missing in the cache,
+# or if tomorrow is wanted and missing. If Tibber can't be reached, or doesn't have the prices yet, whatever is in the
+# cache is returned (possibly empty series). Files in the cache have the same format as Tibber priceInfo.
+#
+
+def getPriceInfo(logger,tomorrow=False):
+    return getHomesPriceInfo(logger,[None],tomorrow)[None]
+
+#
+# Same as getPriceInfo for several homes, given by Tibber home id (None is the first home of the account). One request to
+# Tibber gives prices for all homes. Returns {home:{'today':priceSeries, 'tomorrow':priceSeries}}.
+#
+
+def getHomesPriceInfo(logger,homes,tomorrow=False):
+    day = CLOCK.today()
+    priceinfo = {}
+    with TIMER.stage('parse'):
+        for home in homes :
+            priceinfo[home] = {'today':priceSeries(loadPrices(day,home)),'tomorrow':priceSeries(loadPrices(day + datetime.timedelta(days=1),home))}
+    if all(x['today'] and (x['tomorrow'] or not tomorrow) for x in priceinfo.values()) :
+        logger.info("Prices read from cache")
+        return priceinfo
+
+    response = getPrices(logger)
+    if response is None : return priceinfo
+    try:
+        with TIMER.stage('parse'):
+            fetched = {}
+            for i,x in enumerate(json.loads(response.text)['data']['viewer']['homes']) :
+                if i == 0 : fetched[None] = x['currentSubscription']['priceInfo']
+                fetched[x.get('id')] = x['currentSubscription']['priceInfo']
+    except (ValueError,KeyError,TypeError,IndexError) as err:
+        logger.error(f"Unexpected answer from Tibber: {err}")
+        return priceinfo
+    for home in homes :
+        if home not in fetched :
+            logger.error(f"Home {home} not found in Tibber account")
+            continue
+        for key in ['today','tomorrow'] :
+            if fetched[home][key] :
+                with TIMER.stage('cache'):
+                    savePrices(fetched[home][key],logger,home)
+                with TIMER.stage('parse'):
+                    priceinfo[home][key] = priceSeries(fetched[home][key])
+                with TIMER.stage('archive'):
+                    archivePrices(priceinfo[home][key],logger,home)
+    return priceinfo
+
+def priceFile(day,home=None):
+    if home :
+        return os.path.join(PRICECACHE,f"{day.isoformat()}_{RESOLUTION}_{home}.json")
+    return os.path.join(PRICECACHE,f"{day.isoformat()}_{RESOLUTION}.json")
+
+def loadPrices(day,home=None):
+    try:
+        with open(priceFile(day,home)) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return []
+
+def savePrices(data,logger,home=None):
+    day = datetime.date.fromisoformat(data[0]['startsAt'][0:10])
+    try:
+        os.makedirs(PRICECACHE,exist_ok=True)
+        tmp = priceFile(day,home) + ".tmp"
+        with open(tmp,'w') as f:
+            json.dump(data,f)
+        os.replace(tmp,priceFile(day,home))                  # Atomic, a crash never leaves a half written file
+    except OSError as err:
+        logger.error(f"Failed to write price cache: {err}")
+
+#
+# Plan checkpoint, see batteryPlan.save and batteryPlan.resume. Written like the price cache, but also synced to disk
+# so a power cut never leaves an empty file behind.
+#
+
+def planSettings():
+    return dict(resolution=RESOLUTION,planner=PLANNER,horizon=HORIZON,cyclelength=CYCLELENGTH,nochargehour=NOCHARGEHOUR,
+        chargingpower=CHARGINGPOWER,nettransfercost=NETTRANSFERCOST,inverterloss=INVERTERLOSS)
+
+def loadCheckpoint(logger):
+    if not CHECKPOINT or TEST : return None
+    try:
+        with open(CHECKPOINT) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError,ValueError) as err:
+        logger.warning(f"Failed to read checkpoint {CHECKPOINT}: {err}")
+        return None
+
+def saveCheckpoint(state,logger):
+    try:
+        with open(CHECKPOINT + ".tmp",'w') as f:
+            json.dump(state,f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(CHECKPOINT + ".tmp",CHECKPOINT)
+        return True
+    except OSError as err:
+        logger.error(f"Failed to write checkpoint: {err}")
+        return False
+
+#
+# Archive of prices and plans (option --archive)
+#
+# Every fetched price series and every committed plan is appended to a file of fixed width records, prices as
+# priceSeries.RECORD and plans as PLANRECORD (slot start, 1 charge, -1 discharge, 0 idle). An index file has a
+# record per appended day, the latest one of a day is valid. Data is written and synced before its index record,
+# so after a crash the index never points past the data. Reads are memory maps, days appended in order (the normal
+# case) are read as one slice of the map without copy. Appending a day identical to the latest one of that day is a no-op.
+#
+
+PLANRECORD = np.dtype([('epoch','<i8'),('code','i1')])
+INDEXRECORD = np.dtype([('day','<i4'),('kind','i1'),('offset','<i8'),('length','<i4')])
+ARCHIVEKINDS = {'prices':(0,priceSeries.RECORD),'plans':(1,PLANRECORD)}
+PLANCODES = np.array(['0','L','H'])         # By code, -1 is 'H'
+
+class priceArchive:
+
+    def __init__(self,directory,home=None):
+        suffix = f"_{home}" if home else ""
+        self.directory = directory
+        self.files = {kind:os.path.join(directory,f"{kind}{suffix}.bin") for kind in list(ARCHIVEKINDS) + ['index']}
+        self.index = {kind:{} for kind in ARCHIVEKINDS}             # kind:{day ordinal:(offset,length)}, in day order when read
+        self.maps = {}
+        kinds = {code:kind for kind,(code,dtype) in ARCHIVEKINDS.items()}
+        for record in self.read('index',INDEXRECORD).tolist() :
+            day,code,offset,length = record
+            self.index[kinds[code]][day] = (offset,length)
+
+    def read(self,kind,dtype):
+        try:
+            with open(self.files[kind],'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        return np.frombuffer(data[:len(data) - len(data) % dtype.itemsize],dtype)
+
+    #
+    # Appends records to the file of kind, a partial record left by a crash is cut first. Returns offset in records.
+    #
+    def write(self,kind,records):
+        os.makedirs(self.directory,exist_ok=True)
+        with open(self.files[kind],'ab') as f:
+            size = f.seek(0,os.SEEK_END)
+            if size % records.itemsize : f.truncate(size - size % records.itemsize)
+            offset = f.tell()//records.itemsize
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return offset
+
+    def append(self,kind,day,records):
+        if not len(records) : return False
+        existing = self.records(kind,day,day)
+        if existing.tobytes() == records.tobytes() : return False
+        offset = self.write(kind,records)
+        code,dtype = ARCHIVEKINDS[kind]
+        self.write('index',np.array([(day.toordinal(),code,offset,len(records))],INDEXRECORD))
+        self.index[kind][day.toordinal()] = (offset,len(records))
+        return True
+
+    def appendPrices(self,series):
+        return self.append('prices',series.time(0).date(),series.records()) if series else False
+
+    def appendPlan(self,series,vector):
+        n = min(len(series),len(vector))
+        if n == 0 : return False
+        records = np.empty(n,PLANRECORD)
+        records['epoch'] = series.epoch[:n]
+        records['code'] = vectorCodes([vector],n)[0]
+        return self.append('plans',series.time(0).date(),records)
+
+    def map(self,kind,end):
+        if kind not in self.maps or len(self.maps[kind]) < end :
+            dtype = ARCHIVEKINDS[kind][1]
+            self.maps[kind] = np.memmap(self.files[kind],dtype=dtype,mode='r',shape=(os.path.getsize(self.files[kind])//dtype.itemsize,))
+        return self.maps[kind]
+
+    #
+    # Records of the latest append of each day in first - last (dates, None for no limit). A view of the map if the days
+    # are adjacent in the file, else a copy.
+    #
+    def records(self,kind,first=None,last=None):
+        spans = self.spans(kind,first,last)
+        if not spans : return np.empty(0,ARCHIVEKINDS[kind][1])
+        records = self.map(kind,max(offset + length for day,offset,length in spans))
+        if all(spans[i][1] + spans[i][2] == spans[i+1][1] for i in range(len(spans) - 1)) :
+            return records[spans[0][1]:spans[-1][1] + spans[-1][2]]
+        return np.concatenate([records[offset:offset + length] for day,offset,length in spans])
+
+    def spans(self,kind,first=None,last=None):
+        first = first.toordinal() if first else 0
+        last = last.toordinal() if last else 1 << 30
+        return [(day,) + span for day,span in sorted(self.index[kind].items()) if first <= day <= last]
+
+    def prices(self,first=None,last=None):
+        return priceSeries(self.records('prices',first,last))
+
+    #
+    # Prices of each day in first - last as {date:priceSeries}, each on a slice of the same records
+    #
+    def days(self,first=None,last=None):
+        records = self.records('prices',first,last)
+        days = {}
+        start = 0
+        for day,offset,length in self.spans('prices',first,last) :
+            days[datetime.date.fromordinal(day)] = priceSeries(records[start:start + length])
+            start = start + length
+        return days
+
+    def plan(self,day):
+        return PLANCODES[self.records('plans',day,day)['code']].tolist()
+
+ARCHIVES = {}                       # Open archives by home
+
+def openArchive(home=None):
+    if not ARCHIVE or TEST : return None
+    if home not in ARCHIVES :
+        ARCHIVES[home] = priceArchive(ARCHIVE,home)
+    return ARCHIVES[home]
+
+def archivePrices(series,logger,home=None):
+    archive = openArchive(home)
+    if archive is None : return
+    try:
+        archive.appendPrices(series)
+    except OSError as err:
+        logger.error(f"Failed to write price archive: {err}")
+
+def archivePlan(series,vector,logger,home=None):
+    archive = openArchive(home)
+    if archive is None : return
+    try:
+        archive.appendPlan(series,vector)
+    except OSError as err:
+        logger.error(f"Failed to write plan archive: {err}")
 #
 #
+#  
+# This function builds a charging vector based on today's prices
+# 
+# Prices may come in any resolution (hourly, quarter-hourly, ...). The returned vector has one position per price period, i.e 24 or 96 slots
+# (23/92 or 25/100 when daylight saving time starts or ends).
 #
 
 
 def buildOptimizedChargeCntrlVector(data,logger):
 
+    if len(data) == 0 : return []               # No prices, nothing to plan
     if (TEST) : data = testdata(data)           # Supports swap with testdata in test mode
-    vectorsegment = buildChargeCntrlVector(data,logger)
-    if len(vectorsegment) == 0 : vectorsegment = ['0']*24
+    if PLANNER == 'dp' :
+        with TIMER.stage('build'):
+            vector = buildDPChargeCntrlVector(data,logger)
+        if logger.isEnabledFor(logging.INFO) :
+            with TIMER.stage('score'):
+                logger.info(f"Net value dynamic programming: {netValue(data,vector)}")
+        return vector
+    if PLANNER == 'milp' :
+        with TIMER.stage('build'):
+            vector,heating = buildJointChargeCntrlVector(data,logger)      # Battery only, heating is added by batteryPlan.heatingSchedule
+        if logger.isEnabledFor(logging.INFO) :
+            with TIMER.stage('score'):
+                logger.info(f"Net value milp: {netValue(data,vector)}")
+        return vector
+    hourly = hourlySeries(data)
+    if hourly is not None :
+        return [x for x in buildHeuristicChargeCntrlVector(hourly,logger) for i in range(data.spm)]
+    return buildHeuristicChargeCntrlVector(data,logger)
+
+#
+# Heuristic planner, the best of a single segment plan and a plan of one segment per price hump (see priceSegments).
+# Made for hourly prices, with shorter price periods it finds short cycles around noise. buildOptimizedChargeCntrlVector
+# therefore runs it on hourly mean prices (see hourlySeries), each hour of the vector then holds for all slots of the hour.
+#
+
+def buildHeuristicChargeCntrlVector(data,logger):
+
+    with TIMER.stage('build'):
+        vectorsegment = buildChargeCntrlVector(data,logger)
+    if len(vectorsegment) == 0 : vectorsegment = ['0']*len(data)
     logger.info('')
     logger.info("Singel segment vector result:")
     printvect(vectorsegment,logger)
-    segmentvalue = netValue(data,vectorsegment)
+    with TIMER.stage('score'):
+        segmentvalue = netValue(data,vectorsegment)
     logger.info(f"Net value single segment: {segmentvalue}")
     
 
 
-    segments = priceSegments(data,logger)
-    vector = ['0']*24
+    with TIMER.stage('segment'):
+        segments = priceSegments(data,logger)
+    vector = ['0']*len(data)
     for i,x in enumerate(segments):
         logger.info('')
         logger.info(f"Segment {i} start: {x['start']} end: {x['end']}")
-        xsegment = buildChargeCntrlVector(data[x['start']:x['end']],logger)
-        xvalue = netValue(data,xsegment)
+        with TIMER.stage('build'):
+            xsegment = buildChargeCntrlVector(data[x['start']:x['end']],logger)
+        with TIMER.stage('score'):
+            xvalue = netValue(data,xsegment)
         logger.info(f"Value segment {i} {xvalue}")
         if len(xsegment) != 0 and xvalue > 0:
             for i,y in enumerate(xsegment) : 
@@ -224,7 +1644,8 @@ def buildOptimizedChargeCntrlVector(data,logger):
     logger.info('')
     logger.info("Multiple segment vector result:")
     printvect(vector,logger)
-    msegmentvalue = netValue(data,vector)
+    with TIMER.stage('score'):
+        msegmentvalue = netValue(data,vector)
     logger.info(f"Net value multiple segment: {msegmentvalue}")
     
 
@@ -239,59 +1660,264 @@ def buildOptimizedChargeCntrlVector(data,logger):
     if value > 0 :
         return returnvector
     else :
-        return ['0']*24
-
+        return ['0']*len(data)
 
 #
+# Mean price of each hour of data as a priceSeries of hourly slots. None if data is hourly already, or doesn't start and end at full hours.
 #
-# Following function supports creating a chargevector based on highest and lowest prices.
-# The charging vector is an 24 slot list populated with 'L', 'H' and '0' indicating a charging ('L'), discharging ('H') or idling ('0')
-# 
-# Function can be applied on a segment if data is a subset of a full day data.
-# The returned vector will always cover 24 hours.
-# 
-# The goal is to find CYCLELENGTH highest prices in the segment. Then the price curve  before the first high price will be analyzed to find CYCLELENGTH lowest prices in this interval.
-# By this the function will support analysis of a dromedar curve as well as a curve with multiple peaks. However, with multiple peaks only the hours before the first identified high price hour is considered for charging.
+
+def hourlySeries(data):
+    spm = data.spm
+    if spm == 1 or len(data) % spm or data.first % spm or data.daylength % spm : return None
+    series = data[::spm]
+    for name in ('total','energy','tax') :
+        series.__dict__[name] = data.__dict__[name].reshape(-1,spm).mean(axis=1)
+    series.minutes,series.spm = 60,1
+    series.first,series.daylength = data.first//spm,data.daylength//spm
+    return series
+
+
 #
-# An empty charging vector will be returned if it is not possible to charge before peak
 #
+# Exact planner. Finds the charge control vector with the highest possible netValue by dynamic programming over
+# (slot, state of charge). State of charge is counted in charged slots, 0..CYCLELENGTH*slots per hour, i.e the same bookkeeping as netValue.
+# In each slot the battery can idle ('0'), charge ('L', not allowed in NOCHARGEHOUR or when full) or discharge ('H', not allowed when empty).
+# Charge left in the battery at the end of the day has no value. The backward pass is vectorized over all states of charge,
+# the forward pass follows the best decisions starting from soc (default empty battery).
+# Data is not limited to one day, see buildHorizonChargeCntrlVector.
 #
-def buildChargeCntrlVector(data,logger):
+#
+def buildDPChargeCntrlVector(data,logger,soc=0):
+
+    n = len(data)
+    if n == 0 : return []
+    spm = data.spm
+    cost = (data.total + NETTRANSFERCOST) * (1+INVERTERLOSS)          # Same cost and revenue per slot as in netValue
+    revenue = data.total * (1-INVERTERLOSS) * 0.8
+    chargeable = data.hour != NOCHARGEHOUR                            # Data may start mid-day or span several days
+
+    nstates = CYCLELENGTH*spm + 1
+    value = np.zeros(nstates)                                       # Value of remaining slots for each state of charge
+    decision = np.zeros((n,nstates),dtype=np.int8)                  # 0 idle, 1 charge, 2 discharge
+    candidates = np.empty((3,nstates))
+    for i in range(n-1,-1,-1) :
+        candidates[0] = value
+        candidates[1] = -np.inf
+        candidates[2] = -np.inf
+        if chargeable[i] :
+            candidates[1,:-1] = value[1:] - cost[i]
+        candidates[2,1:] = value[:-1] + revenue[i]
+        decision[i] = np.argmax(candidates,axis=0)                  # Ties resolve to idle
+        value = candidates[decision[i],np.arange(nstates)]
+
+    vector = ['0']*n
+    for i in range(n) :
+        d = decision[i,soc]
+        if d == 1 :
+            vector[i] = 'L'
+            soc = soc + 1
+        elif d == 2 :
+            vector[i] = 'H'
+            soc = soc - 1
 
-    firstSegmentHour=int(data[0]['startsAt'][11:13])
-    result = buildVector(CYCLELENGTH,CYCLELENGTH,data,logger)
-    logger.debug("segmentvector first step:")
-    printvectdebug(result['vector'],logger)
-    if result['high'] == CYCLELENGTH :
-        logger.debug(f"High segment OK, starts at: {result['hindex']}")
-    logger.debug(f"Result high {result['high']} high index {result['hindex']} low {result['low']} low index {result['lindex']}")
-    
-    # Check if we have low segment before high to be able to charge
-    if result['low'] < CYCLELENGTH  and result['hindex'] >= CYCLELENGTH:
-        logger.debug(f"Full length low segment not found before high. Shorten segment and repeat analysis. Start segment at  {0}, end at {result['hindex']}")
-        # Check if we have room for a low segment before high to be able to charge by removing tail of low price hours
-        result_low = buildVector(CYCLELENGTH,0,data[0:result['hindex'] - firstSegmentHour],logger) # Make a new sort of earlier hours to find charging hours before discharge hours     +result['high']
+    logger.info('')
+    logger.info("Dynamic programming vector result:")
+    printvect(vector,logger)
+    return vector
 
-        logger.debug("Lower part")
-        printvectdebug(result_low['vector'],logger)
-        if result_low['low'] < CYCLELENGTH :
-            logger.debug("Not possible to fulfill low segment requirement")
-            logger.debug(f"Low segment short {result_low['low']}, starts at: {result_low['lindex']}")
-            if result_low['low'] <= result['low'] :
-                if result['low'] == 0:
+
+#
+#
+# Rolling horizon planner. Today and tomorrow (if published) are planned as one problem, so charge bought late in the evening can
+# be sold in an expensive morning peak next day. Slots before slot are already executed and kept from vector, the remaining horizon
+# is re-planned from the state of charge these slots give. soc is the state of charge at the start of today (charge carried over
+# from yesterdays plan), current the state of charge at slot if known (measured). Returns a tuple with vectors for today and tomorrow.
+#
+#
+def buildHorizonChargeCntrlVector(today,tomorrow,logger,vector=None,slot=0,soc=0,current=None):
+
+    if len(today) == 0 : return [],[]
+    if not vector : vector = ['0']*len(today)
+    slot = min(slot,len(today))
+    spm = today.spm
+    horizon = today + tomorrow
+    logger.info(f"Rolling horizon planning of {len(horizon)-slot} slots starting at slot {slot}")
+    with TIMER.stage('build'):
+        if current is None : current = stateOfCharge(vector,slot,spm,soc)
+        remaining = buildDPChargeCntrlVector(horizon[slot:],logger,current)
+    plan = vector[:slot] + remaining
+    if logger.isEnabledFor(logging.INFO) :
+        with TIMER.stage('score'):
+            logger.info(f"Net value horizon: {netValue(horizon,plan)}")
+    return plan[:len(today)],plan[len(today):]
+
+#
+#
+# Joint planner (option --planner milp). Battery and heating are planned as one mixed integer linear program over all slots
+# of data, solved by HiGHS through scipy.optimize.milp. Per slot there are binaries for charge (u), discharge (v) and each
+# heating level (x), and the state of charge (s, in charged slots as netValue):
+#   min  sum cost*u - revenue*v + heatcost*x          (netValue, and heating energy at price + NETTRANSFERCOST)
+#   s[i] - s[i-1] - u[i] + v[i] = 0,  0 <= s <= CYCLELENGTH*spm,  u + v <= 1,  u = 0 in NOCHARGEHOUR
+#   sum of x over levels = 1, heating energy >= heating (kWh), at most HEATOFFMAX hours Off in any HEATOFFWINDOW hours
+#   BASELOAD + CHARGINGPOWER*(u - v) + heating power <= GRIDLIMIT (PEAKLIMIT if set)
+# Heating is left out when heating is None. The constraint matrix depends only on the no of slots, chargeable slots and
+# parameters, so it is built once (sparse, vectorized) and reused by later re-plans, only costs and bounds change.
+# scipy has no warm start for milp, reusing the model is what is kept between solves. The JOINTMODELMAX models used last are kept.
+# Returns (vector, heating levels per slot or None). Falls back to the dp planner (no heating) if scipy is not installed.
+#
+#
+
+JOINTMODELS = {}                # Constraint matrices by model key, least recently used first, see jointModel
+JOINTMODELMAX = 4
+
+def jointModel(n,spm,chargeable,heating):
+    from scipy import sparse
+    key = (n,spm,chargeable.tobytes(),heating,CYCLELENGTH,CHARGINGPOWER,tuple(HEATINGPOWER.items()),HEATOFFMAX,HEATOFFWINDOW,BASELOAD,GRIDLIMIT,PEAKLIMIT)
+    if key in JOINTMODELS :
+        JOINTMODELS[key] = JOINTMODELS.pop(key)                     # Now most recently used
+        return JOINTMODELS[key]
+    levels = list(HEATINGPOWER) if heating else []
+    nvars = (3 + len(levels))*n                                     # u, v, s, x per level
+    u,v,s = np.arange(n),np.arange(n,2*n),np.arange(2*n,3*n)
+    x = [np.arange((3+k)*n,(4+k)*n) for k in range(len(levels))]
+    rows,cols,vals,lower,upper = [],[],[],[],[]
+
+    def add(r,c,value,lo,hi):                                       # Constraint rows r (local numbering) of one block
+        base = sum(len(x) for x in lower)
+        rows.append(np.asarray(r) + base)
+        cols.append(np.asarray(c))
+        vals.append(np.broadcast_to(value,np.shape(c)).astype(float))
+        count = int(np.max(r)) + 1
+        lower.append(np.broadcast_to(lo,count).astype(float))
+        upper.append(np.broadcast_to(hi,count).astype(float))
+
+    i = np.arange(n)
+    # State of charge, s[i] - s[i-1] - u[i] + v[i] = 0 (s[-1] is given by the bounds of row 0, see buildJointChargeCntrlVector)
+    add(np.concatenate((i,i[1:],i,i)),np.concatenate((s,s[:-1],u,v)),np.concatenate((np.ones(n),-np.ones(n-1),-np.ones(n),np.ones(n))),0,0)
+    add(np.concatenate((i,i)),np.concatenate((u,v)),1,-np.inf,1)
+    limit = PEAKLIMIT if PEAKLIMIT else GRIDLIMIT
+    if heating :
+        add(np.tile(i,len(levels)),np.concatenate(x),1,1,1)
+        add(np.zeros(n*len(levels),dtype=int),np.concatenate(x),np.repeat([HEATINGPOWER[l]/spm for l in levels],n),0,np.inf)    # Energy, lower bound set per solve
+        w = min(n,HEATOFFWINDOW*spm)                                # Off slots in each rolling window, an Eco slot between does not reset it
+        windows = np.arange(n - w + 1)
+        off = x[levels.index('Off')] if 'Off' in levels else None
+        if off is not None and w > HEATOFFMAX*spm :
+            add(np.repeat(windows,w),(windows[:,None] + np.arange(w)).ravel() + off[0],1,-np.inf,HEATOFFMAX*spm)
+        add(np.tile(i,2 + len(levels)),np.concatenate([u,v] + x),np.concatenate([np.full(n,CHARGINGPOWER),np.full(n,-CHARGINGPOWER)] +
+            [np.full(n,HEATINGPOWER[l]) for l in levels]),-np.inf,limit - BASELOAD)
+    else :
+        add(np.concatenate((i,i)),np.concatenate((u,v)),np.concatenate((np.full(n,CHARGINGPOWER),np.full(n,-CHARGINGPOWER))),-np.inf,limit - BASELOAD)
+    A = sparse.csr_array((np.concatenate(vals),(np.concatenate(rows),np.concatenate(cols))),shape=(len(np.concatenate(lower)),nvars))
+    lb,ub = np.zeros(nvars),np.ones(nvars)
+    ub[u[~chargeable]] = 0
+    ub[s] = CYCLELENGTH*spm
+    integrality = np.ones(nvars)
+    integrality[s] = 0
+    model = dict(A=A,lower=np.concatenate(lower),upper=np.concatenate(upper),lb=lb,ub=ub,integrality=integrality,levels=levels,
+        energyrow=2*n + (n if heating else 0))
+    JOINTMODELS[key] = model
+    while len(JOINTMODELS) > JOINTMODELMAX :
+        del JOINTMODELS[next(iter(JOINTMODELS))]                    # Least recently used
+    return model
+
+def buildJointChargeCntrlVector(data,logger,soc=0,heating=None):
+
+    n = len(data)
+    if n == 0 : return [],None
+    try:
+        from scipy.optimize import milp, LinearConstraint, Bounds
+    except ImportError:
+        logger.error("Python package scipy is needed by the milp planner, dp planner used instead")
+        return buildDPChargeCntrlVector(data,logger,soc),None
+    spm = data.spm
+    model = jointModel(n,spm,data.hour != NOCHARGEHOUR,heating is not None)
+    cost = (data.total + NETTRANSFERCOST) * (1+INVERTERLOSS)
+    revenue = data.total * (1-INVERTERLOSS) * 0.8
+    c = np.concatenate([cost,-revenue,np.zeros(n)] + [(data.total + NETTRANSFERCOST)*HEATINGPOWER[l]/CHARGINGPOWER for l in model['levels']])
+    lower,upper = model['lower'].copy(),model['upper'].copy()
+    lower[0] = upper[0] = soc                                       # s[0] - u[0] + v[0] = soc
+    if heating is not None :
+        lower[model['energyrow']] = min(heating,HEATINGPOWER[max(HEATINGPOWER,key=HEATINGPOWER.get)]*n/spm)
+    start = time.perf_counter()
+    result = milp(c,integrality=model['integrality'],bounds=Bounds(model['lb'],model['ub']),constraints=LinearConstraint(model['A'],lower,upper),
+        options={'time_limit':MILPTIMELIMIT})
+    if result.x is None :
+        logger.error(f"milp planner found no plan ({result.message}), dp planner used instead")
+        return buildDPChargeCntrlVector(data,logger,soc),None
+    solution = np.round(result.x).astype(int)
+    vector = np.where(solution[:n] == 1,'L',np.where(solution[n:2*n] == 1,'H','0')).tolist()
+    levels = None
+    if heating is not None :
+        choice = np.argmax(solution[3*n:].reshape(len(model['levels']),n),axis=0)
+        levels = [model['levels'][k] for k in choice]
+    logger.info('')
+    logger.info(f"Milp vector result ({(time.perf_counter() - start)*1000:.0f} ms, {result.message}):")
+    printvect(vector,logger)
+    return vector,levels
+
+#
+# Returns state of charge (in charged slots, as netValue) after the first slots of vector, starting from soc.
+#
+
+def stateOfCharge(vector,slot,spm=1,soc=0):
+    for x in vector[:slot] :
+        if x == 'L' and soc < CYCLELENGTH*spm : soc = soc + 1
+        elif x == 'H' and soc > 0 : soc = soc - 1
+    return soc
+
+
+#
+#
+# Following function supports creating a chargevector based on highest and lowest prices.
+# The charging vector is a list with one slot per price period (24*spm slots, spm = slots per hour) populated with 'L', 'H' and '0' indicating a charging ('L'), discharging ('H') or idling ('0')
+# 
+# Function can be applied on a segment if data is a subset of a full day data.
+# The returned vector will always cover the full day.
+# 
+# The goal is to find CYCLELENGTH hours of highest prices in the segment. Then the price curve  before the first high price will be analyzed to find CYCLELENGTH lowest prices in this interval.
+# By this the function will support analysis of a dromedar curve as well as a curve with multiple peaks. However, with multiple peaks only the hours before the first identified high price hour is considered for charging.
+#
+# An empty charging vector will be returned if it is not possible to charge before peak
+#
+#
+def buildChargeCntrlVector(data,logger):
+
+    cycle = CYCLELENGTH*data.spm
+    firstSegmentSlot=data.first
+    result = buildVector(cycle,cycle,data,logger)
+    logger.debug("segmentvector first step:")
+    printvectdebug(result['vector'],logger)
+    if result['high'] == cycle :
+        logger.debug("High segment OK, starts at: %s",result['hindex'])
+    logger.debug("Result high %s high index %s low %s low index %s",result['high'],result['hindex'],result['low'],result['lindex'])
+    
+    # Check if we have low segment before high to be able to charge
+    if result['low'] < cycle  and result['hindex'] >= cycle:
+        logger.debug("Full length low segment not found before high. Shorten segment and repeat analysis. Start segment at  %s, end at %s",0,result['hindex'])
+        # Check if we have room for a low segment before high to be able to charge by removing tail of low price hours
+        result_low = buildVector(cycle,0,data[0:result['hindex'] - firstSegmentSlot],logger) # Make a new sort of earlier hours to find charging hours before discharge hours     +result['high']
+
+        logger.debug("Lower part")
+        printvectdebug(result_low['vector'],logger)
+        if result_low['low'] < cycle :
+            logger.debug("Not possible to fulfill low segment requirement")
+            logger.debug("Low segment short %s, starts at: %s",result_low['low'],result_low['lindex'])
+            if result_low['low'] <= result['low'] :
+                if result['low'] == 0:
                     return []                               # This can't happen or?
                 else :
                     return result['vector']                 # Low segment analysis not better than first attempt - return first attempt
             
-        logger.debug(f"Low segment found, starts at {result_low['lindex']}")   # Continue and merge first attempt with low segment. 
-        for i in range(24) :
+        logger.debug("Low segment found, starts at %s",result_low['lindex'])   # Continue and merge first attempt with low segment. 
+        for i in range(len(result['vector'])) :
             if result_low['vector'][i] == 'L' : result['vector'][i] = result_low['vector'][i]
             if i >=result['hindex']+result['high'] :          #Clear all low hours after discharging hours
                 #print (f"Clear tail hour {i}")
                 result['vector'][i] = '0'
         return result['vector']
-    elif result['hindex'] >= CYCLELENGTH :
-        logger.debug(f"Low segment OK, starts at: {result['lindex']}")
+    elif result['hindex'] >= cycle :
+        logger.debug("Low segment OK, starts at: %s",result['lindex'])
         return result['vector']
     else :
         logger.debug("Not possible to fit a low segment before high. Return empty vector")
@@ -301,41 +1927,43 @@ def buildChargeCntrlVector(data,logger):
 #
 #
 # Builds a basic charging vector with the nrlow lowest prices marked with 'L' and nrhigh highest prices marked with 'H'
-# Low prices must be found prior to any high price hour. All other hours will be marked with '0'
+# Low prices must be found prior to any high price slot. All other slots will be marked with '0'
 # 
 # Returns the following data structure
 # {
-# high : n          n equals no of high price hours found
+# high : n          n equals no of high price slots found
 # hindex : no       no index of first in high segment
-# low : n           n equals no of low price hours found prior to any high
+# low : n           n equals no of low price slots found prior to any high
 # lindex : no       no index of first in low segment
-# vector: ['L'/'H'/'0']*24
+# vector: ['L'/'H'/'0']*24*spm
 # }
 #
 #
 def buildVector(nrlow,nrhigh,data,logger):
-    result = {'high':0,'low':0,'hindex':0,'lindex':0,'vector':['0']*24}
-    logger.debug (f"Length of data to be analyzed {len(data)}")
-    printdata(data,logger)
-
-    sorted_data = sorted(data, key=lambda d: d['total'])
-    logger.debug("Sorted data: ")
-    printdata(sorted_data,logger)
-    logger.debug(f"nlow {nrlow} nhigh {nrhigh}")
+    nslots = data.daylength
+    result = {'high':0,'low':0,'hindex':0,'lindex':0,'vector':['0']*nslots}
+    debug = logger.isEnabledFor(logging.DEBUG)            # Don't format debug output that won't be logged
+    if debug :
+        logger.debug (f"Length of data to be analyzed {len(data)}")
+        printdata(data,logger)
+
+    order = np.argsort(data.total,kind='stable').tolist()
+    if debug :
+        logger.debug("Sorted data: ")
+        printdata(data,logger,order)
+        logger.debug(f"nlow {nrlow} nhigh {nrhigh}")
 
     for x in range(min(nrlow,len(data))):
-        logger.debug(f"{int(sorted_data[x]['startsAt'][11:13])}:L")
-        hour = int(sorted_data[x]['startsAt'][11:13])
-        result['vector'][hour]='L'
-    logger.debug('')
+        slot = data.first + order[x]
+        if debug : logger.debug(f"{slot}:L")
+        result['vector'][slot]='L'
     for x in range(min(nrhigh,len(data))):
-        logger.debug(f"{int(sorted_data[len(data)-1-x]['startsAt'][11:13])}:H")
-        hour = int(sorted_data[len(data)-1-x]['startsAt'][11:13])
-        result['vector'][hour]='H' 
-    logger.debug('')
+        slot = data.first + order[len(data)-1-x]
+        if debug : logger.debug(f"{slot}:H")
+        result['vector'][slot]='H' 
     nl = 0
     nh = 0
-    for i in range(24) :
+    for i in range(nslots) :
         if  result['vector'][i] == 'L' : 
             nl = nl + 1
             if nl == 1 :  result['lindex'] = i
@@ -343,7 +1971,7 @@ def buildVector(nrlow,nrhigh,data,logger):
             result['hindex'] = i
             break
         
-    for i in range(result['hindex'],24): 
+    for i in range(result['hindex'],nslots): 
         if  result['vector'][i] == 'H' : nh = nh + 1
     
     result['high'] = nh
@@ -360,14 +1988,13 @@ def buildVector(nrlow,nrhigh,data,logger):
 def priceSegments(data,logger) :
 
 
-    prices = []
-    for x in data : prices.append(x['total'])
+    prices = data.total
     
     #
     # Find all high cost peaks used for discharging
     #
     peaksAndValleys = []
-    peaks,_ = find_peaks(prices)
+    peaks,_ = findPeaks(prices)
     for i in range(len(peaks)):
         d = {'extreme':peaks[i],'type':'H','start':0,'end':0,'value':0,'hours':0}
         peaksAndValleys.append(d)
@@ -375,11 +2002,9 @@ def priceSegments(data,logger) :
     #
     # Find all low cost valleys to be used for charging. 
     #
-    inv_prices=[]
-    for x in prices:
-        inv_prices.append(-x)
+    inv_prices = -prices
 
-    valleys,_ = find_peaks(inv_prices)
+    valleys,_ = findPeaks(inv_prices)
     for i in range(len(valleys)):
         d = {'extreme':valleys[i],'type':'L','start':0,'end':0,'value':0,'hours':0}
         peaksAndValleys.append(d)
@@ -390,6 +2015,8 @@ def priceSegments(data,logger) :
     # print("length peaksandvalleys " + str(len(peaksAndValleys)))
 
     peaksAndValleysSorted=sorted(peaksAndValleys, key=lambda d: d['extreme']) 
+    if len(peaksAndValleysSorted) == 0 :                # Monotonic prices, one segment
+        return [{'start':0,'end':len(prices)}]
 
     # Patch head and tail if needed (must start low and end high) by adding a virtual valley/peak.
 
@@ -413,77 +2040,145 @@ def priceSegments(data,logger) :
         if i + 2 < len(peaksAndValleysSorted) :
             end = peaksAndValleysSorted[i+2]['extreme']
         else :
-            end = 24
+            end = len(prices)
         segments.append({'start':start,'end':end})
         #print (f"Segment {nseg} start: {segments[nseg]['start']} end: {segments[nseg]['end']}")
         nseg=nseg+1
     return segments
 
     
+#
+# Finds local maxima in x, the same result as scipy.signal.find_peaks(x,plateau_size=1) without the scipy import.
+#
+# x is split in runs of equal values. A run with lower values on both sides is a peak (runs at the ends never are).
+# A peak spanning several slots (plateau) is reported at its middle slot, rounded down. Returns indexes of peaks and a
+# dict with left_edges, right_edges and plateau_sizes of each peak.
+#
+
+def findPeaks(x):
+    x = np.asarray(x,dtype=float)
+    if len(x) < 3 :
+        empty = np.array([],dtype=np.intp)
+        return empty,{'left_edges':empty,'right_edges':empty,'plateau_sizes':empty}
+    starts = np.concatenate(([0],np.flatnonzero(np.diff(x)) + 1))
+    ends = np.concatenate((starts[1:] - 1,[len(x) - 1]))
+    values = x[starts]
+    peak = np.zeros(len(starts),dtype=bool)
+    peak[1:-1] = (values[:-2] < values[1:-1]) & (values[2:] < values[1:-1])
+    left = starts[peak]
+    right = ends[peak]
+    if TEST : checkPeaks(x,(left + right)//2,left)
+    return (left + right)//2,{'left_edges':left,'right_edges':right,'plateau_sizes':right - left + 1}
+
+#
+# In test mode, findPeaks is verified against scipy.signal.find_peaks if scipy is installed
+#
+
+def checkPeaks(x,peaks,left):
+    try:
+        from scipy.signal import find_peaks
+    except ImportError:
+        return True
+    reference,properties = find_peaks(x,plateau_size=1)
+    if np.array_equal(peaks,reference) and np.array_equal(left,properties['left_edges']) :
+        return True
+    logging.getLogger(__name__).warning(f"findPeaks {peaks} differs from scipy find_peaks {reference} on {x}")
+    return False
+
 #
 # This function calculates net value for the specific charging vector and prices
+# Each slot charges or discharges CHARGINGPOWER during the slot length, i.e 1/spm hours.
 #
 
 def netValue(data,vector) :
 
     if len(vector) == 0 : return 0
 
-    tempvector=vector.copy()
-    if len(tempvector) != 0 and tempvector[NOCHARGEHOUR] == 'L' : tempvector[NOCHARGEHOUR] = '0'
+    spm = data.spm
+    tempvector=blockNoChargeHour(vector.copy(),data)
+    prices = data.total.tolist()
 
     value = 0
     nolow = 0
     nohigh = 0
-    for i in range(24) :
-        if tempvector[i] == 'L' and nolow < CYCLELENGTH:                            # Charging: Sum up a max CYCLELENGTH charging ours
+    for i in range(min(len(data),len(tempvector))) :
+        if tempvector[i] == 'L' and nolow < CYCLELENGTH*spm:                        # Charging: Sum up a max CYCLELENGTH charging hours
             nolow = nolow + 1
-            value = value - (data[i]['total'] + NETTRANSFERCOST) * (1+INVERTERLOSS)
+            value = value - (prices[i] + NETTRANSFERCOST) * (1+INVERTERLOSS)
             #print(f"Hour {i}, {tempvector[i]}, noLow {nolow}")
         if tempvector[i] == 'H' and nolow > 0:                                      # Discharging: Sum up max #charging hours 
             nolow = nolow - 1
-            value = value + data[i]['total'] * (1-INVERTERLOSS)*0.8                 # VAT included in cost (charging hours), but not when you sell.
+            value = value + prices[i] * (1-INVERTERLOSS)*0.8                        # VAT included in cost (charging hours), but not when you sell.
             #print(f"Hour {i}, {tempvector[i]}, noLow {nolow}")
     
-    return value*CHARGINGPOWER
+    return value*CHARGINGPOWER/spm
+
+#
+# Clears all charging slots within NOCHARGEHOUR (local time of the prices in data). Vector is modified in place and returned.
+#
+
+def blockNoChargeHour(vector,data):
+    for i in np.flatnonzero(data.hour == NOCHARGEHOUR) :
+        if i < len(vector) and vector[i] == 'L' : vector[i] = '0'
+    return vector
+
+#
+# Slot of data that now is in. Slot on the wall clock if now is outside data (no prices, or prices of yesterday just after midnight).
+#
+
+def currentSlot(data,now):
+    slot = data.slotAt(now)
+    if slot is None :
+        return (now.hour*60 + now.minute)//data.minutes
+    return slot
 
 
 
 
 def averagePrice(data) :
-    sum= 0
-    for x in data :
-        sum = sum + x['total']
-    return sum/24
+    if len(data) == 0 : return 0
+    return float(data.total.mean())
 
-def printdata(data,logger):
-    for x in data:
-        logger.debug(f"{x['startsAt'][11:13]}:{x['total']}")
+def printdata(data,logger,order=None):
+    if not logger.isEnabledFor(logging.DEBUG) : return
+    for i in (range(len(data)) if order is None else order) :
+        logger.debug(f"{data.label(i)}:{data.total[i]}")
 
+#
+# Formats a vector as a header line with hours and a line with the slots. Sub-hour slots are grouped per hour.
+#
+
+def vectlines(vect):
+    spm = max(1,round(len(vect)/24))
+    if spm == 1 :
+        header = "0 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21 22 23"
+        line = ''
+        for i,x in enumerate(vect):
+            if i < 9:
+                sp =' '
+            else:
+                sp = '  '
+            line = line  + x + sp
+    else :
+        header = ''
+        line = ''
+        for h in range(math.ceil(len(vect)/spm)) :
+            header = header + f"{h:<{spm+1}}"
+            line = line + ''.join(vect[h*spm:(h+1)*spm]) + ' '
+    return header,line
 
 def printvectdebug(vect,logger):
-    logger.debug("0 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21 22 23")
-    line = ''
-    for i,x in enumerate(vect):
-        if i < 9:
-            sp =' '
-        else:
-            sp = '  '
-        line = line  + x + sp
-        #logger.debug(sp+x,end=' ')
+    if not logger.isEnabledFor(logging.DEBUG) : return
+    header,line = vectlines(vect)
+    logger.debug(header)
     logger.debug(line)
     logger.debug('')
 
 
 def printvect(vect,logger):
-    logger.info("0 1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17 18 19 20 21 22 23")
-    line = ''
-    for i,x in enumerate(vect):
-        if i <9:
-            sp =' '
-        else:
-            sp = '  '
-        line = line  + x + sp
-        #logger.info(sp+x,end=' ')
+    if not logger.isEnabledFor(logging.INFO) : return
+    header,line = vectlines(vect)
+    logger.info(header)
     logger.info(line)
     logger.info('')
 
@@ -491,9 +2186,7 @@ def testdata(data) :
 
     #Use input data as default
 
-    testdata = [0]*len(data)        
-    for i,x in enumerate(data) :
-         testdata[i] = x['total']
+    testdata = data.total.tolist()
 
 
     #testdata = [0.3055, 0.2994, 0.2921, 0.2902, 0.296, 0.3117, 0.382, 1.7493, 2.2345, 2.2333, 2.2337, 2.234, 1.9699, 1.75, 1.7498, 1.6685, 1.75, 2.1652, 2.7454, 2.51, 0.9099, 0.6484, 0.5767, 0.5056]
@@ -509,11 +2202,342 @@ def testdata(data) :
     testdata = [0.455, 0.394, 0.2921, 0.2902, 0.3, 0.3117, 1.8, 2.0, 1.8, 1.0, 0.2, 1.5, 1.6, 1.75, 2.1, 2.05, 2, 1.9, 1.0, 0.8, 0.3, 0.2, 0.2, 0.2]
 
 
-    for i,x in enumerate(testdata) :
-        data[i]['total'] = x
+    data = data.view()
+    data.total = np.array([testdata[i*len(testdata)//len(data)] for i in range(len(data))])    # Stretch hourly testdata to all slots of the hour
     return data
 
 
+#####################################################################################
+#
+# Backtest of the planners over archived daily price files
+#
+# Each file holds the prices of one day as a list, the same format as the price cache, or the directory is
+# a priceArchive (option --archive) and the days are read from its memory map. Every planner
+# in STRATEGIES plans every day, then all plans are scored at once by netValueBatch. Revenue and
+# planner wall time per day are reported per planner.
+#
+#####################################################################################
+
+STRATEGIES = ['heuristic','dp']
+
+#
+# A day is read once per home, the price cache may hold it at both resolutions (the finer one is used) and once per home
+# in fleet mode (home from the file name, see priceFile). Days are returned in date order.
+#
+
+def loadArchive(directory,logger):
+    if os.path.exists(priceArchive(directory).files['index']) :
+        return list(priceArchive(directory).days().values())
+    days = {}
+    for name in sorted(os.listdir(directory)) :
+        if not name.endswith('.json') : continue
+        try:
+            with open(os.path.join(directory,name)) as f:
+                data = json.load(f)
+        except (OSError,ValueError) as err:
+            logger.warning(f"Skipping {name}: {err}")
+            continue
+        if isinstance(data,list) and data :
+            series = priceSeries(data)
+            key = (series.time(0).date(),priceFileHome(name))
+            if key in days and days[key].minutes <= series.minutes : continue
+            days[key] = series
+    return [days[key] for key in sorted(days,key=lambda x: (x[0],x[1] or ''))]
+
+def priceFileHome(name):
+    for resolution in ('QUARTER_HOURLY','HOURLY') :
+        day,found,home = name[:-len('.json')].partition('_' + resolution)
+        if found : return home[1:] or None
+    return None
+
+#
+# Netvalue of many days at once. prices is an (days,slots) array, codes an array of the same shape with 1 for 'L', -1 for 'H' and 0 for '0'.
+# All days must have the same no of slots per hour, spm. Same bookkeeping as netValue, but vectorized over days.
+# chargeable is an array of the same shape, False in NOCHARGEHOUR (default slot i is in hour i//spm).
+# Any no of leading dimensions works the same way, e.g. (vectors,scenarios,slots) of broadcast arrays, see buildForecastChargeCntrlVector.
+#
+
+def netValueBatch(prices,codes,spm=1,chargeable=None):
+    *ndays,nslots = prices.shape
+    if chargeable is None :
+        chargeable = np.broadcast_to(np.arange(nslots)//spm != NOCHARGEHOUR,prices.shape)
+    soc = np.zeros(ndays,dtype=int)
+    value = np.zeros(ndays)
+    for i in range(nslots) :
+        charge = (codes[...,i] == 1) & (soc < CYCLELENGTH*spm) & chargeable[...,i]
+        value = value - charge * (prices[...,i] + NETTRANSFERCOST) * (1+INVERTERLOSS)
+        soc = soc + charge
+        discharge = (codes[...,i] == -1) & (soc > 0)
+        value = value + discharge * prices[...,i] * (1-INVERTERLOSS)*0.8
+        soc = soc - discharge
+    return value*CHARGINGPOWER/spm
+
+#
+# Converts price series and vectors to arrays for netValueBatch. Shorter days are padded with idle slots.
+# priceArray returns prices and chargeable slots.
+#
+
+def priceArray(days,nslots):
+    prices = np.zeros((len(days),nslots))
+    chargeable = np.ones((len(days),nslots),dtype=bool)
+    for i,data in enumerate(days) :
+        prices[i,:len(data)] = data.total[:nslots]
+        chargeable[i,:len(data)] = data.hour[:nslots] != NOCHARGEHOUR
+    return prices,chargeable
+
+#
+# Revenue of each vector (blocked for NOCHARGEHOUR) on the prices of its day, days grouped by resolution and scored by netValueBatch
+#
+
+def scoreVectors(days,vectors):
+    resolutions = {}                                    # Day indexes grouped by slots per hour
+    for i,data in enumerate(days) :
+        resolutions.setdefault(data.spm,[]).append(i)
+    values = np.zeros(len(days))
+    for spm,index in resolutions.items() :
+        nslots = max(max(len(days[i]) for i in index),max(len(vectors[i]) for i in index))
+        prices,chargeable = priceArray([days[i] for i in index],nslots)
+        values[index] = netValueBatch(prices,vectorCodes([vectors[i] for i in index],nslots),spm,chargeable)
+    return values
+
+def vectorCodes(vectors,nslots):
+    codes = np.zeros((len(vectors),nslots),dtype=np.int8)
+    for i,vector in enumerate(vectors) :
+        v = np.array(vector[:nslots])
+        codes[i,:len(v)] = (v == 'L').astype(np.int8) - (v == 'H').astype(np.int8)
+    return codes
+
+def backtest(directory,logger):
+    global PLANNER
+
+    days = loadArchive(directory,logger)
+    if not days :
+        print(f"No price files found in {directory}")
+        return
+
+    planner = PLANNER
+    report = []
+    scoretime = 0
+    for strategy in STRATEGIES :
+        PLANNER = strategy
+        vectors = []
+        times = np.zeros(len(days))
+        for i,data in enumerate(days) :
+            start = time.perf_counter()
+            vector = buildOptimizedChargeCntrlVector(data,logger)
+            times[i] = time.perf_counter() - start
+            vectors.append(blockNoChargeHour(vector,data))
+        start = time.perf_counter()
+        values = scoreVectors(days,vectors)
+        scoretime = scoretime + time.perf_counter() - start
+        report.append((strategy,values,times))
+        logger.info(f"Backtest {strategy}: revenue {values.sum()}")
+    PLANNER = planner
+
+    print(f"Backtest of {len(days)} days in {directory}")
+    print(f"{'Planner':<12}{'Revenue':>12}{'Per day':>10}{'Best days':>11}{'ms/day':>10}{'max ms':>10}{'days/s':>10}")
+    best = np.max([values for strategy,values,times in report],axis=0)
+    for strategy,values,times in report :
+        print(f"{strategy:<12}{values.sum():>12.2f}{values.mean():>10.3f}{int(np.sum(values >= best - 1e-9)):>11}"
+            f"{times.mean()*1000:>10.2f}{times.max()*1000:>10.2f}{len(days)/times.sum():>10.0f}")
+    print(f"Scoring {len(days)*len(STRATEGIES)} plans batched: {scoretime*1000:.1f} ms ({len(days)*len(STRATEGIES)/scoretime:.0f} days/s)")
+
+#####################################################################################
+#
+# Tuning of planner parameters over archived daily price files
+#
+# Every parameter set in TUNEGRID (all combinations, or TUNESAMPLES random ones) plans every day of the archive
+# with PLANNER. NOCHARGEHOUR is how the battery is run, it applies to planning and revenue alike. CYCLELENGTH,
+# NETTRANSFERCOST, INVERTERLOSS and CHARGINGPOWER are what the planner assumes, revenue is always counted with
+# the configured values, so all parameter sets are compared on the same battery. Parameter sets run in parallel in a process pool. Revenue per (day, parameter set) is kept
+# in TUNECACHE, so a new day in the archive or an extended grid only plans what is new.
+#
+#####################################################################################
+
+TUNEGRID = {
+    'CYCLELENGTH':[2,3,4],
+    'NOCHARGEHOUR':[7,8,9],
+    'NETTRANSFERCOST':[0.6,0.7,0.8],
+    'INVERTERLOSS':[0.03,0.05,0.08],
+    'CHARGINGPOWER':[2.5],                  # Only scales the value of a plan, the planners give the same vectors for any power
+}
+SCORED = ('CYCLELENGTH','NETTRANSFERCOST','INVERTERLOSS','CHARGINGPOWER')   # Revenue is counted with configured values of these
+
+TUNEDAYS = []                   # Archive, set in each pool worker by tuneInit
+
+def tuneInit(days):
+    global TUNEDAYS
+    TUNEDAYS = days
+
+#
+# Plans days given by index with params and returns their revenue. Runs in a pool worker.
+#
+
+def tuneRun(params,index,logger):
+    configured = {name:globals()[name] for name in params}
+    try:
+        globals().update(params)
+        vectors = [blockNoChargeHour(buildOptimizedChargeCntrlVector(TUNEDAYS[i],logger),TUNEDAYS[i]) for i in index]
+        globals().update({name:configured[name] for name in SCORED if name in params})
+        return scoreVectors([TUNEDAYS[i] for i in index],vectors).tolist()
+    finally:
+        globals().update(configured)
+
+def loadTuneCache():
+    try:
+        with open(TUNECACHE) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def saveTuneCache(cache,logger):
+    try:
+        with open(TUNECACHE + ".tmp",'w') as f:
+            json.dump(cache,f)
+        os.replace(TUNECACHE + ".tmp",TUNECACHE)
+    except OSError as err:
+        logger.error(f"Failed to write tuning cache: {err}")
+
+def tune(directory,logger):
+
+    days = loadArchive(directory,logger)
+    if not days :
+        print(f"No price files found in {directory}")
+        return
+    names = list(TUNEGRID)
+    grid = [dict(zip(names,values)) for values in itertools.product(*TUNEGRID.values())]
+    if TUNESAMPLES and TUNESAMPLES < len(grid) :
+        grid = random.Random(0).sample(grid,TUNESAMPLES)
+    configured = {name:globals()[name] for name in names}
+    if configured not in grid : grid.append(configured)
+
+    # Results are cached per planner, configured scoring values and parameter set, then per day
+
+    cache = loadTuneCache()
+    setup = json.dumps([PLANNER] + [globals()[name] for name in SCORED])
+    keys = [setup + json.dumps(params,sort_keys=True) for params in grid]
+    digests = [data.digest() for data in days]
+    workers = os.cpu_count() or 1
+    planned = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,mp_context=multiprocessing.get_context('fork'),
+            initializer=tuneInit,initargs=(days,)) as pool :
+        futures = {}
+        for params,key in zip(grid,keys) :
+            results = cache.setdefault(key,{})
+            index = [i for i,digest in enumerate(digests) if digest not in results]
+            if index :
+                futures[pool.submit(tuneRun,params,index,logger)] = (key,index)
+                planned = planned + len(index)
+        for future in concurrent.futures.as_completed(futures) :
+            key,index = futures[future]
+            for i,value in zip(index,future.result()) :
+                cache[key][digests[i]] = value
+    elapsed = time.perf_counter() - start
+    if futures : saveTuneCache(cache,logger)
+
+    revenue = np.array([sum(cache[key][digest] for digest in digests) for key in keys])
+    order = np.argsort(-revenue,kind='stable')
+    print(f"Tuning of {PLANNER} planner on {len(days)} days in {directory}, {len(grid)} parameter sets")
+    print(f"Planned {planned} days in {elapsed:.1f} s on {workers} processes, {len(grid)*len(days) - planned} from cache")
+    header = ''.join(f"{name:>17}" for name in names)
+    print(f"{'':<12}{header}{'Revenue':>12}")
+    print(f"{'Configured':<12}{''.join(f'{configured[name]:>17}' for name in names)}{revenue[grid.index(configured)]:>12.2f}")
+    for rank,i in enumerate(order[:10]) :
+        print(f"{'Best' if rank == 0 else rank+1:<12}{''.join(f'{grid[i][name]:>17}' for name in names)}{revenue[i]:>12.2f}")
+    print("Revenue surface per parameter, best and mean revenue of parameter sets with the value:")
+    for name in names :
+        values = [params[name] for params in grid]
+        line = ''
+        for value in TUNEGRID[name] :
+            selected = revenue[[i for i,x in enumerate(values) if x == value]]
+            if len(selected) : line = line + f"{value:>8}: {selected.max():.2f}/{selected.mean():.2f}"
+        print(f"{name:<17}{line}")
+
+#####################################################################################
+#
+# Forecast planning, for days Tibber has not published prices for yet (option --forecast)
+#
+# Price scenarios are made from the last FORECASTDAYS days in the price cache: the price profile of a cached day
+# (prices minus the day mean) on top of the mean of the latest day, moved by a day to day change of the mean seen
+# in the cache. Days are drawn by weight, recent days and days of the same kind (weekday or weekend) as the forecast
+# day weigh more. Candidate vectors are planned by the dp planner on the profile of each cached day and on the mean
+# scenario, then all candidates are scored on all scenarios at once by netValueBatch. The candidate with the highest
+# expected net value is used (idle if none is expected to pay).
+#
+#####################################################################################
+
+#
+# Price series with the price periods of day (local time), prices 0
+#
+
+def forecastSeries(day):
+    minutes = 15 if RESOLUTION == 'QUARTER_HOURLY' else 60
+    start = datetime.datetime.combine(day,datetime.time()).astimezone()
+    end = datetime.datetime.combine(day + datetime.timedelta(days=1),datetime.time()).astimezone()
+    n = int((end - start).total_seconds())//(minutes*60)
+    times = [(start + datetime.timedelta(minutes=i*minutes)).astimezone() for i in range(n)]
+    return priceSeries([{'total':0,'energy':0,'tax':0,'startsAt':t.isoformat()} for t in times])
+
+#
+# Returns (template,scenarios,profiles), template a forecastSeries of day, scenarios a (SCENARIOS,slots) array of prices and
+# profiles the price profile of each cached day on the latest mean price. Scenarios None if there is less than a week of cached
+# days with the same no of slots.
+#
+
+def forecastScenarios(day,logger,nscenarios=SCENARIOS):
+    template = forecastSeries(day)
+    weekend = day.weekday() >= 5
+    profiles,means,weights = [],[],[]
+    archive = openArchive()
+    history = archive.days(day - datetime.timedelta(days=FORECASTDAYS),day - datetime.timedelta(days=1)) if archive else {}
+    for age in range(1,FORECASTDAYS + 1) :                      # Latest first
+        date = day - datetime.timedelta(days=age)
+        data = history[date] if date in history else priceSeries(loadPrices(date))
+        if len(data) != len(template) : continue                # Missing, other resolution or a daylight saving time day
+        means.append(data.total.mean())
+        profiles.append(data.total - means[-1])
+        weights.append(FORECASTDECAY**age * (3 if (date.weekday() >= 5) == weekend else 1))
+    if len(profiles) < 7 :
+        logger.info(f"Only {len(profiles)} days in price cache like {day}, no forecast")
+        return template,None,None
+    rng = np.random.default_rng(day.toordinal())                # Same scenarios for a day in each run
+    weights = np.array(weights)/sum(weights)
+    changes = -np.diff(means)                                   # Day to day change of mean price
+    levels = means[0] + rng.choice(changes,nscenarios)
+    scenarios = levels[:,None] + np.array(profiles)[rng.choice(len(profiles),nscenarios,p=weights)]
+    return template,scenarios,means[0] + np.array(profiles)
+
+#
+# Returns (vector,expected net value) for day, ([],0) if no forecast could be made
+#
+
+def buildForecastChargeCntrlVector(day,logger):
+    start = time.perf_counter()
+    template,scenarios,profiles = forecastScenarios(day,logger)
+    if scenarios is None : return [],0
+    quiet = logging.getLogger(logger.name + ".forecast")        # Candidates are not logged
+    quiet.setLevel(logging.WARNING)
+    candidates = {tuple(['0']*len(template))}
+    for prices in list(profiles) + [scenarios.mean(axis=0)] :
+        series = template.view()
+        series.total = prices
+        candidates.add(tuple(buildDPChargeCntrlVector(series,quiet)))
+    candidates = sorted(candidates)
+    codes = vectorCodes(candidates,len(template))
+    chargeable = np.broadcast_to(template.hour != NOCHARGEHOUR,(len(candidates),) + scenarios.shape)
+    values = netValueBatch(np.broadcast_to(scenarios,chargeable.shape),np.broadcast_to(codes[:,None,:],chargeable.shape),
+        template.spm,chargeable)
+    expected = values.mean(axis=1)
+    best = int(np.argmax(expected))
+    vector = list(candidates[best])
+    logger.info(f"Forecast for {day}: {len(candidates)} candidates scored on {len(scenarios)} price scenarios in "
+        f"{(time.perf_counter() - start)*1000:.0f} ms. Expected net value {expected[best]:.2f}, "
+        f"positive in {(values[best] > 0).mean()*100:.0f}% of scenarios")
+    printvect(vector,logger)
+    return vector,expected[best]
+
+
 def empty(vector):
     if 'L' in vector or 'H' in vector : 
         return False
@@ -526,136 +2550,1139 @@ def empty(vector):
         
 
 
+#####################################################################################
+#
+# Plan state shared by the control loops
+#
+# Holds prices and charge control vectors for today and tomorrow and decides battery mode and
+# heating level per slot. No I/O towards Home Assistant or Tibber is made here, that is up to
+# the control loop (main, or amain with --asyncio). The control loop calls save() when it has acted,
+# the plan is then written to the checkpoint file if it has changed, and resume() picks it up at restart.
+#
+#####################################################################################
+
+class batteryPlan:
+
+    def __init__(self,logger):
+        self.logger = logger
+        self.priceinfo = {'today':priceSeries(),'tomorrow':priceSeries()}
+        self.vector = []
+        self.vector_tomorrow = []
+        self.daystartsoc = 0                # Planned state of charge at start of today (rolling horizon)
+        self.socanchor = (0,0)              # Slot and state of charge the planned trajectory of today starts from
+        self.heating = []                   # Heating level per slot of today, see heatingSchedule
+        self.heatingkey = None              # Prices and settings the heating schedule was computed for
+        self.todaysAveragePrice = 0
+        self.tomorrowsAveragePrice = 0
+        self.checkpointed = None            # Key of the plan last written to the checkpoint file and archive
+        self.forecast = None                # 'today' or 'tomorrow' if that vector is planned on forecast prices, see planForecast
+
+    def attributes(self):
+        return dict(Today=self.vector, Tomorrow=self.vector_tomorrow)
+
+    def heatingAttributes(self):
+        return dict(Schedule=self.heating)
+
+    #
+    # Writes the plan to the checkpoint file if it has changed since last time. Prices are included (Tibber format),
+    # so the plan can be resumed without price cache or Tibber. Returns True if written.
+    #
+    def checkpointKey(self):
+        return (self.priceinfo['today'].digest(),self.priceinfo['tomorrow'].digest(),tuple(self.vector),tuple(self.vector_tomorrow),
+            self.daystartsoc,self.socanchor,self.forecast)
+
+    def save(self):
+        if TEST : return False
+        today,tomorrow = self.priceinfo['today'],self.priceinfo['tomorrow']
+        key = self.checkpointKey()
+        if key == self.checkpointed : return False
+        with TIMER.stage('archive'):
+            archivePlan(today,self.vector,self.logger)
+            archivePlan(tomorrow,self.vector_tomorrow,self.logger)
+        if not CHECKPOINT :
+            self.checkpointed = key
+            return True
+        state = dict(saved=CLOCK.now().astimezone().isoformat(timespec='seconds'),settings=planSettings(),
+            today=today.data(),tomorrow=tomorrow.data(),vector=self.vector,vector_tomorrow=self.vector_tomorrow,
+            todaysAveragePrice=self.todaysAveragePrice,tomorrowsAveragePrice=self.tomorrowsAveragePrice,
+            daystartsoc=self.daystartsoc,socanchor=self.socanchor,forecast=self.forecast)
+        with TIMER.stage('checkpoint'):
+            if not saveCheckpoint(state,self.logger) : return False
+        self.checkpointed = key
+        return True
+
+    #
+    # Continues from a checkpoint instead of planStartup. The checkpoint is stale if it was made with other settings or
+    # is not for today. A checkpoint from yesterday with a plan for tomorrow is still used, tomorrow then becomes today.
+    # Returns True if resumed.
+    #
+    def resume(self,state):
+        logger = self.logger
+        if not state : return False
+        if state.get('settings') != planSettings() :
+            logger.info("Checkpoint was made with other settings, not resumed")
+            return False
+        try:
+            with TIMER.stage('resume'):
+                priceinfo = {'today':priceSeries(state['today']),'tomorrow':priceSeries(state['tomorrow'])}
+            vector,vector_tomorrow = list(state['vector']),list(state['vector_tomorrow'])
+            first,soc = state['socanchor']
+        except (KeyError,TypeError,ValueError) as err:
+            logger.warning(f"Checkpoint not readable, not resumed: {err}")
+            return False
+        day = CLOCK.today()
+        days = [priceinfo[x].time(0).date() if priceinfo[x] else None for x in ['today','tomorrow']]
+        if days[0] is None and state.get('forecast') == 'today' and datetime.date.fromisoformat(state['saved'][0:10]) == day :
+            days[0] = day                                           # Today planned on forecast prices, no prices yet
+        if days[0] != day and not (days[1] == day and vector_tomorrow) :
+            logger.info(f"Checkpoint is for {days[0]}, not resumed")
+            return False
+        self.priceinfo = priceinfo
+        self.vector,self.vector_tomorrow = vector,vector_tomorrow
+        self.todaysAveragePrice = state['todaysAveragePrice']
+        self.tomorrowsAveragePrice = state['tomorrowsAveragePrice']
+        self.daystartsoc = state['daystartsoc']
+        self.socanchor = (first,soc)
+        self.forecast = state.get('forecast')
+        self.checkpointed = self.checkpointKey()
+        logger.info(f"Plan resumed from checkpoint saved {state.get('saved')}")
+        if days[0] != day :
+            self.newDay()
+        else :
+            logger.info("Todays vector (resumed):" )
+            printvect(self.vector,logger)
+            if self.vector_tomorrow :
+                logger.info("Next days vector (resumed):")
+                printvect(self.vector_tomorrow,logger)
+        return True
+
+    #
+    # Plans today, and tomorrow if prices are published
+    #
+    def planStartup(self,priceinfo):
+        logger = self.logger
+        self.priceinfo = priceinfo
+        if HORIZON and not TEST:
+            self.vector,self.vector_tomorrow = buildHorizonChargeCntrlVector(priceinfo['today'],priceinfo['tomorrow'],logger)
+        else :
+            self.vector = buildOptimizedChargeCntrlVector(priceinfo['today'],logger)
+            blockNoChargeHour(self.vector,priceinfo['today'])
+            if len(priceinfo['tomorrow']) > 0 and not TEST:
+                self.vector_tomorrow =  buildOptimizedChargeCntrlVector(priceinfo['tomorrow'],logger)
+                blockNoChargeHour(self.vector_tomorrow,priceinfo['tomorrow'])
+            else :
+                self.vector_tomorrow = []
+        self.todaysAveragePrice = averagePrice(priceinfo['today'])
+        self.tomorrowsAveragePrice = averagePrice(priceinfo['tomorrow'])
+        self.socanchor = (0,self.daystartsoc)
+
+        logger.info("Todays vector (at startup):" )
+        printvect(self.vector,logger)
+        if self.vector_tomorrow :
+            logger.info("Next days vector (at startup):")
+            printvect(self.vector_tomorrow,logger)
+        else:
+            logger.info("Tomorrows vector empty... (at startup)")
+        if PRICECONTROL :
+            logger.info(f"Today {priceinfo['today']}")
+            logger.info(f"Tomorrow {priceinfo['tomorrow']}")
+            logger.info(f"Todays average price (at startup): {self.todaysAveragePrice}")
+            logger.info(f"Tomorrows average price (at startup): {self.tomorrowsAveragePrice}")
+
+    #
+    # Plans today when prices were missing at startup or at midnight. Returns True if planned.
+    #
+    def planToday(self,priceinfo,slot):
+        logger = self.logger
+        self.priceinfo = priceinfo
+        if not priceinfo['today'] : return False
+        logger.info("Fetched todays prices, analyzing....")
+        if HORIZON :
+            # Slots before slot ran on the vector so far (forecast or none), from the charge carried over midnight
+            self.vector,self.vector_tomorrow = buildHorizonChargeCntrlVector(priceinfo['today'],priceinfo['tomorrow'],logger,
+                self.vector,slot,self.daystartsoc)
+        else :
+            self.vector = buildOptimizedChargeCntrlVector(priceinfo['today'],logger)
+            blockNoChargeHour(self.vector,priceinfo['today'])
+        printvect(self.vector,logger)
+        self.todaysAveragePrice = averagePrice(priceinfo['today'])
+        self.socanchor = (0,self.daystartsoc)
+        if self.forecast == 'today' : self.forecast = None
+        return True
+
+    #
+    # Plans tomorrow (re-plans rest of today with rolling horizon). Returns True if next days prices were available.
+    #
+    def planTomorrow(self,priceinfo,slot):
+        logger = self.logger
+        self.priceinfo = priceinfo
+        if len(priceinfo['tomorrow']) == 0 :
+            logger.info("Next days prices not available yet")
+            return False
+        logger.info("Fetched next days prices, analyzing....")
+        if HORIZON :
+            current = self.expectedSoc(slot)
+            self.vector,self.vector_tomorrow = buildHorizonChargeCntrlVector(priceinfo['today'],
+                priceinfo['tomorrow'],logger,self.vector,slot,self.daystartsoc,current)
+            self.socanchor = (slot,current)
+            logger.info("Todays vector (re-planned):")
+            printvect(self.vector,logger)
+        else :
+            self.vector_tomorrow = buildOptimizedChargeCntrlVector(priceinfo['tomorrow'],logger)
+        blockNoChargeHour(self.vector_tomorrow,priceinfo['tomorrow'])
+        if empty(self.vector_tomorrow) :
+            logger.info("Next day will apply maximize self-consumption")
+        else :
+            logger.info(f"Next days vector: " )
+            printvect(self.vector_tomorrow,logger)
+        self.tomorrowsAveragePrice = averagePrice(priceinfo['tomorrow'])
+        if PRICECONTROL :
+            logger.info(f"Tomorrows average price: {self.tomorrowsAveragePrice}")
+        if self.forecast == 'tomorrow' : self.forecast = None
+        return True
+
+    #
+    # True if next days prices are still wanted from Tibber, i.e tomorrow is not planned or planned on forecast prices
+    #
+    def wantsTomorrow(self):
+        return not self.vector_tomorrow or self.forecast == 'tomorrow'
+
+    #
+    # Returns 'today' or 'tomorrow' if that day should be planned on forecast prices now, else None. A day is forecast once.
+    #
+    def forecastDue(self,hour):
+        if not FORECAST : return None
+        if not self.priceinfo['today'] and not self.vector and self.forecast != 'today' : return 'today'
+        if hour >= FORECASTHOUR and not self.vector_tomorrow and self.forecast != 'tomorrow' : return 'tomorrow'
+        return None
+
+    #
+    # Uses vector planned on forecast prices (buildForecastChargeCntrlVector) for day, 'today' or 'tomorrow'.
+    # The vector is replaced by planToday or planTomorrow when prices arrive.
+    #
+    def planForecast(self,day,vector):
+        self.forecast = day
+        if day == 'today' :
+            self.vector = vector
+            self.socanchor = (0,self.daystartsoc)
+        else :
+            self.vector_tomorrow = vector
+
+    #
+    # Tomorrow becomes today
+    #
+    def newDay(self):
+        logger = self.logger
+        if HORIZON :
+            self.daystartsoc = self.expectedSoc(len(self.vector))
+        self.vector = self.vector_tomorrow.copy()
+        self.vector_tomorrow = []
+        if empty(self.vector) :
+            logger.info("No charge/discharge segments. Activate maximize self-consumption mode ")
+        else :
+            logger.info(f"New day! Todays plan:")
+            printvect(self.vector,logger)
+        self.todaysAveragePrice = self.tomorrowsAveragePrice
+        self.tomorrowsAveragePrice = 0
+        if PRICECONTROL :
+            logger.info(f"Todays average price is: {self.todaysAveragePrice}")
+        self.priceinfo = {'today':self.priceinfo['tomorrow'],'tomorrow':priceSeries()}
+        self.socanchor = (0,self.daystartsoc)
+        self.forecast = 'today' if self.forecast == 'tomorrow' else None
+
+    #
+    # Planned state of charge (in charged slots) at start of slot, following the vector from the last known state
+    #
+    def expectedSoc(self,slot):
+        first,soc = self.socanchor
+        return stateOfCharge(self.vector[first:],slot - first,self.priceinfo['today'].spm,soc)
+
+    #
+    # Closed loop. soc is the measured state of charge (%) at start of slot, 0-100% is mapped on the CYCLELENGTH hours
+    # of charge the planners count with. If it differs SOCDRIFT or more from the planned trajectory, the remaining slots are
+    # re-planned by the dp engine from the measured state (today and tomorrow with rolling horizon). Returns True if re-planned.
+    #
+    def track(self,slot,soc):
+        logger = self.logger
+        today = self.priceinfo['today']
+        try:
+            soc = float(soc)
+        except (TypeError,ValueError):      # None, 'unavailable'...
+            return False
+        if slot >= len(self.vector) or slot >= len(today) : return False
+        capacity = CYCLELENGTH*today.spm
+        expected = self.expectedSoc(slot)
+        if abs(soc - expected*100/capacity) < SOCDRIFT : return False
+        measured = min(capacity,max(0,round(soc*capacity/100)))
+        logger.info(f"State of charge {soc}% in slot {slot}, planned {expected*100/capacity:.0f}%. Re-planning remaining slots")
+        if HORIZON :
+            self.vector,self.vector_tomorrow = buildHorizonChargeCntrlVector(today,self.priceinfo['tomorrow'],
+                logger,self.vector,slot,self.daystartsoc,measured)
+        else :
+            with TIMER.stage('build'):
+                self.vector = self.vector[:slot] + buildDPChargeCntrlVector(today[slot:],logger,measured)
+        self.socanchor = (slot,measured)
+        printvect(self.vector,logger)
+        return True
+
+    #
+    # Battery mode the plan has for slot, None if no plan
+    #
+    def plannedMode(self,slot):
+        if slot >= len(self.vector) : return None
+        if empty(self.vector) : return 'Selfconsumption'
+        return {'0':'Idle','L':'Charge','H':'Discharge'}[self.vector[slot]]
+
+    #
+    # Returns the battery mode to set in slot, None if current battery_mode is right (or no plan)
+    #
+    def batteryMode(self,slot,battery_mode):
+        if slot >= len(self.vector) : return None
+        if self.vector[slot] == '0' and battery_mode != 'Idle' and battery_mode != 'Selfconsumption' :
+            return 'Idle'
+        elif self.vector[slot] == 'L' and battery_mode != 'Charge' :
+            return 'Charge'
+        elif self.vector[slot] == 'H' and battery_mode != 'Discharge' :
+            return 'Discharge'
+        return None
+
+    #
+    # Computes heating level of all slots today: 'Off' when price is above maxprice, 'Eco' when above todays average price
+    # by level, else 'Normal'. Only done when prices or settings have changed. Returns True if the schedule was (re)computed.
+    # With the milp planner this schedule only gives the heating energy needed. Slots after slot are then re-planned with
+    # battery and heating jointly, with at least that much heating energy.
+    #
+    def heatingSchedule(self,maxprice,level,slot=0):
+        today = self.priceinfo['today']
+        try:
+            key = (today.digest(),float(maxprice),float(level))
+        except (TypeError,ValueError):      # Settings not read (None) or 'unavailable'
+            return False
+        if key == self.heatingkey : return False
+        self.heatingkey = key
+        eco = np.where(today.total > self.todaysAveragePrice*(1+key[2]),'Eco','Normal')
+        self.heating = np.where(today.total > key[1],'Off',eco).tolist()
+        if PLANNER == 'milp' and not HORIZON and slot + 1 < min(len(today),len(self.vector)) :
+            self.jointSchedule(slot + 1)
+        self.logger.info(f"Heating schedule, max price {maxprice} level {level}:")
+        printvect([x[0] for x in self.heating],self.logger)
+        return True
+
+    #
+    # Re-plans battery and heating of slots from first on, jointly (milp planner)
+    #
+    def jointSchedule(self,first):
+        today = self.priceinfo['today']
+        energy = sum(HEATINGPOWER[x] for x in self.heating[first:])/today.spm
+        current = self.expectedSoc(first)
+        with TIMER.stage('build'):
+            vector,heating = buildJointChargeCntrlVector(today[first:],self.logger,current,energy)
+        if heating is None : return
+        self.vector = self.vector[:first] + vector
+        self.heating = self.heating[:first] + heating
+        self.socanchor = (first,current)
+
+    #
+    # Returns the heating level to set in slot from the schedule, None if current heatinglevel is right (or no price or settings).
+    # When the schedule has been recomputed the level is returned anyway, so the new schedule is published with it.
+    #
+    def heatingLevel(self,slot,maxprice,level,heatinglevel):
+        changed = self.heatingSchedule(maxprice,level,slot)
+        if slot >= len(self.heating) : return None
+        wanted = self.heating[slot]
+        if wanted == heatinglevel and not changed : return None
+        self.logger.info(f"Current price is: {self.priceinfo['today'].total[slot]} Heating level set to: {wanted}")
+        return wanted
+
+
+#####################################################################################
+#
+# Local HTTP API
+#
+#   GET /plan       Vectors, prices, average price and expected net value of today and tomorrow, current slot and mode
+#   GET /metrics    Timing of the last planning run, startup benchmark and request statistics
+#   POST /simulate  {"prices": [Tibber priceInfo], "params": {"PLANNER": "dp", "CYCLELENGTH": 4, ...}} gives the vector
+#                   and net value the planner would give for these prices. params may be left out, else any of PLANNER
+#                   and the parameters in TUNEGRID.
+#
+# Results are kept by hash of their input (the plan, or the request), so polling gives no new planning work. Simulations
+# run in a separate process, so parameters can be changed without touching the control loop.
+#
+#####################################################################################
+
+class planApi:
+
+    def __init__(self,plan,logger,address,sources={}):
+        self.plan = plan
+        self.logger = logger
+        self.address = address
+        self.sources = sources              # name:function giving statistics for /metrics
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.pool = None                    # Process running simulations, created at first use, replaced if stuck
+        self.stats = {'requests':0,'hits':0,'simulations':0,'errors':0}
+
+    def start(self):
+        import http.server
+        api = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                api.respond(self,{'/plan':api.planState,'/metrics':api.metrics}.get(self.path.split('?')[0]))
+
+            def do_POST(self):
+                if self.path.split('?')[0] != '/simulate' :
+                    return api.respond(self,None)
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))))
+                except ValueError as err:
+                    return api.respond(self,None,(400,f"Invalid JSON: {err}"))
+                api.respond(self,lambda: api.simulate(body))
+
+            def log_message(self,format,*args):
+                api.logger.debug(f"API {self.address_string()} {format % args}")
+
+        self.server = http.server.ThreadingHTTPServer(self.address,handler)
+        threading.Thread(target=self.server.serve_forever,name="api",daemon=True).start()
+        self.logger.info(f"HTTP API listening on {self.address[0]}:{self.server.server_port}")
+
+    def respond(self,request,compute,error=None):
+        self.stats['requests'] += 1
+        if compute is None and error is None :
+            error = (404,"Not found, use GET /plan, GET /metrics or POST /simulate")
+        if error is None :
+            try:
+                status,result = 200,compute()
+            except (KeyError,TypeError,ValueError,IndexError) as err:
+                status,result = 400,{'error':f"Invalid request: {err!r}"}
+            except multiprocessing.TimeoutError:
+                status,result = 503,{'error':f"Simulation not done in {APITIMEOUT} s"}
+            except Exception as err:
+                self.logger.error(f"API request {request.path} failed: {err}")
+                status,result = 500,{'error':str(err)}
+        else :
+            status,result = error[0],{'error':error[1]}
+        if status != 200 : self.stats['errors'] += 1
+        body = json.dumps(result).encode()
+        request.send_response(status)
+        request.send_header('Content-Type','application/json')
+        request.send_header('Content-Length',str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def memoized(self,key,compute):
+        with self.lock:
+            if key in self.memo :
+                self.stats['hits'] += 1
+                return self.memo[key]
+        result = compute()
+        with self.lock:
+            self.memo[key] = result
+            while len(self.memo) > APIMEMO :
+                del self.memo[next(iter(self.memo))]        # Oldest first
+        return result
+
+    def planState(self):
+        plan = self.plan
+        key = ('plan',) + plan.checkpointKey()
+        state = self.memoized(key,lambda: {day:describeVector(plan.priceinfo[day],vector,average)
+            for day,vector,average in (('today',plan.vector,plan.todaysAveragePrice),('tomorrow',plan.vector_tomorrow,plan.tomorrowsAveragePrice))})
+        slot = currentSlot(plan.priceinfo['today'],CLOCK.now())
+        return dict(state,slot=slot,mode=plan.plannedMode(slot),settings=planSettings())
+
+    def metrics(self):
+        return dict(planning=METRICS,startup=STARTUP,api=self.stats,**{name:source() for name,source in self.sources.items()})
+
+    def simulate(self,body):
+        params = body.get('params') or {}
+        unknown = [name for name in params if name not in TUNEGRID and name != 'PLANNER']
+        if unknown : raise ValueError(f"Unknown parameters {unknown}")
+        if params.get('PLANNER',PLANNER) not in PLANNERS : raise ValueError(f"PLANNER must be one of {PLANNERS}")
+        data = priceSeries(body['prices'])
+        if not data : raise ValueError("No prices")
+        key = hashlib.sha1(json.dumps([planSettings(),params,body['prices']],sort_keys=True).encode()).hexdigest()
+        return self.memoized(key,lambda: self.run(params,data))
+
+    #
+    # Simulations run in a spawned process, as forking the multithreaded daemon may copy a held lock. The process
+    # starts from the defaults, so the settings are passed with each call. A simulation not done in APITIMEOUT
+    # seconds stops the process, and the next call starts a new one.
+    #
+    def run(self,params,data):
+        with self.lock:
+            if self.pool is None :
+                self.pool = multiprocessing.get_context('spawn').Pool(1)
+            pool = self.pool
+        self.stats['simulations'] += 1
+        try:
+            return pool.apply_async(simulateRun,(configuration(),params,data,self.logger)).get(APITIMEOUT)
+        except multiprocessing.TimeoutError:
+            self.logger.warning(f"Simulation not done in {APITIMEOUT} s, simulation process restarted")
+            with self.lock:
+                if self.pool is pool : self.pool = None
+            pool.terminate()
+            raise
+
+#
+# Vector of one day with what it is worth, as given by /plan and /simulate
+#
+
+def describeVector(data,vector,average=None):
+    result = dict(vector=vector,value=round(netValue(data,vector),3) if data else 0,
+        start=data.time(0).isoformat() if data else None,minutes=data.minutes,prices=data.total.tolist())
+    if average is not None : result['average'] = average
+    return result
+
+#
+# Settings given by options, i.e the scalar globals
+#
+
+def configuration():
+    return {name:value for name,value in globals().items() if name.isupper() and isinstance(value,(bool,int,float,str,type(None)))}
+
+#
+# Plans data with settings of the daemon and params (see tuneRun). Runs in the simulation process of planApi.
+#
+
+def simulateRun(settings,params,data,logger):
+    configured = {name:globals()[name] for name in {**settings,**params}}
+    try:
+        globals().update(settings)
+        globals().update(params)
+        start = time.perf_counter()
+        vector = blockNoChargeHour(buildOptimizedChargeCntrlVector(data,logger),data)
+        result = describeVector(data,vector)
+        result.update(params=params,planning_ms=round((time.perf_counter() - start)*1000,2))
+        return result
+    finally:
+        globals().update(configured)
+
+def startApi(plan,logger,sources):
+    if not API : return None
+    host,_,port = API.rpartition(':')
+    api = planApi(plan,logger,(host or '127.0.0.1',int(port)),sources)
+    try:
+        api.start()
+    except OSError as err:
+        logger.error(f"HTTP API not started on {API}: {err}")
+        return None
+    return api
+
+#
+# Starts live readings and peak shaving if configured. The shaver wakes up the scheduler when the control loop
+# should act between slot boundaries. Returns (tibberLive,peakShaver), None for what is not used.
+#
+
+def startLive(logger,scheduler):
+    if not LIVE : return None,None
+    live = tibberLive(logger,LIVEURL)
+    shaver = None
+    if PEAKLIMIT :
+        shaver = peakShaver(live,PEAKLIMIT,logger)
+        live.listeners.append(lambda: shaver.due() and scheduler.wakeup())
+    live.start()
+    return live,shaver
+
+#
+# Statistics shown by /metrics of the HTTP API
+#
+
+def apiSources(ha,scheduler,live,shaver):
+    sources = dict(homeassistant=ha.statistics,scheduler=lambda: scheduler.stats,tibber=lambda: tibber.statistics() if tibber else None)
+    if live : sources['live'] = lambda: live.stats
+    if shaver : sources['peakshaving'] = lambda: shaver.stats
+    return sources
+
 def main():
 
     options=get_cmd_line_parameters()           # get command line  
     bLogger=logger(LOGFILE, LOGLEVEL)
-    
+
+    if BACKTEST :
+        backtest(BACKTEST,bLogger)
+        return
+
+    if TUNE :
+        tune(TUNE,bLogger)
+        return
+
+    if FLEET :
+        fleet(FLEET,bLogger)
+        return
+
+    if SIMULATE :
+        simulation(SIMULATE,bLogger)
+        return
+
+    if ASYNCIO and not TEST :
+        asyncio.run(amain(bLogger))
+        return
+
+    control(bLogger)
+
+#
+# Control loop of one home, see amain for the same on asyncio
+#
+
+def control(bLogger):
+
     haSrv=homeAssistant(privatetokens.HA_URL,privatetokens.HA_TOKEN,bLogger)
    
     bLogger.info("*** Battery control system is starting up ***")
     bLogger.info(f"Logging - Log file: {LOGFILE}, Log level: {LOGLEVEL}, Test: {TEST}, Pricecontrol: {PRICECONTROL}")
 
-
-    batteryChargeCntrl=haEntity(haSrv,"input_select.battery_mode")
-
-    pdata=json.loads(getPrices(bLogger).text)             # get prices
-    vector = buildOptimizedChargeCntrlVector(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['today'],bLogger)
-    if len(vector) != 0 and vector[NOCHARGEHOUR] == 'L' : vector[NOCHARGEHOUR] = '0'
-    if len(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow']) > 0 and not TEST:
-        vector_tomorrow =  buildOptimizedChargeCntrlVector(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow'],bLogger)
-        if len(vector_tomorrow) > 0 and vector_tomorrow[NOCHARGEHOUR] == 'L': vector_tomorrow[NOCHARGEHOUR] = '0'
-    else :
-        vector_tomorrow = []
-
-    bLogger.info("Todays vector (at startup):" )
-    printvect(vector,bLogger)
-    if empty(vector) : 
+    batteryChargeCntrl=haActuator(haEntity(haSrv,"input_select.battery_mode"))
+    haPlanning=haEntity(haSrv,"sensor.battery_planning") if not TEST else None
+    haSoc=haEntity(haSrv,SOCSENSOR) if SOCSENSOR else None
+    if PRICECONTROL:
+        haMaxPrice=haEntity(haSrv,'input_number.max_pris')
+        haLevel=haEntity(haSrv,'input_number.niva')
+        haHeatingLevel=haActuator(haEntity(haSrv,'sensor.heating_level'))
+    if WEBSOCKET :
+        # Started after the entities are made, so their states are in the initial states of the cache
+        if haSrv.startCache() :
+            bLogger.info("Entity states are read from WebSocket state cache")
+        else :
+            bLogger.warning("WebSocket state cache not connected, entity states are read over REST until it is")
+
+    plan = batteryPlan(bLogger)
+    TIMER.reset()
+    if not plan.resume(loadCheckpoint(bLogger)) :                                   # plan from last run, no request
+        plan.planStartup(getPriceInfo(bLogger,CLOCK.now().hour >= 15))                # get prices and plan
+    plan.save()
+    if empty(plan.vector) : 
         bLogger.info("Apply maximize self-consumption")
-        batteryChargeCntrl.setState('Selfconsumption')
-    if vector_tomorrow :
-        bLogger.info("Next days vector (at startup):")
-        printvect(vector_tomorrow,bLogger)
-    else:
-        bLogger.info("Tomorrows vector empty... (at startup)")
-    battery_mode = batteryChargeCntrl.getState()
+        batteryChargeCntrl.set('Selfconsumption',plan.attributes())
+    publishMetrics(bLogger,haPlanning)
+    battery_mode = batteryChargeCntrl.current()
     bLogger.info(f"Current battery mode (at startup): {battery_mode}")
 
 
     if PRICECONTROL:
-        haMaxPrice=haEntity(haSrv,'input_number.max_pris')
-        haLevel=haEntity(haSrv,'input_number.niva')
-        haHeatingLevel=haEntity(haSrv,'sensor.heating_level')
         maxprice = haMaxPrice.getState()
         level = haLevel.getState()
-        heatinglevel=haHeatingLevel.getState()
+        heatinglevel=haHeatingLevel.current()
         bLogger.info(f"Current Max Price (at startup): {maxprice}")
         bLogger.info(f"Current Level (at startup): {level}")
         bLogger.info(f"Current Heating Level (at startup): {heatinglevel}")
-        todaysAveragePrice = averagePrice(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['today'])
-        tomorrowsAveragePrice = averagePrice(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow'])
-        bLogger.info(f"Today {pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['today']}")
-        bLogger.info(f"Tomorrow {pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow']}")
-        bLogger.info(f"Todays average price (at startup): {todaysAveragePrice}")
-        bLogger.info(f"Tomorrows average price (at startup): {tomorrowsAveragePrice}")
-        if len(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow']) > 0 :
-            tomorrowsAveragePrice = averagePrice(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow'])
-        else :
-            tomorrowsAveragePrice = 0
-    hour = -1
+    slot = -1
+    bLogger.info(f"Home Assistant requests (at startup): {haSrv.statistics()}")
 
-    if TEST : return
+    if TEST :
+        firstDecision(bLogger)
+        return
    
 
     # Continous execution loop
     bLogger.info("Start of control loop")
+    scheduler = slotScheduler(bLogger,SWITCHOFFSET)
+    live,shaver = startLive(bLogger,scheduler)
+    startApi(plan,bLogger,apiSources(haSrv,scheduler,live,shaver))
+    profiler = startProfiler(bLogger)
+    haProfile = haEntity(haSrv,"sensor.battery_profile")
     while True : 
 
-        # Run once each new hour
-        if datetime.datetime.now().hour > hour or (datetime.datetime.now().hour == 0 and hour == 23):
-            # New hour
-            hour = datetime.datetime.now().hour
-            time.sleep(60)                      # Wait one minute to make sure we are well beyond hour boundery
-
-            if hour == 0:
-                vector=vector_tomorrow.copy()
-                vector_tomorrow = []
-                if empty(vector) :
-                    bLogger.info("No charge/discharge segments. Activate maximize self-consumption mode ")
-                    batteryChargeCntrl.setState('Selfconsumption',dict(Today=vector, Tomorrow=vector_tomorrow))
-                else :
-                    bLogger.info(f"New day! Todays plan:")
-                    printvect(vector,bLogger)
-                    battery_mode = batteryChargeCntrl.getState()
-                    batteryChargeCntrl.setState(battery_mode,dict(Today=vector, Tomorrow=vector_tomorrow))
-                if PRICECONTROL :
-                    todaysAveragePrice=tomorrowsAveragePrice
-                    bLogger.info(f"Todays average price is: {todaysAveragePrice}")
-                pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['today'] = pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow']
-                pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow'] = []
-            
-            if hour >= 15 and not vector_tomorrow:
-                pdata=json.loads(getPrices(bLogger).text)             # get new prices
-                bLogger.info("Fetched next days prices, analyzing....")
-                vector_tomorrow = buildOptimizedChargeCntrlVector(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow'],bLogger)
-                if len(vector_tomorrow) != 0 : 
-                    if vector_tomorrow[NOCHARGEHOUR] == 'L' : vector_tomorrow[NOCHARGEHOUR] = '0'
-                    bLogger.info(f"Next days vector: " )
-                    printvect(vector_tomorrow,bLogger)
-                else :
-                    bLogger.info("Next day will apply maximize self-consumption")
-                battery_mode = batteryChargeCntrl.getState()
-                batteryChargeCntrl.setState(battery_mode,dict(Today=vector, Tomorrow=vector_tomorrow))
-                if PRICECONTROL :
-                    tomorrowsAveragePrice = averagePrice(pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['tomorrow'])
-                    bLogger.info(f"Tomorrows average price: {tomorrowsAveragePrice}")
-            if  len(vector) != 0 :
-                battery_mode = batteryChargeCntrl.getState()
-                if vector[hour] == '0' and battery_mode != 'Idle' and battery_mode != 'Selfconsumption' :
-                    batteryChargeCntrl.setState('Idle',dict(Today=vector, Tomorrow=vector_tomorrow))
-                    bLogger.info("Battery mode set to Idle")
-                elif vector[hour] == 'L' and battery_mode != 'Charge' :
-                    batteryChargeCntrl.setState('Charge',dict(Today=vector, Tomorrow=vector_tomorrow))
-                    bLogger.info("Battery mode set to Charge")
-                elif vector[hour] == 'H' and battery_mode != 'Discharge' :
-                    batteryChargeCntrl.setState('Discharge',dict(Today=vector, Tomorrow=vector_tomorrow))
-                    bLogger.info("Battery mode set to Discharge")
+        # Run once each new price period (slot)
+        now = CLOCK.now()
+        nowslot = currentSlot(plan.priceinfo['today'],now)
+        if nowslot != slot:
+            profiler.begin()
+            # New slot, a lower slot number than before means a new day
+            newday = nowslot < slot
+            slot = nowslot
+            hour = now.hour
+
+            if newday:
+                plan.newDay()
+                if empty(plan.vector) :
+                    batteryChargeCntrl.set('Selfconsumption',plan.attributes())
+                bLogger.info(f"Home Assistant requests: {haSrv.statistics()}")
+                bLogger.info(f"Scheduler: {scheduler.stats}")
+                if tibber : bLogger.info(f"Tibber requests: {tibber.statistics()}")
+                if live : bLogger.info(f"Tibber live: {live.stats}, peak shaving: {shaver.stats if shaver else None}")
+
+            # Battery mode is the local copy, no request. New plans are written with the mode switch, or by flush()
+
+            battery_mode = batteryChargeCntrl.current()
+            if haSoc is not None : plan.track(slot,haSoc.getState())
+            batteryChargeCntrl.update(plan.attributes())
+            mode = shaver.batteryMode(plan,slot,battery_mode) if shaver else plan.batteryMode(slot,battery_mode)
+            if mode and batteryChargeCntrl.set(mode) :
+                bLogger.info(f"Battery mode set to {mode}")
+            batteryChargeCntrl.flush()
+            firstDecision(bLogger)
             if PRICECONTROL :
-                maxprice = haMaxPrice.getState()
-                currentprice =  pdata['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']['today'][hour]['total']
-                heatinglevel = haHeatingLevel.getState();
-                level = haLevel.getState()
-                if currentprice > float(maxprice) and heatinglevel != 'Off' :
-                    bLogger.info(f"Current price is: {currentprice} Heating level set to: Off")
-                    haHeatingLevel.setState('Off')
-                elif currentprice > todaysAveragePrice *(1+float(level)) and heatinglevel != 'Eco' :
-                    bLogger.info(f"Current price is: {currentprice} Heating level set to: Eco")
-                    haHeatingLevel.setState('Eco')
-                elif currentprice <= todaysAveragePrice *(1+float(level)) and heatinglevel != 'Normal' :
-                    bLogger.info(f"Current price is: {currentprice} Heating level set to: Normal")
-                    haHeatingLevel.setState('Normal')
+                # Settings are read at the start of each hour, each slot if they are in the WebSocket state cache (no request)
+                if (haSrv.cached(haMaxPrice.id) and haSrv.cached(haLevel.id)) or slot % plan.priceinfo['today'].spm == 0 :
+                    maxprice = haMaxPrice.getState()
+                    level = haLevel.getState()
+                wanted = plan.heatingLevel(slot,maxprice,level,haHeatingLevel.current())
+                if wanted :
+                    haHeatingLevel.set(wanted,plan.heatingAttributes())
+
+            # Prices are fetched and planned after the mode is switched, so a slow or failing Tibber never delays the switch.
+            # New plans are used from next slot, as in amain().
+
+            if not plan.priceinfo['today'] :
+                # No prices for today, neither in cache nor from Tibber at startup or last night. Try again.
+                TIMER.reset()
+                if plan.planToday(getPriceInfo(bLogger,hour >= 15),slot) :
+                    publishMetrics(bLogger,haPlanning)
+
+            if hour >= 15 and plan.wantsTomorrow():
+                TIMER.reset()
+                if plan.planTomorrow(getPriceInfo(bLogger,True),slot) :         # get new prices
+                    batteryChargeCntrl.set(None,plan.attributes())
+                    publishMetrics(bLogger,haPlanning)
+
+            forecast = plan.forecastDue(hour)
+            if forecast :
+                # Prices late, plan on forecast prices until they arrive
+                day = CLOCK.today() + datetime.timedelta(days=0 if forecast == 'today' else 1)
+                plan.planForecast(forecast,buildForecastChargeCntrlVector(day,bLogger)[0])
+
+            batteryChargeCntrl.reconcile()      # After acting, changes made in HA are used from next slot
+            if PRICECONTROL : haHeatingLevel.reconcile()
+            plan.save()                         # Checkpoint new plans, after acting on them
+            if profiler.end(plan) :
+                profiler.publish(haProfile)
+
+        elif shaver :
+            # Woken by the live thread within the slot, a peak has started or ended
+            mode = shaver.batteryMode(plan,slot,batteryChargeCntrl.current())
+            if mode and batteryChargeCntrl.set(mode) :
+                bLogger.info(f"Battery mode set to {mode} (peak shaving)")
+
+        scheduler.sleep(plan.priceinfo)         # Sleep until just after start of next slot (or woken by peak shaving)
+
+#
+# Control loop on asyncio, see option --asyncio. Does the same as main(), but independent reads and writes towards Home Assistant
+# run concurrently and price fetching from Tibber runs as a background task, so it never delays a battery mode switch.
+#
+
+async def amain(bLogger):
+
+    haSrv=asyncHomeAssistant(privatetokens.HA_URL,privatetokens.HA_TOKEN,bLogger)
+    loop = asyncio.get_running_loop()
+
+    bLogger.info("*** Battery control system is starting up (asyncio) ***")
+    bLogger.info(f"Logging - Log file: {LOGFILE}, Log level: {LOGLEVEL}, Test: {TEST}, Pricecontrol: {PRICECONTROL}")
+
+    batteryChargeCntrl=haActuator(asyncHaEntity(haSrv,"input_select.battery_mode"))
+    haPlanning=asyncHaEntity(haSrv,"sensor.battery_planning")
+    haSoc=asyncHaEntity(haSrv,SOCSENSOR) if SOCSENSOR else None
+    if PRICECONTROL:
+        haMaxPrice=asyncHaEntity(haSrv,'input_number.max_pris')
+        haLevel=asyncHaEntity(haSrv,'input_number.niva')
+        haHeatingLevel=haActuator(asyncHaEntity(haSrv,'sensor.heating_level'))
+
+    # Prices are fetched while the WebSocket cache starts, startup reads of entities then run concurrently (from the cache if connected)
+
+    plan = batteryPlan(bLogger)
+    TIMER.reset()
+    resumed = plan.resume(loadCheckpoint(bLogger))
+    if not resumed :
+        pricefetch = loop.run_in_executor(None,getPriceInfo,bLogger,CLOCK.now().hour >= 15)
+    if WEBSOCKET :
+        if await loop.run_in_executor(None,haSrv.startCache) :
+            bLogger.info("Entity states are read from WebSocket state cache")
         else :
-            time.sleep(60)  
-         
-main()
-    
+            bLogger.warning("WebSocket state cache not connected, entity states are read over REST until it is")
+    reads = [batteryChargeCntrl.acurrent()]
+    if PRICECONTROL :
+        reads = reads + [haMaxPrice.agetState(),haLevel.agetState(),haHeatingLevel.acurrent()]
+    states = await asyncio.gather(*reads)
+    bLogger.info(f"Current battery mode (at startup): {states[0]}")
+    if PRICECONTROL:
+        bLogger.info(f"Current Max Price (at startup): {states[1]}")
+        bLogger.info(f"Current Level (at startup): {states[2]}")
+        bLogger.info(f"Current Heating Level (at startup): {states[3]}")
+    if not resumed :
+        plan.planStartup(await pricefetch)
+    plan.save()
+    if empty(plan.vector) : 
+        bLogger.info("Apply maximize self-consumption")
+        await batteryChargeCntrl.aset('Selfconsumption',plan.attributes())
+    await loop.run_in_executor(None,publishMetrics,bLogger,haPlanning)
+    bLogger.info(f"Home Assistant requests (at startup): {haSrv.statistics()}")
+
+    #
+    # Fetch prices in background and plan when they arrive
+    #
+    async def fetchPrices(hour):
+        try:
+            TIMER.reset()
+            priceinfo = await loop.run_in_executor(None,getPriceInfo,bLogger,hour >= 15)
+            slot = currentSlot(priceinfo['today'],CLOCK.now())
+            planned = False
+            if not plan.priceinfo['today'] :
+                planned = plan.planToday(priceinfo,slot)
+            if hour >= 15 and plan.wantsTomorrow() :
+                if plan.planTomorrow(priceinfo,slot) :
+                    planned = True
+                    await batteryChargeCntrl.aset(None,plan.attributes())
+            forecast = plan.forecastDue(hour)
+            if forecast :
+                day = CLOCK.today() + datetime.timedelta(days=0 if forecast == 'today' else 1)
+                vector,value = await loop.run_in_executor(None,buildForecastChargeCntrlVector,day,bLogger)
+                if plan.forecastDue(hour) == forecast :                 # Prices may have arrived meanwhile
+                    plan.planForecast(forecast,vector)
+                    planned = True
+            if planned :
+                plan.save()
+                await loop.run_in_executor(None,publishMetrics,bLogger,haPlanning)
+        except Exception as err:
+            bLogger.error(f"Price fetch failed: {err}")
+
+    async def switchBattery(slot):
+        if haSoc :
+            battery_mode,soc = await asyncio.gather(batteryChargeCntrl.acurrent(),haSoc.agetState())
+            plan.track(slot,soc)
+        else :
+            battery_mode = await batteryChargeCntrl.acurrent()
+        batteryChargeCntrl.update(plan.attributes())
+        mode = shaver.batteryMode(plan,slot,battery_mode) if shaver else plan.batteryMode(slot,battery_mode)
+        if mode and await batteryChargeCntrl.aset(mode) :
+            bLogger.info(f"Battery mode set to {mode}")
+        await batteryChargeCntrl.aflush()
+        firstDecision(bLogger)
+
+    # Settings are kept between slots, see main()
+
+    settings = dict(zip(['maxprice','level'],states[1:3]))
+
+    async def priceControl(slot):
+        if (haSrv.cached(haMaxPrice.id) and haSrv.cached(haLevel.id)) or slot % plan.priceinfo['today'].spm == 0 :
+            settings['maxprice'],settings['level'] = await asyncio.gather(haMaxPrice.agetState(),haLevel.agetState())
+        wanted = plan.heatingLevel(slot,settings['maxprice'],settings['level'],await haHeatingLevel.acurrent())
+        if wanted :
+            await haHeatingLevel.aset(wanted,plan.heatingAttributes())
+
+    # Continous execution loop
+    bLogger.info("Start of control loop")
+    scheduler = slotScheduler(bLogger,SWITCHOFFSET)
+    live,shaver = startLive(bLogger,scheduler)
+    startApi(plan,bLogger,apiSources(haSrv,scheduler,live,shaver))
+    profiler = startProfiler(bLogger)
+    haProfile = asyncHaEntity(haSrv,"sensor.battery_profile")
+    fetch = None
+    slot = -1
+    try:
+        while True : 
+
+            now = CLOCK.now()
+            nowslot = currentSlot(plan.priceinfo['today'],now)
+            if nowslot != slot:
+                profiler.begin()
+                newday = nowslot < slot
+                slot = nowslot
+                hour = now.hour
+
+                if newday:
+                    plan.newDay()
+                    if empty(plan.vector) :
+                        await batteryChargeCntrl.aset('Selfconsumption',plan.attributes())
+                    bLogger.info(f"Home Assistant requests: {haSrv.statistics()}")
+                    bLogger.info(f"Scheduler: {scheduler.stats}")
+                    if tibber : bLogger.info(f"Tibber requests: {tibber.statistics()}")
+                    if live : bLogger.info(f"Tibber live: {live.stats}, peak shaving: {shaver.stats if shaver else None}")
+
+                if (not plan.priceinfo['today'] or (hour >= 15 and plan.wantsTomorrow()) or plan.forecastDue(hour)) and (fetch is None or fetch.done()) :
+                    fetch = asyncio.create_task(fetchPrices(hour))
+
+                actions = [switchBattery(slot)]
+                if PRICECONTROL : actions.append(priceControl(slot))
+                await asyncio.gather(*actions)
+                checks = [batteryChargeCntrl.areconcile()] + ([haHeatingLevel.areconcile()] if PRICECONTROL else [])
+                await asyncio.gather(*checks)       # After acting, changes made in HA are used from next slot
+                plan.save()
+                if profiler.end(plan) :
+                    await loop.run_in_executor(None,profiler.publish,haProfile)
+
+            elif shaver :
+                mode = shaver.batteryMode(plan,slot,await batteryChargeCntrl.acurrent())
+                if mode and await batteryChargeCntrl.aset(mode) :
+                    bLogger.info(f"Battery mode set to {mode} (peak shaving)")
+
+            await scheduler.asleep(plan.priceinfo)  # Sleep until just after start of next slot (or woken by peak shaving)
+    finally:
+        await haSrv.aclose()
+
+#####################################################################################
+#
+# Fleet mode, one daemon controlling the batteries of several homes
+#
+# The config file lists the homes:
+#   {"homes": [{"name": "Cottage", "home": "<Tibber home id>", "ha_url": "http://...:8123", "ha_token": "...",
+#               "battery": "input_select.battery_mode", "soc": "sensor.battery_state_of_capacity"}, ...]}
+# "home" may be left out for the first home of the Tibber account, "battery" defaults to input_select.battery_mode.
+# "soc" is optional, the state of charge sensor for closed loop control of the home (see option --soc).
+# Prices for all homes are fetched by one Tibber request and cached per home. Each home has its own batteryPlan, planned in
+# a process pool so homes are planned in parallel. A home is not re-planned when its prices and slot are the same as last time.
+# Battery mode only, price control of heating is not supported in fleet mode.
+#
+#####################################################################################
+
+class fleetHome:
+
+    def __init__(self,config,logger):
+        self.name = config['name']
+        self.id = config.get('home')
+        self.logger = logger
+        self.ha = homeAssistant(config['ha_url'],config['ha_token'],logger)
+        self.battery = haActuator(haEntity(self.ha,config.get('battery',"input_select.battery_mode")))
+        self.soc = haEntity(self.ha,config['soc']) if config.get('soc') else None
+        self.plan = batteryPlan(logger)
+        self.slot = -1
+        self.planned = {}               # Per planning method, prices and slot of last planning
+
+    #
+    # Key of the planning input. None if the same as last time method was run, i.e no need to plan again.
+    #
+    def planKey(self,method,priceinfo,slot):
+        key = (priceinfo['today'].digest(),priceinfo['tomorrow'].digest(),slot if HORIZON else None)
+        if self.planned.get(method) == key : return None
+        return key
+
+#
+# Runs method of plan in a pool worker. The plan is returned, since the worker has its own copy.
+#
+
+def fleetPlan(plan,method,*args):
+    result = getattr(plan,method)(*args)
+    return plan,result
+
+#
+# Runs method (planStartup, or planToday/planTomorrow in the current slot of each home) for all homes in parallel.
+# Returns the homes where method returned True.
+#
+
+def planFleet(pool,homes,method,priceinfo):
+    futures = {}
+    for home in homes :
+        args = (priceinfo[home.id],) if method == 'planStartup' else (priceinfo[home.id],home.slot)
+        key = home.planKey(method,priceinfo[home.id],home.slot)
+        if key is None : continue
+        home.planned[method] = key
+        futures[home] = pool.submit(fleetPlan,home.plan,method,*args)
+    planned = []
+    with TIMER.stage('build'):
+        for home,future in futures.items() :
+            try:
+                home.plan,result = future.result()
+            except Exception as err:
+                home.logger.error(f"Planning of {home.name} failed: {err}")
+                home.planned.pop(method)
+                continue
+            if result is not False : planned.append(home)
+    return planned
+
+def fleet(config,bLogger):
+
+    try:
+        with open(config) as f:
+            homes = [fleetHome(x,bLogger) for x in json.load(f)['homes']]
+    except (OSError,ValueError,KeyError,TypeError) as err:
+        bLogger.error(f"Invalid fleet config {config}: {err}")
+        return
+    if not homes : return
+    bLogger.info(f"*** Battery control system is starting up, fleet of {len(homes)} homes ***")
+
+    # Workers are forked, spawning would re-run this script. Pool is started before any other thread.
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(len(homes),os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context('fork'))
+    ids = [home.id for home in homes]
+    try:
+        TIMER.reset()
+        priceinfo = getHomesPriceInfo(bLogger,ids,CLOCK.now().hour >= 15)
+        planFleet(pool,homes,'planStartup',priceinfo)
+        for home in homes :
+            if empty(home.plan.vector) :
+                bLogger.info(f"{home.name}: Apply maximize self-consumption")
+                home.battery.set('Selfconsumption',home.plan.attributes())
+            bLogger.info(f"{home.name}: Current battery mode (at startup): {home.battery.current()}")
+        publishMetrics(bLogger)
+        if TEST : return
+
+        bLogger.info("Start of control loop")
+        scheduler = slotScheduler(bLogger,SWITCHOFFSET)
+        while True :
+
+            now = CLOCK.now()
+            hour = now.hour
+            changed = []
+            for home in homes :
+                nowslot = currentSlot(home.plan.priceinfo['today'],now)
+                if nowslot == home.slot : continue
+                if nowslot < home.slot :
+                    home.plan.newDay()
+                    if empty(home.plan.vector) :
+                        home.battery.set('Selfconsumption',home.plan.attributes())
+                    bLogger.info(f"{home.name}: Home Assistant requests: {home.ha.statistics()}")
+                    nowslot = currentSlot(home.plan.priceinfo['today'],now)
+                home.slot = nowslot
+                changed.append(home)
+
+            today = [home for home in changed if not home.plan.priceinfo['today']]
+            tomorrow = [home for home in changed if hour >= 15 and not home.plan.vector_tomorrow]
+            if today or tomorrow :
+                TIMER.reset()
+                priceinfo = getHomesPriceInfo(bLogger,ids,hour >= 15)
+                planFleet(pool,today,'planToday',priceinfo)
+                for home in planFleet(pool,tomorrow,'planTomorrow',priceinfo) :
+                    home.battery.set(None,home.plan.attributes())
+                publishMetrics(bLogger)
+
+            for home in changed :
+                battery_mode = home.battery.current()
+                if home.soc is not None : home.plan.track(home.slot,home.soc.getState())
+                home.battery.update(home.plan.attributes())
+                mode = home.plan.batteryMode(home.slot,battery_mode)
+                if mode and home.battery.set(mode) :
+                    bLogger.info(f"{home.name}: Battery mode set to {mode}")
+                home.battery.flush()
+            if changed : firstDecision(bLogger)
+            for home in changed :
+                home.battery.reconcile()
+
+            scheduler.sleep(homes[0].plan.priceinfo)    # Sleep until just after start of next slot
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+#####################################################################################
+#
+# Simulation (option --simulate), the control loop of control() run on a virtual clock
+#
+# Home Assistant and Tibber are simulated in process, as requests transport adapters mounted on the HTTP clients, so
+# the real clients, price cache, checkpoint and planners are used. Tibber gives the recorded prices of the virtual day,
+# and next days prices from SIMPUBLISHHOUR. Each sleep of the loop moves the clock at once, so a year runs in seconds.
+# Revenue is counted from the battery modes actually set in simulated HA, by netValue of each day.
+#
+#####################################################################################
+
+class simServer(requests.adapters.BaseAdapter):
+
+    def __init__(self):
+        super().__init__()
+        self.calls = {}
+
+    def send(self,request,**kwargs):
+        self.calls[request.method] = self.calls.get(request.method,0) + 1
+        body = json.loads(request.body) if request.body else None
+        status,result = self.handle(request.method,requests.utils.urlparse(request.url).path,body)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(result).encode()
+        response.headers['Content-Type'] = 'application/json'
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+class simHomeAssistant(simServer):
+
+    def __init__(self,states):
+        super().__init__()
+        self.states = dict(states)
+        self.history = {id:[(CLOCK.now().timestamp(),state)] for id,state in states.items()}     # (epoch,state) of each change
+        self.switches = {}
+
+    def handle(self,method,path,body):
+        id = path.split('/')[-1]
+        if path.startswith('/api/services/') : return 200,[]
+        if method == 'GET' :
+            if id not in self.states : return 404,{'message':'Entity not found.'}
+            return 200,{'entity_id':id,'state':self.states[id],'attributes':{}}
+        if body['state'] != self.states.get(id) :
+            self.switches[id] = self.switches.get(id,0) + 1
+            self.history.setdefault(id,[]).append((CLOCK.now().timestamp(),body['state']))
+        self.states[id] = body['state']
+        return 200,{'entity_id':id,'state':body['state']}
+
+class simTibber(simServer):
+
+    def __init__(self,days):
+        super().__init__()
+        self.days = days                # Recorded priceInfo by date
+
+    def handle(self,method,path,body):
+        now = CLOCK.now()
+        today = self.days.get(now.date(),[])
+        tomorrow = self.days.get(now.date() + datetime.timedelta(days=1),[]) if now.hour >= SIMPUBLISHHOUR else []
+        home = {'id':'simulated','currentSubscription':{'priceInfo':{'current':None,'today':today,'tomorrow':tomorrow}}}
+        return 200,{'data':{'viewer':{'homes':[home]}}}
+
+#
+# Records of data split into slots of minutes, same price in each part
+#
+
+def slotRecords(data,minutes):
+    parts = data.minutes//minutes
+    records = np.repeat(data.records(),parts)
+    records['epoch'] += np.tile(np.arange(parts)*minutes*60,len(data))
+    return records
+
+def simulation(directory,logger):
+    global CLOCK,TIBBER_URL,PRICECACHE,CHECKPOINT,ARCHIVE,METRICSFILE,WEBSOCKET,LIVE,API,tibber
+    import tempfile
+
+    days = {}
+    for name in sorted(os.listdir(directory)) :
+        if not name.endswith('.json') : continue
+        try:
+            with open(os.path.join(directory,name)) as f:
+                data = json.load(f)
+            days[datetime.date.fromisoformat(data[0]['startsAt'][0:10])] = data
+        except (OSError,ValueError,KeyError,IndexError,TypeError) as err:
+            logger.warning(f"Skipping {name}: {err}")
+    if not days :
+        print(f"No price files found in {directory}")
+        return None
+    first,last = min(days),max(days)
+    series = [priceSeries(days[day]) for day in sorted(days)]
+    start = datetime.datetime.combine(first,datetime.time()).timestamp()
+    end = datetime.datetime.combine(last + datetime.timedelta(days=1),datetime.time()).timestamp()
+
+    with tempfile.TemporaryDirectory() as work :
+        CLOCK = virtualClock(start,end)
+        ha = simHomeAssistant({'input_select.battery_mode':'Idle','input_number.max_pris':'3','input_number.niva':'0.1',
+            'sensor.heating_level':'Normal'})
+        market = simTibber(days)
+        ADAPTERS.update({'http://ha.simulated':ha,'http://tibber.simulated':market})
+        privatetokens.HA_URL,TIBBER_URL = 'http://ha.simulated','http://tibber.simulated/v1-beta/gql'
+        PRICECACHE,CHECKPOINT,METRICSFILE = os.path.join(work,'prices'),os.path.join(work,'plan.json'),os.path.join(work,'metrics.json')
+        ARCHIVE = os.path.join(work,'archive')
+        ARCHIVES.clear()
+        WEBSOCKET,LIVE,API,tibber = False,False,None,None
+        wall = time.perf_counter()
+        try:
+            control(logger)
+        except simulationEnd:
+            pass
+        wall = time.perf_counter() - wall
+
+    # The run is scored as one series, so charge carried over midnight counts (as it does for the horizon planner).
+    # Battery mode in effect in the middle of each slot, as set in simulated HA, next to dp over the same series.
+
+    span = priceSeries(np.concatenate([slotRecords(data,min(x.minutes for x in series)) for data in series]))
+    changes = ha.history['input_select.battery_mode']
+    times = np.array([t for t,state in changes])
+    codes = {'Charge':'L','Discharge':'H'}
+    states = [changes[i][1] for i in np.searchsorted(times,span.epoch + span.minutes*30,side='right') - 1]
+    realised = netValue(span,[codes.get(x,'0') for x in states])
+    optimal = netValue(span,buildDPChargeCntrlVector(span,logging.getLogger(logger.name + ".simulation")))
+    summary = dict(days=len(days),from_day=first.isoformat(),to_day=last.isoformat(),wall_s=round(wall,2),
+        ha_get=ha.calls.get('GET',0),ha_post=ha.calls.get('POST',0),tibber_requests=sum(market.calls.values()),
+        mode_switches=ha.switches.get('input_select.battery_mode',0),heating_switches=ha.switches.get('sensor.heating_level',0),
+        revenue=round(realised,2),revenue_dp=round(optimal,2))
+    print(f"Simulation of {len(days)} days ({first} - {last}) in {wall:.1f} s, {PLANNER} planner")
+    for name,value in summary.items() :
+        print(f"{name:<20}{value:>12}")
+    return summary
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,85 @@
+#
+# Test fixtures. battery.py is imported as a module, privatetokens is given dummy values if there is none.
+#
+
+import datetime
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import privatetokens
+except ImportError:
+    directory = tempfile.mkdtemp(prefix='batterytest')         # A file, so spawned processes find it too
+    with open(os.path.join(directory,'privatetokens.py'),'w') as f:
+        f.write('HA_URL = "http://127.0.0.1:8123"\nHA_TOKEN = "token"\nTIBBER_TOKEN = "token"\n')
+    sys.path.append(directory)
+    import privatetokens
+
+import battery
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("batterytest")
+
+#
+# Tibber priceInfo of day for prices (one per price period, hourly or quarter-hourly), UTC+01:00
+#
+
+def priceDay(prices,day=datetime.date(2024,3,4)):
+    minutes = 24*60//len(prices)
+    start = datetime.datetime.combine(day,datetime.time(),datetime.timezone(datetime.timedelta(hours=1)))
+    return [{'total':float(x),'energy':float(x),'tax':0.0,'startsAt':(start + datetime.timedelta(minutes=i*minutes)).isoformat()}
+        for i,x in enumerate(prices)]
+
+#
+# Quarter-hourly prices of n days with a morning and an evening peak, and noise
+#
+
+def quarterDays(n,noise=0.05,seed=1):
+    rng = np.random.default_rng(seed)
+    t = np.arange(96)/4
+    days = []
+    for i in range(n) :
+        curve = 0.3 + rng.uniform(1.2,2.0)*np.exp(-(t - 8)**2/4) + rng.uniform(1.5,2.5)*np.exp(-(t - 18)**2/6)
+        days.append(curve + rng.uniform(-noise,noise,96))
+    return days
+
+#
+# Quarter-hourly Tibber priceInfo of day in local time, cheap at night and expensive in the evening
+#
+
+def localPrices(day):
+    data = battery.forecastSeries(day)
+    data.total = 0.3 + 2.0*np.exp(-(data.hour + data.minute % 60/60 - 18)**2/6)
+    return data.data()
+
+HASTATES = {'input_select.battery_mode':'Idle','input_number.max_pris':'3','input_number.niva':'0.1','sensor.heating_level':'Normal'}
+
+#
+# Stand-in Home Assistant with WebSocket API, and Tibber, see standin.py
+#
+
+@pytest.fixture
+def ha():
+    pytest.importorskip('aiohttp')
+    pytest.importorskip('websocket')
+    from standin import standIn
+    server = standIn(HASTATES,localPrices).start()
+    yield server
+    server.stop()
+
+def waitFor(condition,timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() :
+        if time.monotonic() > deadline : return False
+        time.sleep(0.01)
+    return True
@@ -0,0 +1,159 @@
+#
+# Local stand-in for Home Assistant (REST and WebSocket API) and the Tibber price API, on one aiohttp server run in a
+# thread. Requests to the REST API are counted in requests, as (method,entity id). Tibber answers with prices, a
+# function of the date giving Tibber priceInfo of that day.
+#
+
+import asyncio
+import datetime
+import json
+import threading
+
+from aiohttp import web
+
+
+class standIn:
+
+    def __init__(self,states,prices=None):
+        self.states = dict(states)
+        self.prices = prices
+        self.requests = []
+        self.tibber = 0
+        self.sockets = set()
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.started.wait(10)
+        return self
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_get('/api/websocket',self.websocket)
+        app.router.add_get('/api/states/{id}',self.getState)
+        app.router.add_post('/api/states/{id}',self.postState)
+        app.router.add_post('/api/services/{domain}/{service}',self.service)
+        app.router.add_post('/gql',self.gql)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner,'127.0.0.1',0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.started.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        async def close():
+            for ws in list(self.sockets) :
+                await ws.close()
+            await self.runner.cleanup()
+        asyncio.run_coroutine_threadsafe(close(),self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+
+    def gets(self,id=None):
+        return sum(1 for method,x in self.requests if method == 'GET' and id in (None,x))
+
+    #
+    # State changed in HA (not by the daemon), sent as state_changed event
+    #
+    def change(self,id,state):
+        asyncio.run_coroutine_threadsafe(self.setState(id,state),self.loop).result(10)
+
+    async def setState(self,id,state):
+        old = self.states.get(id)
+        self.states[id] = state
+        event = {'type':'event','event':{'event_type':'state_changed','data':{'entity_id':id,
+            'old_state':None if old is None else {'entity_id':id,'state':old},'new_state':{'entity_id':id,'state':state}}}}
+        for ws in list(self.sockets) :
+            await ws.send_str(json.dumps(event))
+
+    async def getState(self,request):
+        id = request.match_info['id']
+        self.requests.append(('GET',id))
+        if id not in self.states :
+            return web.json_response({'message':'Entity not found.'},status=404)
+        return web.json_response({'entity_id':id,'state':self.states[id],'attributes':{}})
+
+    async def postState(self,request):
+        id = request.match_info['id']
+        self.requests.append(('POST',id))
+        body = await request.json()
+        await self.setState(id,body['state'])
+        return web.json_response({'entity_id':id,'state':body['state']})
+
+    async def service(self,request):
+        self.requests.append(('POST',request.match_info['domain'] + '.' + request.match_info['service']))
+        return web.json_response([])
+
+    async def gql(self,request):
+        self.tibber += 1
+        today = datetime.date.today()
+        info = {'current':None,'today':self.prices(today),'tomorrow':self.prices(today + datetime.timedelta(days=1))}
+        return web.json_response({'data':{'viewer':{'homes':[{'id':'standin','currentSubscription':{'priceInfo':info}}]}}})
+
+    async def websocket(self,request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({'type':'auth_required'}))
+        if json.loads(await ws.receive_str())['type'] != 'auth' : return ws
+        await ws.send_str(json.dumps({'type':'auth_ok'}))
+        async for msg in ws :
+            command = json.loads(msg.data)
+            if command['type'] == 'subscribe_events' :
+                self.sockets.add(ws)
+                await ws.send_str(json.dumps({'id':command['id'],'type':'result','success':True,'result':None}))
+            elif command['type'] == 'get_states' :
+                states = [{'entity_id':id,'state':state} for id,state in self.states.items()]
+                await ws.send_str(json.dumps({'id':command['id'],'type':'result','success':True,'result':states}))
+            elif command['type'] == 'ping' :
+                await ws.send_str(json.dumps({'id':command['id'],'type':'pong'}))
+        self.sockets.discard(ws)
+        return ws
+
+#
+# Local stand-in for the Tibber liveMeasurement subscription (graphql-transport-ws). Each connection is acknowledged
+# and replays readings, liveMeasurement payloads as recorded from the subscription, one every interval seconds. The
+# connection is then kept open (no reconnect), until stop(). Subscribed home ids are kept in homes.
+#
+
+class liveStandIn(standIn):
+
+    def __init__(self,readings,interval=0.01):
+        super().__init__({})
+        self.readings = readings
+        self.interval = interval
+        self.homes = []
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_get('/live',self.live)
+        self.runner = web.AppRunner(app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner,'127.0.0.1',0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = f"ws://127.0.0.1:{self.port}/live"
+        self.started.set()
+        self.loop.run_forever()
+
+    async def live(self,request):
+        ws = web.WebSocketResponse(protocols=['graphql-transport-ws'])
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        if json.loads(await ws.receive_str())['type'] != 'connection_init' : return ws
+        await ws.send_str(json.dumps({'type':'connection_ack'}))
+        subscribe = json.loads(await ws.receive_str())
+        self.homes.append(subscribe['payload']['query'].split('"')[1])
+        for reading in self.readings :
+            await asyncio.sleep(self.interval)
+            await ws.send_str(json.dumps({'id':subscribe['id'],'type':'next','payload':{'data':{'liveMeasurement':reading}}}))
+        async for msg in ws :
+            pass
+        self.sockets.discard(ws)
+        return ws
@@ -0,0 +1,52 @@
+import threading
+
+import battery
+
+
+class steppedClock(battery.virtualClock):
+
+    def step(self,seconds):
+        self.wait(threading.Event(),seconds)
+
+def test_actuator_without_connected_cache_reads_once(ha,logger):
+    server = battery.homeAssistant(ha.url,"token",logger)
+    mode = battery.haActuator(battery.haEntity(server,'input_select.battery_mode'))
+    server.cache = battery.haStateCache(server)                         # Not started, never connected
+    assert mode.current() == 'Idle'
+    assert not mode.due()
+    assert mode.current() == 'Idle'
+    assert ha.gets() == 1
+
+#
+# Without WebSocket cache the state is read once, then only checked by reconcile() every RECONCILE seconds
+#
+
+def test_reconcile_off_the_switch_path(ha,logger,monkeypatch):
+    clock = steppedClock(0,1e9)
+    monkeypatch.setattr(battery,'CLOCK',clock)
+    server = battery.homeAssistant(ha.url,"token",logger)
+    mode = battery.haActuator(battery.haEntity(server,'input_select.battery_mode'))
+    assert mode.current() == 'Idle'
+    for slot in range(battery.RECONCILE//900 - 1) :
+        clock.step(900)
+        wanted = 'Charge' if mode.current() == 'Idle' else 'Idle'       # Decision on the local copy
+        assert mode.set(wanted)
+        mode.reconcile()
+    assert ha.gets() == 1
+    ha.states['input_select.battery_mode'] = 'Discharge'                # Changed in HA
+    clock.step(900)
+    assert mode.current() == wanted
+    mode.reconcile()
+    assert ha.gets() == 2
+    assert mode.current() == 'Discharge'
+
+def test_writes_only_changes(ha,logger):
+    server = battery.homeAssistant(ha.url,"token",logger)
+    mode = battery.haActuator(battery.haEntity(server,'input_select.battery_mode'))
+    mode.current()
+    assert not mode.set('Idle')
+    mode.update({'planned':'L'})
+    assert mode.flush()
+    assert not mode.flush()
+    assert mode.set('Charge',{'planned':'L'})
+    assert [x for x in ha.requests if x[0] == 'POST'] == [('POST','input_select.battery_mode')]*2
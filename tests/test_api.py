@@ -0,0 +1,50 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import battery
+from conftest import priceDay, quarterDays
+
+@pytest.fixture
+def api(logger):
+    server = battery.planApi(None,logger,('127.0.0.1',0))
+    server.start()
+    yield server
+    server.server.shutdown()
+    if server.pool is not None : server.pool.terminate()
+
+def simulate(api,body):
+    request = urllib.request.Request(f"http://127.0.0.1:{api.server.server_port}/simulate",data=json.dumps(body).encode())
+    try:
+        with urllib.request.urlopen(request,timeout=60) as response:
+            return response.status,json.loads(response.read())
+    except urllib.error.HTTPError as err:
+        return err.code,json.loads(err.read())
+
+#
+# Simulations run in a spawned process with the settings of the daemon. One not done in APITIMEOUT gives 503, and
+# the next request gets a new process.
+#
+
+def test_simulate_with_daemon_settings(api,logger,monkeypatch):
+    monkeypatch.setattr(battery,'CYCLELENGTH',2)
+    prices = priceDay(quarterDays(1)[0])
+    status,result = simulate(api,{'prices':prices,'params':{'PLANNER':'dp'}})
+    assert status == 200
+    expected = battery.simulateRun(battery.configuration(),{'PLANNER':'dp'},battery.priceSeries(prices),logger)
+    assert result['vector'] == expected['vector'] and result['value'] == expected['value']
+    default = battery.simulateRun(battery.configuration(),{'PLANNER':'dp','CYCLELENGTH':3},battery.priceSeries(prices),logger)
+    assert result['vector'] != default['vector']                         # Not planned with the default CYCLELENGTH
+    assert simulate(api,{'prices':prices,'params':{'PLANNER':'dp'}}) == (200,result)
+    assert api.stats['simulations'] == 1 and api.stats['hits'] == 1
+
+def test_stuck_simulation_gives_503(api,monkeypatch):
+    monkeypatch.setattr(battery,'APITIMEOUT',0.001)                        # Less than starting the process
+    prices = priceDay(quarterDays(1)[0])
+    status,result = simulate(api,{'prices':prices})
+    assert status == 503 and api.pool is None
+    monkeypatch.setattr(battery,'APITIMEOUT',60)
+    status,result = simulate(api,{'prices':prices})
+    assert status == 200 and result['vector']
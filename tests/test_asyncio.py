@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+import battery
+
+
+#
+# First slot of the asyncio loop with WebSocket cache and price control (-a -w -p) reads all entities from the cache
+#
+
+def test_amain_reads_from_cache(ha,logger,monkeypatch,tmp_path):
+    pytest.importorskip('aiohttp')
+    monkeypatch.setattr(battery.privatetokens,'HA_URL',ha.url,raising=False)
+    for name,value in {'TIBBER_URL':ha.url + '/gql','tibber':None,'WEBSOCKET':True,'PRICECONTROL':True,'CHECKPOINT':'','ARCHIVE':'',
+            'PRICECACHE':str(tmp_path/'prices'),'METRICSFILE':str(tmp_path/'metrics.json'),'PROFILEDIR':str(tmp_path/'profile'),'STARTUP':{}}.items() :
+        monkeypatch.setattr(battery,name,value)
+
+    async def firstSlot():
+        task = asyncio.create_task(battery.amain(logger))
+        for i in range(500) :
+            if ('POST','sensor.battery_planning') in ha.requests and battery.STARTUP : break
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(firstSlot())
+    assert battery.STARTUP                                              # First decision made
+    assert ha.gets() == 0
+    assert ha.tibber == 1
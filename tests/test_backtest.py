@@ -0,0 +1,60 @@
+import datetime
+import json
+
+import numpy as np
+
+import battery
+from conftest import priceDay, quarterDays
+
+
+def series(prices,i=0):
+    return battery.priceSeries(priceDay(prices,datetime.date(2024,3,4) + datetime.timedelta(days=i)))
+
+def revenue(days,planner,logger,monkeypatch):
+    monkeypatch.setattr(battery,'PLANNER',planner)
+    vectors = [battery.blockNoChargeHour(battery.buildOptimizedChargeCntrlVector(data,logger),data) for data in days]
+    return battery.scoreVectors(days,vectors).sum()
+
+#
+# The heuristic plans quarter-hourly prices on their hourly means, it must earn as much as on hourly prices
+#
+
+def test_heuristic_quarter_hourly(logger,monkeypatch):
+    quarters = quarterDays(14)
+    days = [series(x,i) for i,x in enumerate(quarters)]
+    hours = [series(x.reshape(24,4).mean(axis=1),i) for i,x in enumerate(quarters)]
+    heuristic = revenue(days,'heuristic',logger,monkeypatch)
+    dp = revenue(days,'dp',logger,monkeypatch)
+    assert heuristic > 0.5*dp
+    assert np.isclose(heuristic,revenue(hours,'heuristic',logger,monkeypatch))
+
+def test_heuristic_smooth_curve_not_idle(logger,monkeypatch):
+    quarters = quarterDays(1,noise=0.05,seed=7)[0]
+    monkeypatch.setattr(battery,'PLANNER','heuristic')
+    vector = battery.buildOptimizedChargeCntrlVector(series(quarters),logger)
+    assert 'L' in vector and 'H' in vector
+    assert len(vector) == 96 and all(len(set(vector[i:i+4])) == 1 for i in range(0,96,4))
+
+def test_hourly_series():
+    data = series(np.arange(96,dtype=float))
+    hourly = battery.hourlySeries(data)
+    assert len(hourly) == 24 and hourly.spm == 1 and hourly.minutes == 60
+    assert np.allclose(hourly.total,np.arange(96).reshape(24,4).mean(axis=1))
+    assert hourly.hour.tolist() == list(range(24))
+    assert battery.hourlySeries(hourly) is None
+
+#
+# A day in the price cache at both resolutions, and once for a fleet home, is read once per home at the finer resolution
+#
+
+def test_load_archive_reads_each_day_once(tmp_path,logger):
+    first,second = datetime.date(2024,3,4),datetime.date(2024,3,5)
+    quarter = quarterDays(2)
+    files = {f"{first}_HOURLY.json":priceDay(quarter[0][::4],first),f"{first}_QUARTER_HOURLY.json":priceDay(quarter[0],first),
+        f"{first}_QUARTER_HOURLY_home_1.json":priceDay(quarter[0],first),f"{second}_HOURLY.json":priceDay(quarter[1][::4],second)}
+    for name,prices in files.items() :
+        (tmp_path/name).write_text(json.dumps(prices))
+    days = battery.loadArchive(str(tmp_path),logger)
+    assert [(x.time(0).date(),x.minutes) for x in days] == [(first,15),(first,15),(second,60)]
+    assert battery.priceFileHome(f"{first}_QUARTER_HOURLY_home_1.json") == 'home_1'
+    assert battery.priceFileHome(f"{first}_HOURLY.json") is None
@@ -0,0 +1,40 @@
+import battery
+from conftest import waitFor
+
+
+def test_states_read_from_cache(ha,logger):
+    server = battery.homeAssistant(ha.url,"token",logger)
+    mode = battery.haEntity(server,'input_select.battery_mode')
+    server.cache = battery.haStateCache(server)
+    server.cache.track(mode.id)
+    assert server.cache.start()
+    assert mode.getState() == 'Idle'
+    ha.change('input_select.battery_mode','Charge')                     # Changed in HA, arrives as event
+    assert waitFor(lambda: mode.getState() == 'Charge')
+    assert mode.setState('Discharge')
+    assert mode.getState() == 'Discharge'
+    assert ha.gets() == 0
+    assert waitFor(lambda: server.cache.stats['events'] >= 2)
+
+def test_unknown_entity_read_over_rest(ha,logger):
+    server = battery.homeAssistant(ha.url,"token",logger)
+    assert server.startCache()
+    missing = battery.haEntity(server,'sensor.missing')
+    assert missing.getState() is None
+    assert ha.gets('sensor.missing') == 1
+
+def test_cache_disconnected_falls_back_to_rest(ha,logger):
+    server = battery.homeAssistant(ha.url,"token",logger)
+    level = battery.haEntity(server,'input_number.niva')
+    server.cache = battery.haStateCache(server)                         # Not started, never connected
+    assert level.getState() == '0.1'
+    assert ha.gets('input_number.niva') == 1
+
+def test_entities_made_before_cache_are_tracked(ha,logger):
+    server = battery.homeAssistant(ha.url,"token",logger)
+    mode = battery.haActuator(battery.haEntity(server,'input_select.battery_mode'))
+    level = battery.haEntity(server,'input_number.niva')
+    assert server.startCache()
+    assert mode.current() == 'Idle' and level.getState() == '0.1'
+    assert mode.cached() and not mode.due()                             # Read from the cache at every slot...
+    assert ha.gets() == 0                                               # ...without request
@@ -0,0 +1,31 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import battery
+from conftest import priceDay, quarterDays
+
+pytest.importorskip('scipy')
+
+#
+# Heating Off is counted over a rolling window: Eco slots between Off slots do not let heating stay off longer
+#
+
+def test_heating_off_within_rolling_window(logger):
+    data = battery.priceSeries(priceDay(quarterDays(1)[0]))
+    vector,levels = battery.buildJointChargeCntrlVector(data,logger,0,10.0)
+    off = np.array([x == 'Off' for x in levels])
+    window = battery.HEATOFFWINDOW*data.spm
+    counts = np.convolve(off,np.ones(window,dtype=int),'valid')
+    assert counts.max() <= battery.HEATOFFMAX*data.spm
+    assert off.sum() > battery.HEATOFFMAX*data.spm                      # Off in more than one window
+
+def test_joint_models_bounded(logger,monkeypatch):
+    monkeypatch.setattr(battery,'JOINTMODELS',{})
+    days = [battery.priceSeries(priceDay(x[:96 - i],datetime.date(2024,3,4))) for i,x in enumerate(quarterDays(6))]
+    for data in days :
+        battery.buildJointChargeCntrlVector(data,logger,0,10.0)
+    assert [key[0] for key in battery.JOINTMODELS] == [94,93,92,91]        # By no of slots, least recently used first
+    battery.buildJointChargeCntrlVector(days[2],logger,0,10.0)
+    assert [key[0] for key in battery.JOINTMODELS] == [93,92,91,94]
@@ -0,0 +1,84 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import battery
+from conftest import waitFor
+
+#
+# Tibber live readings replayed by a local stand-in, data/livemeasurement.jsonl: a Pulse reading every 2 s, with a
+# peak of about 12 kW when the car charger starts
+#
+
+READINGS = [json.loads(x) for x in open(os.path.join(os.path.dirname(__file__),'data','livemeasurement.jsonl'))]
+
+@pytest.fixture
+def replay():
+    pytest.importorskip('aiohttp')
+    pytest.importorskip('websocket')
+    from standin import liveStandIn
+    server = liveStandIn(READINGS).start()
+    yield server
+    server.stop()
+
+class plannedMode:
+
+    def __init__(self,mode):
+        self.mode = mode
+
+    def plannedMode(self,slot):
+        return self.mode
+
+    def batteryMode(self,slot,battery_mode):
+        return self.mode if self.mode != battery_mode else None
+
+def test_replay_into_ring(replay,logger):
+    live = battery.tibberLive(logger,replay.url,'home1',size=8)
+    live.start()
+    assert waitFor(lambda: live.stats['readings'] == len(READINGS))
+    assert replay.homes == ['home1'] and live.stats['connects'] == 1
+    assert live.buffer.count == len(READINGS) and len(live.buffer.time) == 8       # Bounded
+    importing,exporting = live.rolling()
+    assert importing == pytest.approx(sum(x['power'] for x in READINGS[-8:])/8/1000)
+    assert exporting == 0
+
+def test_peak_overrides_plan(replay,logger,monkeypatch):
+    live = battery.tibberLive(logger,replay.url,'home1')
+    shaver = battery.peakShaver(live,5.0,logger)
+    due = []
+    live.listeners.append(lambda: due.append(shaver.due()))
+    live.start()
+    assert waitFor(lambda: live.stats['readings'] == len(READINGS))
+    power = np.cumsum([x['power'] for x in READINGS])/np.arange(1,len(READINGS) + 1)/1000
+    above = power > 5.0                                         # All readings are within PEAKWINDOW
+    assert due == list(above & ~np.concatenate(([False],above[:-1])))     # Once, when the peak starts
+    assert sum(due) == 1
+    plan = plannedMode('Charge')
+    assert shaver.batteryMode(plan,0,'Charge') == 'Selfconsumption'
+    assert shaver.batteryMode(plan,0,'Selfconsumption') is None
+    assert shaver.stats == {'overrides':1,'maxpeak':pytest.approx(sum(x['power'] for x in READINGS)/len(READINGS)/1000,abs=0.01)}
+    monkeypatch.setattr(battery,'PEAKWINDOW',0)                 # No readings in the window
+    monkeypatch.setattr(battery,'PEAKHOLD',0.1)
+    assert waitFor(shaver.due)
+    assert shaver.batteryMode(plan,0,'Selfconsumption') == 'Charge'
+    assert not shaver.active
+    assert shaver.batteryMode(plannedMode('Discharge'),0,'Charge') == 'Discharge'
+
+#
+# A peak while the plan discharges is not overridden, and wakes the control loop only when it starts
+#
+
+def test_peak_during_discharge_wakes_once(replay,logger):
+    live = battery.tibberLive(logger,replay.url,'home1')
+    shaver = battery.peakShaver(live,5.0,logger)
+    wakeups = []
+    live.listeners.append(lambda: shaver.due() and wakeups.append(live.stats['readings']))
+    live.start()
+    assert waitFor(lambda: live.stats['readings'] == len(READINGS))
+    assert len(wakeups) == 1
+    plan = plannedMode('Discharge')
+    assert shaver.batteryMode(plan,0,'Discharge') is None and not shaver.active
+    assert not shaver.due()
+    assert shaver.stats['overrides'] == 0
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+
+import battery
+from conftest import priceDay, quarterDays
+
+find_peaks = pytest.importorskip('scipy.signal').find_peaks
+
+#
+# Random prices, rounded so plateaus are common, as in real prices. Hourly and quarter-hourly days, and short series.
+#
+
+def randomPrices(n=2000,seed=3):
+    rng = np.random.default_rng(seed)
+    for i in range(n) :
+        size = rng.choice([1,2,3,5,24,96,100])
+        yield np.round(rng.uniform(0,3,size),rng.integers(0,3))
+
+def test_same_peaks_as_scipy():
+    for x in randomPrices() :
+        for y in (x,-x) :
+            peaks,properties = battery.findPeaks(y)
+            reference,referenceProperties = find_peaks(y,plateau_size=1)
+            assert np.array_equal(peaks,reference),y
+            for name in ('left_edges','right_edges','plateau_sizes') :
+                assert np.array_equal(properties[name],referenceProperties[name]),y
+
+#
+# The guarantee asked for: priceSegments gives the same segments as with scipy find_peaks
+#
+
+def test_same_segments_as_scipy(logger,monkeypatch):
+    days = [x for x in randomPrices(500) if len(x) in (24,96)] + quarterDays(20)
+    days = [battery.priceSeries(priceDay(x)) for x in days]
+    segments = [battery.priceSegments(data,logger) for data in days]
+    monkeypatch.setattr(battery,'findPeaks',lambda x: find_peaks(x,plateau_size=1))
+    assert segments == [battery.priceSegments(data,logger) for data in days]
+
+#
+# Benchmark, findPeaks must not be slower than scipy on a day of prices, and importing battery must not import scipy
+#
+
+def test_findpeaks_benchmark():
+    x = quarterDays(1)[0]
+    timings = {}
+    for name,function in (('findPeaks',battery.findPeaks),('scipy',lambda x: find_peaks(x,plateau_size=1))) :
+        start = time.perf_counter()
+        for i in range(1000) : function(x)
+        timings[name] = (time.perf_counter() - start)/1000
+    print(f"findPeaks {timings['findPeaks']*1e6:.1f} us, scipy find_peaks {timings['scipy']*1e6:.1f} us per 96 slot day")
+    assert timings['findPeaks'] < 2*timings['scipy']
+
+def test_import_without_scipy(tmp_path):
+    (tmp_path/'privatetokens.py').write_text("HA_URL = 'http://127.0.0.1:8123'\nHA_TOKEN = 'token'\nTIBBER_TOKEN = 'token'\n")
+    code = "import sys; import battery; assert 'scipy' not in sys.modules, 'scipy imported'"
+    path = os.pathsep.join([str(tmp_path),os.path.dirname(battery.__file__)])
+    subprocess.run([sys.executable,'-c',code],check=True,env={'PYTHONPATH':path},cwd=tmp_path)
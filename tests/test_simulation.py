@@ -0,0 +1,84 @@
+import datetime
+import json
+
+import numpy as np
+import pytest
+
+import battery
+
+#
+# Prices high in the morning and cheap late in the evening. A plan of one day can not earn on them, the horizon
+# planner charges in the evening for the morning after.
+#
+
+def eveningPrices(day):
+    data = battery.forecastSeries(day)
+    data.total = np.select([data.hour < 9,data.hour < 20],[1.5 + (data.hour == 7),1.0],0.2)
+    return data.data()
+
+@pytest.fixture
+def simulate(tmp_path,logger,monkeypatch):
+    for name in ('CLOCK','TIBBER_URL','PRICECACHE','CHECKPOINT','ARCHIVE','METRICSFILE','WEBSOCKET','LIVE','API','tibber',
+            'PLANNER','HORIZON') :
+        monkeypatch.setattr(battery,name,getattr(battery,name))
+    monkeypatch.setattr(battery,'ADAPTERS',{})
+    monkeypatch.setattr(battery.privatetokens,'HA_URL',battery.privatetokens.HA_URL)
+    for i in range(3) :
+        day = datetime.date(2024,3,4) + datetime.timedelta(days=i)
+        (tmp_path/f"{day}.json").write_text(json.dumps(eveningPrices(day)))
+    def run(planner,horizon=False):
+        battery.PLANNER,battery.HORIZON = planner,horizon
+        return battery.simulation(str(tmp_path),logger)
+    return run
+
+def test_revenue_carried_over_midnight(simulate):
+    daily = simulate('dp')
+    horizon = simulate('dp',True)
+    assert daily['days'] == horizon['days'] == 3
+    assert daily['ha_post'] > 0 and daily['tibber_requests'] > 0
+    assert daily['revenue_dp'] == horizon['revenue_dp'] > 0             # Optimum of the whole run, same for both
+    assert daily['revenue'] == pytest.approx(0,abs=0.01)
+    assert 0 < horizon['revenue'] <= horizon['revenue_dp']
+
+def test_slot_records(logger):
+    hourly = battery.priceSeries(eveningPrices(datetime.date(2024,3,4))[::4])
+    quarter = battery.priceSeries(battery.slotRecords(hourly,15))
+    assert quarter.minutes == 15 and len(quarter) == 4*len(hourly)
+    assert np.array_equal(quarter.total,np.repeat(hourly.total,4)) and np.array_equal(quarter.hour,np.repeat(hourly.hour,4))
+    vector = battery.buildDPChargeCntrlVector(hourly,logger)
+    assert battery.netValue(quarter,[x for x in vector for i in range(4)]) == pytest.approx(battery.netValue(hourly,vector))
+
+#
+# The battery mode of a slot is switched before prices are fetched in it, so waiting for Tibber never delays the switch
+#
+
+def test_switch_before_price_fetch(simulate,monkeypatch):
+    events = []
+    fetch,decision = battery.getPriceInfo,battery.firstDecision
+    def getPriceInfo(*args):
+        events.append(('fetch',battery.CLOCK.now()))
+        return fetch(*args)
+    def firstDecision(*args):
+        events.append(('switch',battery.CLOCK.now()))
+        return decision(*args)
+    monkeypatch.setattr(battery,'getPriceInfo',getPriceInfo)
+    monkeypatch.setattr(battery,'firstDecision',firstDecision)
+    simulate('dp')
+    fetches = [i for i,(kind,t) in enumerate(events) if kind == 'fetch' and i > 0]
+    assert fetches
+    for i in fetches :
+        assert events[i - 1][0] == 'switch' and events[i - 1][1] == events[i][1]
+
+#
+# Today's prices arriving late (-z): the rest of the day is planned from the charge carried over midnight
+#
+
+def test_late_prices_plan_from_carried_charge(logger,monkeypatch):
+    monkeypatch.setattr(battery,'HORIZON',True)
+    plan = battery.batteryPlan(logger)
+    plan.daystartsoc = 8                                                # Two hours of charge bought last evening
+    today = battery.priceSeries(eveningPrices(datetime.date(2024,3,5)))
+    assert plan.planToday({'today':today,'tomorrow':battery.priceSeries()},24)     # At 06:00
+    assert plan.expectedSoc(24) == 8
+    assert 'H' in plan.vector[28:32]                                    # Sold in the morning peak
+    assert battery.stateOfCharge(plan.vector,len(plan.vector),today.spm,8) == 0
@@ -0,0 +1,39 @@
+import datetime
+
+import pytest
+
+import battery
+from conftest import priceDay, quarterDays
+
+
+@pytest.fixture
+def week(monkeypatch):
+    days = [battery.priceSeries(priceDay(x,datetime.date(2024,3,4) + datetime.timedelta(days=i))) for i,x in enumerate(quarterDays(7))]
+    monkeypatch.setattr(battery,'TUNEDAYS',days)
+    return list(range(len(days)))
+
+def revenues(index,logger):
+    return {length:sum(battery.tuneRun({'CYCLELENGTH':length},index,logger)) for length in (2,3,4)}
+
+#
+# The heuristic plans differently for each cycle length, and the ranking of them is what tuning gives
+#
+
+def test_heuristic_cycle_length_ranking(week,logger,monkeypatch):
+    monkeypatch.setattr(battery,'PLANNER','heuristic')
+    revenue = revenues(week,logger)
+    assert len(set(revenue.values())) == 3
+    assert sorted(revenue,key=revenue.get,reverse=True) == [3,2,4]
+
+#
+# Scored on a battery of its own size a longer cycle earns more, on the configured battery (CYCLELENGTH 3) it does not
+#
+
+def test_cycle_length_scored_on_configured_battery(week,logger,monkeypatch):
+    monkeypatch.setattr(battery,'PLANNER','dp')
+    assert battery.CYCLELENGTH == 3
+    configured = revenues(week,logger)
+    monkeypatch.setattr(battery,'SCORED',tuple(x for x in battery.SCORED if x != 'CYCLELENGTH'))
+    own = revenues(week,logger)
+    assert max(own,key=own.get) == 4 and max(configured,key=configured.get) == 3
+    assert configured[4] < own[4] and configured[3] == own[3]